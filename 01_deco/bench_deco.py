@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Скорость n_ary на вызовах с большим числом аргументов, отдельно и под countcalls и memo. Результат сверяется со
+сверткой справа через reduce."""
+import argparse
+import sys
+import time
+from functools import reduce
+
+from deco import countcalls, memo, n_ary
+
+
+@n_ary
+def plain_add(a, b):
+    return a + b
+
+
+@countcalls
+@n_ary
+def counted_add(a, b):
+    return a + b
+
+
+@memo
+@countcalls
+@n_ary
+def memo_counted_add(a, b):
+    return a + b
+
+
+def fold_right(args):
+    return reduce(lambda result, arg: arg + result, reversed(args[:-1]), args[-1])
+
+
+def get_calls(func):
+    calls = getattr(func, 'calls', None)
+    return calls.calls if calls is not None else None
+
+
+def bench(name, func, args, base_seconds):
+    calls_before = get_calls(func)
+    started = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - started
+    assert result == fold_right(args), '{} differs from reduce'.format(name)
+    line = '{}: {:.3f}s'.format(name, seconds)
+    if base_seconds:
+        line += ', x{:.1f} of reduce'.format(seconds / base_seconds)
+    if calls_before is not None:
+        line += ', {} calls'.format(get_calls(func) - calls_before)
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark n_ary on calls with many arguments.')
+    parser.add_argument('--args', type=int, nargs='+', default=[1000, 10000, 100000], help='numbers of arguments')
+    args = parser.parse_args()
+    print('recursion limit: {}'.format(sys.getrecursionlimit()))
+    for count in args.args:
+        values = list(range(count))
+        print('{} arguments'.format(count))
+        started = time.perf_counter()
+        fold_right(values)
+        base_seconds = time.perf_counter() - started
+        print('reduce: {:.3f}s'.format(base_seconds))
+        for name, func in (('n_ary', plain_add), ('countcalls + n_ary', counted_add),
+                           ('memo + countcalls + n_ary', memo_counted_add)):
+            bench(name, func, values, base_seconds)
+
+
+if __name__ == '__main__':
+    main()
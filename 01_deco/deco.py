@@ -1,4 +1,9 @@
 #!/usr/bin/env python
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, deque
 from functools import update_wrapper, partial, WRAPPER_ASSIGNMENTS
 from itertools import zip_longest, chain
 
@@ -10,9 +15,9 @@ def get_global_func(func):
     return r
 
 
-# В итоге пришлось добавить в каждый декоратор код, чтобы реализовать disable как описано. Может быть есть другой,
-# более изящный способ?
-def disable():
+# Декоратор, замененный на disable, возвращает функцию как есть, так что выключенный декоратор ничего не стоит при
+# вызовах. memo и n_ary еще и проверяют при каждом вызове, не выключили ли их уже после декорирования.
+def disable(func=None, *args, **kwargs):
     '''
     Disable a decorator by re-assigning the decorator's name
     to this function. For example, to turn off memoization:
@@ -20,7 +25,8 @@ def disable():
     >>> memo = disable
 
     '''
-    pass
+    # Декоратор с параметрами, как trace("####"), сначала вызывается с параметрами и должен вернуть декоратор
+    return func if callable(func) else disable
 
 
 CUSTOM_WRAPPER_ASSIGNMENTS = WRAPPER_ASSIGNMENTS + ('calls',)
@@ -52,12 +58,10 @@ def countcalls(func):
     @decorator(func)
     def wrapper(*args, **kwargs):
         result = func(*args, **kwargs)
-        if countcalls.__name__ == disable.__name__:
-            return result
-        wrapper.calls.calls += 1
+        calls.calls += 1
         return result
 
-    wrapper.calls = CountObj()
+    calls = wrapper.calls = CountObj()
     return wrapper
 
 
@@ -67,8 +71,6 @@ def countcalls2(func):
     @decorator(func)
     def wrapper(*args, **kwargs):
         result = func(*args, **kwargs)
-        if countcalls.__name__ == disable.__name__:
-            return result
         global_func = get_global_func(func)
         if hasattr(global_func, 'calls'):
             global_func.calls += 1
@@ -79,25 +81,308 @@ def countcalls2(func):
     return wrapper
 
 
-def memo(func):
+class CallStats:
+    '''Статистика profile по функции. calls - все вызовы, top_calls - вызовы не изнутри других вызовов с profile, из
+    них выбирается каждый sample-й. Время только по выбранным вызовам и вызовам внутри них: cumulative - вместе с
+    вложенными вызовами, рекурсивный вызов внутри выбранного не добавляется повторно, self - без времени вложенных
+    функций с profile. Все поля меняются под PROFILE_LOCK.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.top_calls = 0
+        self.sampled = 0
+        self.cumulative_time = 0.0
+        self.self_time = 0.0
+
+    def __repr__(self):
+        return 'CallStats({}: calls={}, top_calls={}, sampled={}, cumulative={:.6f}s, self={:.6f}s)'.format(
+            self.name, self.calls, self.top_calls, self.sampled, self.cumulative_time, self.self_time)
+
+
+PROFILE_LOCK = threading.Lock()
+# Для каждого потока: stack - стек выполняющихся выбранных вызовов profile, [CallStats, время вложенных вызовов],
+# skipped - глубина вложенности в невыбранный вызов
+PROFILE_STATE = threading.local()
+# Свернутые стеки для flame graph: 'f;g;h' -> собственное время h в этом стеке в секундах
+FOLDED_STACKS = Counter()
+
+
+def profile(sample=1):
+    '''Collect call counts and wall time of the function decorated.
+
+    @profile(sample=100)
+    def fib(n):
+        ....
+
+    Every call is counted, but only 1 in sample top level calls (made outside of other profiled
+    calls) is timed, together with all profiled calls inside it. Calls inside a top level call
+    that is not sampled are not timed either. Stats are in fib.stats, stacks of timed calls are
+    written by dump_flamegraph.
+    '''
+
+    def decorate(func):
+        stats = CallStats(func.__qualname__)
+
+        @decorator(func)
+        def wrapper(*args, **kwargs):
+            state = PROFILE_STATE
+            stack = getattr(state, 'stack', None)
+            if stack is None:
+                stack = state.stack = []
+                state.skipped = 0
+            skip = state.skipped
+            with PROFILE_LOCK:
+                stats.calls += 1
+                if not stack and not skip:
+                    stats.top_calls += 1
+                    skip = (stats.top_calls - 1) % sample
+            if skip:
+                # Невыбранный вызов верхнего уровня пропускается вместе со всеми вызовами внутри него
+                state.skipped += 1
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    state.skipped -= 1
+            frame = [stats, 0.0]
+            stack.append(frame)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+                folded = ';'.join([parent[0].name for parent in stack] + [stats.name])
+                with PROFILE_LOCK:
+                    stats.sampled += 1
+                    stats.self_time += elapsed - frame[1]
+                    if all(parent[0] is not stats for parent in stack):
+                        stats.cumulative_time += elapsed
+                    FOLDED_STACKS[folded] += elapsed - frame[1]
+
+        wrapper.stats = stats
+        return wrapper
+
+    return decorate
+
+
+def dump_flamegraph(path):
+    '''Пишет стеки выбранных вызовов profile в формате свернутых стеков ("f;g;h 1234", собственное время
+    в микросекундах), который понимают flamegraph.pl и speedscope'''
+    with PROFILE_LOCK:
+        stacks = sorted(FOLDED_STACKS.items())
+    with open(path, mode='w') as folded_file:
+        for stack, seconds in stacks:
+            microseconds = round(seconds * 1e6)
+            if microseconds > 0:
+                folded_file.write('{} {}\n'.format(stack, microseconds))
+
+
+MEMO_POLICIES = ('lru', 'lfu')
+# Отделяет в ключе кэша позиционные аргументы от именованных, чтобы f(1, ('a', 2)) и f(1, a=2) не совпали
+KWARGS_MARK = object()
+# Значения нет в кэше. Не None, потому что None, 0 и другие ложные значения тоже кэшируются.
+MISSING = object()
+
+
+def make_key(args, kwargs):
+    '''Ключ кэша memo. Именованные аргументы сортируются, f(a=1, b=2) и f(b=2, a=1) дают один ключ.'''
+    if not kwargs:
+        return args
+    return args + (KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+
+class MemoStats:
+
+    def __init__(self, hits=0, misses=0, evictions=0, expirations=0, size=0):
+        self.hits = hits
+        self.misses = misses
+        self.evictions = evictions
+        self.expirations = expirations
+        self.size = size
+
+    def __add__(self, other):
+        return MemoStats(self.hits + other.hits, self.misses + other.misses, self.evictions + other.evictions,
+                         self.expirations + other.expirations, self.size + other.size)
+
+    def __repr__(self):
+        return 'MemoStats(hits={}, misses={}, evictions={}, expirations={}, size={})'.format(
+            self.hits, self.misses, self.evictions, self.expirations, self.size)
+
+
+class MemoCache:
+    '''Сегмент кэша memo со своим замком. Хранит не больше max_size значений (None - без ограничения) и вытесняет
+    давно не использованное (lru) или реже всего использованное (lfu) значение. Значение старше ttl секунд считается
+    отсутствующим и удаляется, когда к нему обращаются, а также при каждом добавлении удаляются все устаревшие
+    значения, поэтому кэш с ttl без max_size не растет бесконечно.'''
+
+    def __init__(self, max_size=None, policy='lru', ttl=None):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.policy = policy
+        self.ttl = ttl
+        self.stats = MemoStats()
+        # ключ -> [значение, момент устаревания или None, число обращений], для lru в порядке давности обращения
+        self.data = OrderedDict()
+        # Для lfu: число обращений -> ключи с таким числом в порядке давности, чтобы при равенстве вытеснять старый
+        self.frequencies = {}
+        self.min_frequency = 0
+        # (момент устаревания, ключ) в порядке добавления. ttl у всех значений один, поэтому это и порядок устаревания.
+        self.expirations = deque()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self.remove(key)
+                self.stats.expirations += 1
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return MISSING
+            self.stats.hits += 1
+            self.touch(key, entry)
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            expires = None
+            if self.ttl is not None:
+                now = time.monotonic()
+                self.remove_expired(now)
+                expires = now + self.ttl
+                self.expirations.append((expires, key))
+            if key in self.data:
+                # Пока функция считалась без замка, значение успел положить другой поток
+                self.remove(key)
+            elif self.max_size is not None and len(self.data) >= self.max_size:
+                self.evict()
+            self.data[key] = [value, expires, 1]
+            if self.policy == 'lfu':
+                self.frequencies.setdefault(1, OrderedDict())[key] = None
+                self.min_frequency = 1
+
+    def remove_expired(self, now):
+        expirations = self.expirations
+        while expirations and expirations[0][0] <= now:
+            expires, key = expirations.popleft()
+            entry = self.data.get(key)
+            # Значение могли уже вытеснить или положить заново с новым сроком
+            if entry is not None and entry[1] == expires:
+                self.remove(key)
+                self.stats.expirations += 1
+
+    def touch(self, key, entry):
+        if self.policy == 'lru':
+            self.data.move_to_end(key)
+            return
+        frequency = entry[2]
+        self.remove_frequency(key, frequency)
+        if self.min_frequency == frequency and frequency not in self.frequencies:
+            self.min_frequency = frequency + 1
+        entry[2] = frequency + 1
+        self.frequencies.setdefault(frequency + 1, OrderedDict())[key] = None
+
+    def remove_frequency(self, key, frequency):
+        keys = self.frequencies[frequency]
+        del keys[key]
+        if not keys:
+            del self.frequencies[frequency]
+
+    def remove(self, key):
+        entry = self.data.pop(key)
+        if self.policy == 'lfu':
+            self.remove_frequency(key, entry[2])
+
+    def evict(self):
+        if self.policy == 'lru':
+            key = next(iter(self.data))
+        else:
+            # После remove min_frequency может указывать на уже пустую частоту
+            if self.min_frequency not in self.frequencies:
+                self.min_frequency = min(self.frequencies)
+            key = next(iter(self.frequencies[self.min_frequency]))
+        self.remove(key)
+        self.stats.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return self.stats + MemoStats(size=len(self.data))
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.frequencies.clear()
+            self.expirations.clear()
+            self.stats = MemoStats()
+
+
+def memo(func=None, max_size=None, policy='lru', ttl=None, stripes=1):
     '''
     Memoize a function so that it caches all return values for
     faster future lookups.
+
+    @memo
+    @memo(max_size=1000, policy='lfu', ttl=60, stripes=16)
+
+    max_size - max cached values, None - unbounded. policy - 'lru' or 'lfu' eviction.
+    ttl - seconds a value stays valid, None - forever. stripes - number of independently locked
+    cache segments, more stripes - less lock contention between threads.
+    Statistics are in func.cache_info(), func.cache_clear() empties the cache.
     '''
-    cache_dict = {}
+    if func is None:
+        return partial(memo, max_size=max_size, policy=policy, ttl=ttl, stripes=stripes)
+    if policy not in MEMO_POLICIES:
+        raise ValueError('Unknown memo policy "{}", should be one of {}'.format(policy, ', '.join(MEMO_POLICIES)))
+    if max_size is not None and max_size < stripes:
+        raise ValueError('memo max_size should be at least the number of stripes')
+    # Размер делится между сегментами поровну, поэтому общий размер может быть чуть меньше max_size
+    shards = [MemoCache(max_size // stripes if max_size is not None else None, policy, ttl) for _ in range(stripes)]
 
     @decorator(func)
     def wrapper(*args, **kwargs):
         if memo.__name__ == disable.__name__:
-            func(*args, **kwargs)
-        cache = cache_dict.get(args)
-        if cache:
-            return cache
-        else:
-            cache = func(*args, **kwargs)
-            cache_dict[args] = cache
-            return cache
+            return func(*args, **kwargs)
+        key = make_key(args, kwargs)
+        try:
+            shard = shards[hash(key) % stripes]
+        except TypeError:
+            # Аргументы, непригодные для ключа, например списки - вызов без кэша
+            return func(*args, **kwargs)
+        value = shard.get(key)
+        if value is MISSING:
+            # Функция считается без замка, иначе рекурсивные вызовы ждали бы сами себя. Два потока могут посчитать
+            # одно значение одновременно, в кэше останется последнее.
+            value = func(*args, **kwargs)
+            shard.put(key, value)
+        return value
+
+    def cache_info():
+        stats = MemoStats()
+        for shard in shards:
+            stats += shard.get_stats()
+        return stats
+
+    def cache_clear():
+        for shard in shards:
+            shard.clear()
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
 
+def get_outer_func(func, wrapper):
+    '''Возвращает функцию, под которой func с декораторами видна в своем модуле, если wrapper входит в ее цепочку
+    __wrapped__, иначе сам wrapper. Через нее шаги n_ary проходят и внешние декораторы, например countcalls и memo.'''
+    outer = func.__globals__.get(func.__name__)
+    current = outer
+    while current is not None:
+        if current is wrapper:
+            return outer
+        current = getattr(current, '__wrapped__', None)
     return wrapper
 
 
@@ -109,13 +394,15 @@ def n_ary(func):
 
     @decorator(func)
     def wrapper(*args, **kwargs):
-        global_func = get_global_func(func)
         if len(args) <= 2 or n_ary.__name__ == disable.__name__:
             return func(*args, **kwargs)
-        # Чтобы посчитать каждый вызов в рекурсии вызываем глобальную функцию,
-        # а можно еще вот так :-) reduce(func, reversed(args))
-        # но так мне меньше нравится чем написано в итоге
-        return global_func(*args[:-2], global_func(*args[-2:], **kwargs), **kwargs)
+        # Свертка справа циклом: глубина стека не зависит от числа аргументов. Каждый шаг вызывается через внешнюю
+        # функцию, чтобы его посчитали countcalls и закэшировал memo.
+        step = get_outer_func(func, wrapper)
+        result = args[-1]
+        for arg in reversed(args[:-1]):
+            result = step(arg, result, **kwargs)
+        return result
 
     return wrapper
 
@@ -158,7 +445,7 @@ def print_step(f, steps_data, delimiter, step, result, args, kwargs):
     print(*step_print_list, sep='')
 
 
-def trace(delimiter):
+def trace(delimiter, sample=1):
     '''Trace calls made to function decorated.
 
     @trace("____")
@@ -177,20 +464,31 @@ def trace(delimiter):
     ____ <-- fib(1) == 1
      <-- fib(3) == 3
 
+    With sample=N only 1 in N top level calls is traced, together with the calls inside it.
     '''
 
     def decorate(func):
         steps_data = {}
+        # top_calls - вызовов верхнего уровня, skipped - глубина вложенности в невыбранный вызов
+        state = {'top_calls': 0, 'skipped': 0}
 
         @decorator(func)
         def wrapper(*args, **kwargs):
-            if trace.__name__ == disable.__name__:
-                return func(*args, **kwargs)
+            if state['skipped'] or (not steps_data.get(func.__name__) and sample > 1 and skip_top_call()):
+                state['skipped'] += 1
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    state['skipped'] -= 1
             print_step(func, steps_data, delimiter, 1, None, args, kwargs)
             r = func(*args, **kwargs)
             print_step(func, steps_data, delimiter, -1, r, args, kwargs)
             return r
 
+        def skip_top_call():
+            state['top_calls'] += 1
+            return (state['top_calls'] - 1) % sample != 0
+
         return wrapper
 
     return decorate
@@ -234,5 +532,184 @@ def main():
     print(fib.calls, 'calls made')
 
 
+def test_memo_eviction():
+    print("test_memo_eviction...")
+    calls = Counter()
+
+    def record(x):
+        calls[x] += 1
+        return x
+
+    lru = memo(record, max_size=2)
+    lru(1), lru(2), lru(1), lru(3)
+    # 1 использовали позже 2, поэтому вытеснено 2
+    lru(1), lru(2)
+    assert calls == Counter({1: 1, 2: 2, 3: 1})
+    assert lru.cache_info().evictions == 2 and lru.cache_info().size == 2
+    calls.clear()
+    lfu = memo(record, max_size=2, policy='lfu')
+    lfu(1), lfu(1), lfu(2), lfu(3)
+    # 2 использовали реже 1, поэтому вытеснено 2, хотя 1 использовали раньше
+    lfu(1), lfu(2)
+    assert calls == Counter({1: 1, 2: 2, 3: 1})
+    lfu.cache_clear()
+    assert lfu.cache_info().size == 0
+    print('OK')
+
+
+def test_memo_ttl():
+    print("test_memo_ttl...")
+    calls = Counter()
+
+    @memo(ttl=0.05)
+    def record(x):
+        calls[x] += 1
+        return x
+
+    record(1), record(1)
+    assert calls[1] == 1
+    time.sleep(0.06)
+    record(1)
+    assert calls[1] == 2 and record.cache_info().expirations == 1
+    # Без max_size устаревшие значения удаляются при добавлении новых, даже если к ним больше не обращаются
+    for x in range(100):
+        record(x)
+    time.sleep(0.06)
+    record(-1)
+    assert record.cache_info().size == 1
+    print('OK')
+
+
+def test_memo_keys():
+    print("test_memo_keys...")
+    calls = []
+
+    @memo
+    def record(a, b=0):
+        calls.append((a, b))
+        # Ложные значения тоже кэшируются
+        return None if a else 0
+
+    assert record(1, b=2) is None and record(1, b=2) is None
+    assert record(b=2, a=1) is None and record(a=1, b=2) is None
+    assert record(0) == 0 and record(0) == 0
+    assert len(calls) == 3
+    # Позиционный аргумент и именованный дают разные ключи
+    record(1, 2)
+    assert len(calls) == 4
+    # Непригодные для ключа аргументы считаются без кэша
+    record([1]), record([1])
+    assert len(calls) == 6
+    print('OK')
+
+
+def test_memo_threads():
+    print("test_memo_threads...")
+    calls = Counter()
+    calls_lock = threading.Lock()
+
+    @memo(max_size=64, stripes=4)
+    def square(x):
+        with calls_lock:
+            calls[x] += 1
+        return x * x
+
+    errors = []
+
+    def run():
+        for i in range(2000):
+            if square(i % 100) != (i % 100) ** 2:
+                errors.append(i)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = square.cache_info()
+    assert not errors
+    assert info.hits + info.misses == 8 * 2000 and info.size <= 64
+    assert info.misses == sum(calls.values())
+    print('OK')
+
+
+def test_profile():
+    print("test_profile...")
+
+    @profile(sample=3)
+    def fib_profiled(n):
+        return 1 if n <= 1 else fib_profiled(n - 1) + fib_profiled(n - 2)
+
+    for _ in range(6):
+        fib_profiled(10)
+    stats = fib_profiled.stats
+    # fib(10) - 177 вызовов, выбраны 1-й и 4-й вызовы верхнего уровня со всеми вложенными
+    assert stats.calls == 6 * 177 and stats.top_calls == 6 and stats.sampled == 2 * 177
+    assert 0 < stats.self_time <= stats.cumulative_time
+
+    @profile()
+    def counted():
+        pass
+
+    threads = [threading.Thread(target=lambda: [counted() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counted.stats.calls == counted.stats.sampled == 4000
+    print('OK')
+
+
+def test_dump_flamegraph():
+    print("test_dump_flamegraph...")
+    with PROFILE_LOCK:
+        FOLDED_STACKS.clear()
+
+    @profile(sample=2)
+    def leaf():
+        time.sleep(0.001)
+
+    @profile(sample=2)
+    def outer():
+        leaf()
+
+    for _ in range(4):
+        outer()
+    # leaf вызывается только из outer, поэтому корнем стека не бывает, даже в невыбранных вызовах outer
+    assert outer.stats.sampled == leaf.stats.sampled == 2 and leaf.stats.top_calls == 0
+    file_descriptor, path = tempfile.mkstemp(suffix='.folded')
+    os.close(file_descriptor)
+    try:
+        dump_flamegraph(path)
+        with open(path) as folded_file:
+            stacks = dict(line.rsplit(' ', 1) for line in folded_file.read().splitlines())
+    finally:
+        os.remove(path)
+    leaf_name, outer_name = leaf.stats.name, outer.stats.name
+    assert set(stacks) <= {outer_name, outer_name + ';' + leaf_name} and outer_name + ';' + leaf_name in stacks
+    assert int(stacks[outer_name + ';' + leaf_name]) >= 2000
+    print('OK')
+
+
+def test_disable():
+    print("test_disable...")
+
+    def add(a, b):
+        return a + b
+
+    # И декоратор без параметров, и с параметрами возвращают функцию как есть
+    assert disable(add) is add
+    assert disable("####")(add) is add
+    assert disable()(add) is add
+    print('OK')
+
+
 if __name__ == '__main__':
     main()
+    test_memo_eviction()
+    test_memo_ttl()
+    test_memo_keys()
+    test_memo_threads()
+    test_profile()
+    test_dump_flamegraph()
+    test_disable()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Бенчмарки log_analyzer на синтетическом логе из log_generator.
+
+modes    - сравнение скорости режимов разбора, заодно проверяет, что режимы дают одинаковый результат.
+pipeline - полный прогон main() с метриками по этапам. Результат дописывается в файл результатов и сравнивается с
+           предыдущим прогоном с теми же параметрами."""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time as sys_time
+from datetime import datetime
+
+import yaml
+
+import log_analyzer
+from lib_analyze import get_stat_data
+from lib_get_logs_names import log_params
+from log_analyzer import DEFAULT_SETTINGS
+from log_generator import add_generator_args, generate_log, get_generator_kwargs
+
+# Режимы, которые должны давать в точности такой же результат, как режим по умолчанию
+MODES = (
+    ('fast', {'line_parser': 'fast'}),
+    ('mmap', {'line_parser': 'mmap'}),
+    ('numpy', {'aggregation_engine': 'numpy'}),
+    ('fast+numpy', {'line_parser': 'fast', 'aggregation_engine': 'numpy'}),
+)
+
+LOG_DATE = '20170630'
+DEFAULT_RESULTS_PATH = './bench_results.jsonl'
+# Чтобы лог с --broken-ratio не отбрасывался по порогу, можно переопределить через --set
+BENCH_SETTINGS = dict(DEFAULT_SETTINGS, parse_success_threshold_percent=0)
+
+
+def run(log, repeat=1, **settings):
+    """Разбирает лог repeat раз и возвращает результат и лучшее время, чтобы меньше зависеть от шума машины"""
+    times = []
+    for _ in range(repeat):
+        started = sys_time.perf_counter()
+        stat_data = get_stat_data(log, **settings)
+        times.append(sys_time.perf_counter() - started)
+    return stat_data, min(times)
+
+
+def get_log_name(compress):
+    return 'nginx-access-ui.log-{}{}'.format(LOG_DATE, '.gz' if compress else '.log')
+
+
+def bench_modes(log_dir, generator_kwargs, compress, settings, repeat=1):
+    path = os.path.join(log_dir, get_log_name(compress))
+    generate_log(path, compress=compress, **generator_kwargs)
+    log = log_params(LOG_DATE, None, None, path, '.gz' if compress else '.log')
+    settings = dict(dict(BENCH_SETTINGS, report_size=0), **settings)
+    base, base_time = run(log, repeat, **settings)
+    print('default: {:.2f}s'.format(base_time))
+    for name, mode_settings in MODES:
+        stat_data, parse_time = run(log, repeat, **dict(settings, **mode_settings))
+        assert stat_data == base, 'Result of "{}" differs from default'.format(name)
+        print('{}: {:.2f}s, x{:.1f}'.format(name, parse_time, base_time / parse_time))
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(('git', 'rev-parse', '--short', 'HEAD'), stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_pipeline(log_dir, settings):
+    """Прогоняет log_analyzer.main() с конфигом из settings и возвращает общее время и метрики запуска"""
+    config_path = os.path.join(log_dir, 'config.yml')
+    metrics_path = os.path.join(log_dir, 'metrics.json')
+    reports_dir = os.path.join(log_dir, 'reports')
+    os.mkdir(reports_dir)
+    config = dict(settings, nginx_logs_dir=log_dir, reports_dir=reports_dir, metrics_file=metrics_path,
+                  analyzer_log_file=os.path.join(log_dir, 'log_analyzer.log'))
+    with open(config_path, mode='w') as config_file:
+        yaml.safe_dump(config, config_file)
+    argv = sys.argv[:]
+    sys.argv[:] = [log_analyzer.__file__, '-c', config_path]
+    started = sys_time.perf_counter()
+    try:
+        log_analyzer.main()
+    finally:
+        sys.argv[:] = argv
+    total_time = sys_time.perf_counter() - started
+    with open(metrics_path) as metrics_file:
+        return total_time, json.load(metrics_file)
+
+
+def find_previous(results_path, params):
+    """Последний сохраненный результат с теми же параметрами или None"""
+    previous = None
+    if os.path.isfile(results_path):
+        with open(results_path, encoding='utf-8') as results_file:
+            for line in results_file:
+                result = json.loads(line)
+                if result['params'] == params:
+                    previous = result
+    return previous
+
+
+def print_comparison(result, previous):
+    print('total: {:.2f}s'.format(result['total_sec']), end='')
+    if previous:
+        print(', x{:.2f} against {} of {}'.format(previous['total_sec'] / result['total_sec'], previous['commit'],
+                                                  previous['time']), end='')
+    print()
+    previous_stages = previous['metrics']['stages'] if previous else {}
+    for name, value in result['metrics']['stages'].items():
+        line = '  {}: {:.2f}s'.format(name, value)
+        if previous_stages.get(name) and value:
+            line += ', x{:.2f}'.format(previous_stages[name] / value)
+        print(line)
+    for name in ('lines_per_sec', 'bytes_per_sec', 'peak_rss_mb'):
+        print('  {}: {}'.format(name, result['metrics'].get(name)))
+
+
+def bench_pipeline(log_dir, generator_kwargs, compress, settings, results_path):
+    generate_log(os.path.join(log_dir, get_log_name(compress)), compress=compress, **generator_kwargs)
+    total_time, metrics = run_pipeline(log_dir, dict(BENCH_SETTINGS, **settings))
+    params = {'generator': generator_kwargs, 'gzip': compress, 'settings': settings}
+    result = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'params': params,
+        'total_sec': round(total_time, 3),
+        'metrics': metrics,
+    }
+    print_comparison(result, find_previous(results_path, params))
+    if results_path:
+        with open(results_path, mode='a', encoding='utf-8') as results_file:
+            results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def parse_setting(value):
+    """key=value, value разбирается как yaml: workers=4, line_parser=fast"""
+    key, _, raw_value = value.partition('=')
+    if key not in DEFAULT_SETTINGS:
+        raise argparse.ArgumentTypeError('Unknown setting "{}"'.format(key))
+    return key, yaml.safe_load(raw_value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark log_analyzer on a synthetic nginx log.')
+    parser.add_argument('bench', choices=('modes', 'pipeline'), nargs='?', default='modes')
+    add_generator_args(parser)
+    parser.add_argument('--gzip', action='store_true', help='generate gzipped log')
+    parser.add_argument('--set', type=parse_setting, action='append', default=[], dest='settings',
+                        metavar='KEY=VALUE', help='override analyzer setting, can be repeated')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every mode in "modes", the best time is shown')
+    parser.add_argument('--results', default=DEFAULT_RESULTS_PATH,
+                        help='file to append pipeline results to, empty - do not save')
+    args = parser.parse_args()
+
+    generator_kwargs = get_generator_kwargs(args)
+    settings = dict(args.settings)
+    log_dir = tempfile.mkdtemp()
+    try:
+        if args.bench == 'modes':
+            bench_modes(log_dir, generator_kwargs, args.gzip, settings, args.repeat)
+        else:
+            bench_pipeline(log_dir, generator_kwargs, args.gzip, settings, args.results)
+    finally:
+        shutil.rmtree(log_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import gzip
+import os
+import pickle
+import re
+from datetime import datetime
+from functools import partial
+
+from lib_analyze import LogAggregate, SketchReqData
+
+DAY_DATE_FORMAT = '%Y.%m.%d'
+
+ROLLUP_PERIODS = {
+    'week': lambda date: 'week-{}-W{:02}'.format(*date.isocalendar()[:2]),
+    'month': lambda date: date.strftime('month-%Y.%m'),
+}
+
+
+def to_day_aggregate(aggregate, sketch_relative_error):
+    """Сжимает LogAggregate до count/sum/max/скетча на url, чтобы хранить его рядом с отчетом и сливать с другими
+    днями"""
+    day_aggregate = LogAggregate(partial(SketchReqData, sketch_relative_error))
+    day_aggregate.parsed_data = {url: req_data.to_sketch(sketch_relative_error)
+                                 for url, req_data in aggregate.iter_req_data()}
+    day_aggregate.parsed_count = aggregate.parsed_count
+    day_aggregate.unparsed_count = aggregate.unparsed_count
+    day_aggregate.sum_all_time = aggregate.sum_all_time
+    day_aggregate.offset = aggregate.offset
+    return day_aggregate
+
+
+def get_day_aggregate_path(reports_dir, aggregate_name_template, date):
+    return os.path.join(reports_dir, aggregate_name_template.format(date.strftime(DAY_DATE_FORMAT)))
+
+
+def save_day_aggregate(aggregate, path):
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, mode='wb') as aggregate_file:
+        pickle.dump(aggregate, aggregate_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_day_aggregate(path):
+    with gzip.open(path, mode='rb') as aggregate_file:
+        return pickle.load(aggregate_file)
+
+
+def get_day_aggregates(reports_dir, aggregate_name_template):
+    """Возвращает {дата: путь} для всех сохраненных дневных агрегатов"""
+    name_re = re.compile(re.escape(aggregate_name_template).replace(re.escape('{}'), r'(?P<date>\d{4}\.\d{2}\.\d{2})')
+                         + '$')
+    day_aggregates = {}
+    for entry in os.scandir(reports_dir):
+        result = name_re.match(entry.name)
+        if not result:
+            continue
+        try:
+            date = datetime.strptime(result.group('date'), DAY_DATE_FORMAT)
+        except ValueError:
+            continue
+        day_aggregates[date] = entry.path
+    return day_aggregates
+
+
+def get_rollups(day_aggregates, period):
+    """Группирует пути дневных агрегатов по неделям или месяцам. Дни внутри периода идут по порядку."""
+    rollups = {}
+    for date in sorted(day_aggregates):
+        rollups.setdefault(ROLLUP_PERIODS[period](date), []).append(day_aggregates[date])
+    return rollups
+
+
+def merge_day_aggregates(paths):
+    aggregate = None
+    for path in paths:
+        day_aggregate = load_day_aggregate(path)
+        if aggregate is None:
+            aggregate = day_aggregate
+        else:
+            aggregate.merge(day_aggregate)
+    return aggregate
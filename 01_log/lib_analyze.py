@@ -1,10 +1,27 @@
 import gzip
 import logging
+import math
+import mmap
+import os
+import random
 import re
 import time as sys_time
+from array import array
+from collections import namedtuple
+from functools import partial
 from statistics import median
 
-from lib_errors import ErrorMessages
+from lib_checkpoint import Checkpoint
+from lib_errors import ErrorMessages, MyException
+from lib_gzip import GzipLineReader
+from lib_parallel import get_complete_lines_end, imap_ordered, iter_line_batches, split_to_ranges
+from lib_sketch import QuantileSketch
+from lib_urls import OTHER_URL, get_url_normalizer, normalize_analyzed_line
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class EmptyReqData:
@@ -13,9 +30,371 @@ class EmptyReqData:
         self.time_list = []
         self.time_sum = 0
 
+    def add(self, time):
+        self.count += 1
+        self.time_list.append(time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_list.extend(other.time_list)
+
+    def get_time_sum(self):
+        return sum(self.time_list)
+
+    def get_time_sq_sum(self):
+        return sum(time * time for time in self.time_list)
+
+    def get_stat(self):
+        return {
+            'time_med': median(self.time_list),
+            'time_max': max(self.time_list),
+        }
+
+    def get_quantile_interval(self, q):
+        low, high = get_quantile_interval_ranks(q, self.count)
+        time_list = sorted(self.time_list)
+        return time_list[low], time_list[high]
+
+    def to_sketch(self, relative_error):
+        sketch_req_data = SketchReqData(relative_error)
+        for time in self.time_list:
+            sketch_req_data.add(time)
+        return sketch_req_data
+
+
+class SketchReqData:
+    """Хранит count, сумму и максимум точно, а квантили приблизительно, поэтому память не растет с числом запросов"""
+    PERCENTILES = (90, 95, 99)
+    # На уровне класса для агрегатов за день, сохраненных до появления суммы квадратов
+    time_sq_sum = 0
+
+    def __init__(self, relative_error):
+        self.count = 0
+        self.time_sum = 0
+        self.time_sq_sum = 0
+        self.time_max = 0
+        self.sketch = QuantileSketch(relative_error)
+
+    def add(self, time):
+        self.count += 1
+        self.time_sum += time
+        self.time_sq_sum += time * time
+        if time > self.time_max:
+            self.time_max = time
+        self.sketch.add(time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_sq_sum += other.time_sq_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.sketch.merge(other.sketch)
+
+    def get_time_sum(self):
+        return self.time_sum
+
+    def get_time_sq_sum(self):
+        return self.time_sq_sum
+
+    def get_stat(self):
+        stat = {
+            'time_med': self.sketch.quantile(0.5),
+            'time_max': self.time_max,
+        }
+        for percentile in self.PERCENTILES:
+            stat['time_p{}'.format(percentile)] = self.sketch.quantile(percentile / 100)
+        return stat
+
+    def get_quantile_interval(self, q):
+        # quantile скетча берет значение с рангом q * (count - 1)
+        return tuple(self.sketch.quantile(rank / max(self.count - 1, 1))
+                     for rank in get_quantile_interval_ranks(q, self.count))
+
+    def to_sketch(self, relative_error):
+        return self
+
+
+# Квантиль нормального распределения для 95% доверительных интервалов
+Z_95 = 1.96
+# Квантили, которые бывают в строках отчета
+STAT_QUANTILES = {'time_med': 0.5, 'time_p90': 0.9, 'time_p95': 0.95, 'time_p99': 0.99}
+
+
+def get_quantile_interval_ranks(q, count):
+    """Ранги (с нуля) в отсортированной выборке из count значений, между которыми с вероятностью около 95% лежит
+    квантиль q всего лога. Число значений выборки меньше квантиля распределено биномиально Bin(count, q), интервал
+    для него берется по нормальному приближению."""
+    half_width = Z_95 * math.sqrt(count * q * (1 - q))
+    return max(math.floor(count * q - half_width), 0), min(math.ceil(count * q + half_width), count - 1)
+
+
+# Какая часть max_distinct_urls остается после слива хвоста в OTHER_URL. Запас нужен, чтобы не сливать хвост на
+# каждом новом url.
+URL_CAP_KEEP_SHARE = 0.9
+
+
+class LogAggregate:
+    """Накопленные данные по логу или по его куску, который разбирал отдельный процесс"""
+    # Каждая строка лога разобрана с вероятностью 1 / sample_step, см. analyze_log_sampled
+    sample_step = 1
+    # На уровне класса для агрегатов за день, сохраненных до появления ограничения
+    max_distinct_urls = None
+
+    def __init__(self, req_data_factory=EmptyReqData, max_distinct_urls=None):
+        self.req_data_factory = req_data_factory
+        # Если url стало больше, самые редкие из них сливаются в OTHER_URL
+        self.max_distinct_urls = max_distinct_urls
+        self.parsed_data = {}
+        self.parsed_count = 0
+        self.unparsed_count = 0
+        self.sum_all_time = 0
+        # Позиция в логе, до которой строки уже учтены. Для gz в распакованных байтах.
+        self.offset = 0
+        # Время чтения и распаковки gz через GzipLineReader, для метрик запуска
+        self.decompress_seconds = 0
+
+    def add_request(self, url, time):
+        req_data = self.parsed_data.get(url)
+        if req_data is None:
+            if self.max_distinct_urls and len(self.parsed_data) >= self.max_distinct_urls:
+                self.spill_tail()
+            req_data = self.parsed_data.setdefault(url, self.req_data_factory())
+        req_data.add(time)
+
+    def merge(self, other):
+        # Куски сливаются по порядку, поэтому url в словаре остаются в порядке первого появления в логе
+        for url, req_data in other.parsed_data.items():
+            self.parsed_data.setdefault(url, self.req_data_factory()).merge(req_data)
+        if self.max_distinct_urls and len(self.parsed_data) > self.max_distinct_urls:
+            self.spill_tail()
+        self.merge_counters(other)
+
+    def get_tail_urls(self, counts):
+        """Возвращает множество url с наименьшим числом запросов, которые надо слить в OTHER_URL, чтобы осталось
+        URL_CAP_KEEP_SHARE от max_distinct_urls. counts - {url: число запросов}."""
+        keep = max(int(self.max_distinct_urls * URL_CAP_KEEP_SHARE) - 1, 0)
+        urls = sorted((url for url in counts if url != OTHER_URL), key=counts.get, reverse=True)
+        return set(urls[keep:])
+
+    def spill_tail(self):
+        tail_urls = self.get_tail_urls({url: req_data.count for url, req_data in self.parsed_data.items()})
+        other_req_data = self.parsed_data.pop(OTHER_URL, None) or self.req_data_factory()
+        parsed_data = {}
+        for url, req_data in self.parsed_data.items():
+            if url in tail_urls:
+                other_req_data.merge(req_data)
+            else:
+                parsed_data[url] = req_data
+        parsed_data[OTHER_URL] = other_req_data
+        self.parsed_data = parsed_data
+
+    def merge_counters(self, other):
+        self.parsed_count += other.parsed_count
+        self.unparsed_count += other.unparsed_count
+        self.sum_all_time += other.sum_all_time
+        self.offset = other.offset
+        self.decompress_seconds += other.decompress_seconds
+
+    def iter_req_data(self):
+        return iter(self.parsed_data.items())
+
+    def get_stat_data(self, report_size):
+        """Превращает накопленные данные в строки отчета"""
+        count_all_reqs = self.parsed_count + self.unparsed_count
+        sum_time_all_reqs = round(self.sum_all_time, 3)
+        stat_data = []
+        for url, data_obj in self.parsed_data.items():
+            # Приходится проходить цикл, чтобы пересчитать общие суммы и отфильтровать запросы на которых суммарно по
+            # времени не набирается порог
+            time_sum = data_obj.get_time_sum()
+            if time_sum < report_size:
+                count_all_reqs -= data_obj.count
+                sum_time_all_reqs -= time_sum
+                continue
+            data_obj.time_sum = time_sum
+            count = data_obj.count
+            data = {
+                'url': url,
+                'count': count,
+                'time_sum': round(time_sum, 3),
+                'time_avg': round(time_sum / count, 3),
+            }
+            data.update((key, round(value, 3)) for key, value in data_obj.get_stat().items())
+            stat_data.append(data)
+        add_percents(stat_data, count_all_reqs, sum_time_all_reqs)
+        return stat_data
+
+
+class NumpyLogAggregate(LogAggregate):
+    """Вместо объекта на каждый url копит два плоских массива: id url и время запроса. Статистика по всем url
+    считается в конце несколькими векторными проходами numpy.
+    Записанные id при сливе хвоста в OTHER_URL не переписываются: в таблице other_ids слитые id просто начинают
+    указывать на id OTHER_URL, а переводятся по ней один раз в конце. Поэтому слив стоит O(новых запросов + url),
+    а не O(всех запросов)."""
+
+    def __init__(self, max_distinct_urls=None):
+        super().__init__(req_data_factory=None, max_distinct_urls=max_distinct_urls)
+        # url -> id, только для url, которые еще не слиты в OTHER_URL. id выдаются по порядку первого появления url.
+        self.url_ids = {}
+        # id -> id, в который он слит, или он сам
+        self.other_ids = array('I')
+        self.ids = array('I')
+        self.times = array('d')
+        # Число запросов по id из url_ids среди первых counted_ids записей ids, чтобы слив не пересчитывал их заново
+        self.id_counts = {}
+        self.counted_ids = 0
+        # Место OTHER_URL среди строк отчета - наименьший id среди слитых в него url
+        self.other_position = None
+
+    def add_url(self, url):
+        url_id = self.url_ids[url] = len(self.other_ids)
+        self.other_ids.append(url_id)
+        return url_id
+
+    def add_request(self, url, time):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            if self.max_distinct_urls and len(self.url_ids) >= self.max_distinct_urls:
+                self.spill_tail()
+            # Сам OTHER_URL получает id при сливе
+            url_id = self.url_ids.get(url)
+            if url_id is None:
+                url_id = self.add_url(url)
+        self.ids.append(url_id)
+        self.times.append(time)
+
+    def merge(self, other):
+        urls, rows = other.get_rows()
+        # Строки other по порядку -> id тех же url здесь
+        row_ids = np.array([self.url_ids[url] if url in self.url_ids else self.add_url(url) for url in urls],
+                           dtype=np.uint32)
+        self.ids.frombytes(row_ids[rows].tobytes())
+        self.times.extend(other.times)
+        if self.max_distinct_urls and len(self.url_ids) > self.max_distinct_urls:
+            self.spill_tail()
+        self.merge_counters(other)
+
+    def get_rows(self):
+        """Возвращает url строк отчета по порядку первого появления и номер строки для каждого запроса"""
+        url_ids = sorted(self.url_ids.items(), key=self.get_position)
+        urls = [url for url, _ in url_ids]
+        if not self.ids:
+            return urls, np.zeros(0, dtype=np.uint32)
+        row_by_id = np.zeros(len(self.other_ids), dtype=np.uint32)
+        row_by_id[[url_id for _, url_id in url_ids]] = np.arange(len(url_ids), dtype=np.uint32)
+        # Слитые id получают строку OTHER_URL
+        row_by_id = row_by_id[np.frombuffer(self.other_ids, dtype=np.uint32)]
+        return urls, row_by_id[np.frombuffer(self.ids, dtype=np.uint32)]
+
+    def get_position(self, url_and_id):
+        url, url_id = url_and_id
+        return self.other_position if url == OTHER_URL and self.other_position is not None else url_id
+
+    def spill_tail(self):
+        id_counts = self.id_counts
+        new_ids, new_counts = np.unique(np.frombuffer(self.ids, dtype=np.uint32)[self.counted_ids:],
+                                        return_counts=True)
+        for url_id, count in zip(new_ids.tolist(), new_counts.tolist()):
+            id_counts[url_id] = id_counts.get(url_id, 0) + count
+        self.counted_ids = len(self.ids)
+        tail_urls = self.get_tail_urls({url: id_counts.get(url_id, 0) for url, url_id in self.url_ids.items()})
+        tail_ids = [self.url_ids.pop(url) for url in tail_urls]
+        if not tail_ids:
+            return
+        other_id = self.url_ids.setdefault(OTHER_URL, min(tail_ids))
+        # OTHER_URL встает на место первого слитого url, если он раньше
+        self.other_position = min(min(tail_ids), other_id if self.other_position is None else self.other_position)
+        other_count = id_counts.pop(other_id, 0)
+        for url_id in tail_ids:
+            self.other_ids[url_id] = other_id
+            other_count += id_counts.pop(url_id, 0)
+        id_counts[other_id] = other_count
+
+    def get_groups(self):
+        """Возвращает url строк отчета, число запросов, сумму времени и времена, отсортированные по url, а внутри url
+        по возрастанию, и начало каждого url в них"""
+        urls, ids = self.get_rows()
+        times = np.frombuffer(self.times, dtype=np.float64)
+        counts = np.bincount(ids, minlength=len(urls))
+        # bincount складывает веса по порядку, так же как sum по списку времен в EmptyReqData
+        time_sums = np.bincount(ids, weights=times, minlength=len(urls))
+        sorted_times = times[np.lexsort((times, ids))]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        return urls, counts, time_sums, sorted_times, starts
+
+    def iter_req_data(self):
+        urls, counts, _, sorted_times, starts = self.get_groups()
+        for url, start, count in zip(urls, starts.tolist(), counts.tolist()):
+            req_data = EmptyReqData()
+            req_data.count = count
+            req_data.time_list = sorted_times[start:start + count].tolist()
+            yield url, req_data
+
+    def get_stat_data(self, report_size):
+        if not self.url_ids:
+            return []
+        urls, counts, time_sums, sorted_times, starts = self.get_groups()
+        medians = (sorted_times[starts + (counts - 1) // 2] + sorted_times[starts + counts // 2]) / 2
+        maxes = np.maximum.reduceat(sorted_times, starts)
+        in_report = time_sums >= report_size
+        count_all_reqs = self.parsed_count + self.unparsed_count - int(counts[~in_report].sum())
+        sum_time_all_reqs = round(self.sum_all_time, 3) - float(time_sums[~in_report].sum())
+        urls = np.array(urls, dtype=object)[in_report]
+        # round из python, а не np.round, чтобы округление совпадало с обычным отчетом
+        stat_data = [{
+            'url': url,
+            'count': count,
+            'time_sum': round(time_sum, 3),
+            'time_avg': round(time_sum / count, 3),
+            'time_med': round(time_med, 3),
+            'time_max': round(time_max, 3),
+        } for url, count, time_sum, time_med, time_max in zip(
+            urls.tolist(), counts[in_report].tolist(), time_sums[in_report].tolist(), medians[in_report].tolist(),
+            maxes[in_report].tolist())]
+        add_percents(stat_data, count_all_reqs, sum_time_all_reqs)
+        return stat_data
+
+
+def add_percents(stat_data, count_all_reqs, sum_time_all_reqs):
+    for data in stat_data:
+        count = data['count']
+        time_sum = data['time_sum']
+        data.update({
+            'count_perc': round(count * 100 / count_all_reqs, 2),
+            'time_perc': round(time_sum * 100 / sum_time_all_reqs, 2),
+        })
+
+
+AGGREGATION_ENGINES = ('exact', 'sketch', 'numpy')
+
+
+def get_aggregate_factory(aggregation_engine='exact', sketch_relative_error=0.01, max_distinct_urls=None, **settings):
+    """Возвращает функцию, создающую пустой LogAggregate для выбранного способа подсчета"""
+    if aggregation_engine not in AGGREGATION_ENGINES:
+        raise MyException(ErrorMessages.unknown_aggregation_engine.format(aggregation_engine,
+                                                                          ', '.join(AGGREGATION_ENGINES)))
+    if aggregation_engine == 'sketch':
+        return partial(LogAggregate, partial(SketchReqData, sketch_relative_error), max_distinct_urls)
+    if aggregation_engine == 'numpy':
+        if np is None:
+            raise MyException(ErrorMessages.numpy_not_installed)
+        return partial(NumpyLogAggregate, max_distinct_urls)
+    return partial(LogAggregate, EmptyReqData, max_distinct_urls)
+
 
 TRIPLE_NONE = (None, None, None)
 
+LINE_PARSERS = ('regex', 'fast', 'mmap')
+
+# Какую часть оставшегося времени планировать на разбор выборки. Запас нужен, потому что пропущенные строки тоже
+# приходится читать, а для gz и распаковывать.
+SAMPLING_TIME_SHARE = 0.7
+# seed выборки строк, чтобы повторный разбор того же лога давал тот же отчет
+SAMPLING_SEED = 0
+
+chunk_task = namedtuple('chunk_task', ('line_analyzer', 'binary', 'max_time', 'aggregate_factory', 'log_file_path',
+                                       'lines', 'start', 'end'))
+
 
 def analyze_line(line, regex_line_from_log):
     result = regex_line_from_log.match(line)
@@ -27,12 +406,126 @@ def analyze_line(line, regex_line_from_log):
         return '', '', line
 
 
-def get_line(log, regex_line_from_log):
+def parse_request_time(field):
+    """Достает $request_time из хвоста строки после последней кавычки, например b' 0.390\\n'. Проверяется только
+    положение точки, остальное проверит float. Возвращает None, если поле не похоже на время."""
+    if field[-1:] == b'\n':
+        field = field[:-1]
+    if field[:1] == b' ' and field[-4:-3] == b'.' and field[-3:].isdigit():
+        try:
+            return float(field)
+        except ValueError:
+            return None
+    return None
+
+
+def fast_analyze_line(line, regex_line_from_log):
+    """Разбирает строку лога формата по умолчанию в байтах без regex. В такой строке ровно 12 кавычек, $request лежит
+    в первых кавычках, а $request_time - после последних, остальные поля не проверяются. Если что-то не сошлось,
+    строка разбирается обычным analyze_line."""
+    fields = line.split(b'"')
+    time = parse_request_time(fields[12]) if len(fields) == 13 else None
+    if time is not None:
+        request = fields[1].split(b' ')
+        if len(request) == 3 and request[1]:
+            return request[1].decode('utf-8'), time, ''
+        elif request == [b'0']:
+            return None, time, ''
+    return analyze_line(line.decode('utf-8'), regex_line_from_log)
+
+
+class MappedLineAnalyzer:
+    """Разбирает plain лог regex'ом прямо по отображенному в память файлу: для каждой строки ищется перевод строки и
+    regex применяется к куску буфера между ними, а в объекты превращаются только url и время. Строки лога целиком
+    не копируются и не декодируются, поэтому ошибки кодировки ловятся только в url.
+    Как функция разбора строки работает так же, как analyze_line, это нужно для разбора с checkpoint."""
+
+    def __init__(self, nginx_line_log_re, line_analyzer, url_normalizer=None):
+        # MULTILINE, чтобы ^ совпадал с началом строки в середине буфера
+        self.line_regex = re.compile(nginx_line_log_re.encode('utf-8'), re.VERBOSE | re.MULTILINE)
+        self.line_analyzer = line_analyzer
+        self.url_normalizer = url_normalizer
+
+    def __call__(self, line):
+        return self.line_analyzer(line)
+
+    def scan(self, log_file_path, start=0, end=None):
+        """Как get_chunk_line, но по отображенному в память файлу"""
+        with open(log_file_path, mode='rb') as log_file:
+            if not os.fstat(log_file.fileno()).st_size:
+                # Пустой файл отобразить нельзя
+                return
+            with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+                yield from self.scan_buffer(log_map, start, len(log_map) if end is None else end)
+
+    def scan_buffer(self, buffer, start, end):
+        find = buffer.find
+        match = self.line_regex.match
+        url_normalizer = self.url_normalizer
+        position = start
+        while position < end:
+            line_end = find(b'\n', position, end)
+            if line_end == -1:
+                line_end = end
+            result = match(buffer, position, line_end)
+            if result:
+                url, time = result.group('url', 'time')
+                if url:
+                    url = url.decode('utf-8')
+                    if url_normalizer:
+                        url = url_normalizer(url)
+                yield url, float(time), ''
+            else:
+                line = buffer[position:line_end + 1].decode('utf-8')
+                logging.error(ErrorMessages.line_not_matched + line)
+                yield '', '', line
+            position = line_end + 1
+
+
+def get_line_analyzer(nginx_line_log_re, line_parser='regex', compressed=False, **settings):
+    """Возвращает функцию разбора строки и признак того, что лог нужно читать в байтах.
+    compressed - лог в gz. Его разбор упирается в распаковку, и fast с mmap на нем не быстрее regex (замеры в
+    README), поэтому gz всегда разбирается через regex."""
+    if line_parser not in LINE_PARSERS:
+        raise MyException(ErrorMessages.unknown_line_parser.format(line_parser, ', '.join(LINE_PARSERS)))
+    if compressed:
+        line_parser = 'regex'
+    regex_line_from_log = re.compile(nginx_line_log_re, re.VERBOSE)
+    binary = line_parser == 'fast'
+    line_analyzer = partial(fast_analyze_line if binary else analyze_line, regex_line_from_log=regex_line_from_log)
+    url_normalizer = get_url_normalizer(**settings)
+    if url_normalizer:
+        line_analyzer = partial(normalize_analyzed_line, line_analyzer=line_analyzer, url_normalizer=url_normalizer)
+    if line_parser == 'mmap':
+        return MappedLineAnalyzer(nginx_line_log_re, line_analyzer, url_normalizer), binary
+    return line_analyzer, binary
+
+
+def open_log(log, binary):
     open_func = gzip.open if log.ext == '.gz' else open
+    if binary:
+        return open_func(log.log_file_path, mode='rb')
+    return open_func(log.log_file_path, mode='rt', encoding="utf-8")
+
+
+def get_line(log, line_analyzer, binary=False, aggregate=None):
+    """Разбирает строки лога. Если задан aggregate, в него добавляется время распаковки gz."""
     try:
-        with open_func(log.log_file_path, mode='rt', encoding="utf-8") as log_file:
-            for line in log_file:
-                yield analyze_line(line, regex_line_from_log)
+        if log.ext == '.gz':
+            # Распаковка большими блоками заметно быстрее построчного чтения через gzip.open, см. lib_gzip
+            with GzipLineReader(log.log_file_path) as log_file:
+                try:
+                    for line in log_file:
+                        yield line_analyzer(line if binary else line.decode('utf-8'))
+                finally:
+                    if aggregate is not None:
+                        aggregate.decompress_seconds += log_file.decompress_seconds
+        elif isinstance(line_analyzer, MappedLineAnalyzer):
+            yield from line_analyzer.scan(log.log_file_path)
+        else:
+            with open_log(log, binary) as log_file:
+                for line in log_file:
+                    yield line_analyzer(line)
 
     except ValueError:
         logging.error(ErrorMessages.log_encoding_error.format(log.log_file_path))
@@ -42,72 +535,284 @@ def get_line(log, regex_line_from_log):
         return TRIPLE_NONE
 
 
-def analyze_log(log, parse_success_threshold_percent, max_time_parsing_for_log, nginx_line_log_re, **settings):
-    parsed_data = {}
-    parsed_count = 0
-    unparsed_count = 0
-    sum_all_time = 0
-    max_time = sys_time.time() + max_time_parsing_for_log
-    regex_line_from_log = re.compile(nginx_line_log_re, re.VERBOSE)
-    for url, time, line in get_line(log, regex_line_from_log):
+def get_line_from_offset(log, line_analyzer, binary, aggregate, checkpoint=None, step=1, stop_position=None):
+    """Как get_line, но начинает с aggregate.offset и, если задан checkpoint, сохраняет его каждые
+    checkpoint.every_lines строк, а также когда чтение лога прекращается. Лог читается в байтах, чтобы знать позицию
+    строки в нем, по окончании чтения позиция записывается в aggregate.offset.
+    step > 1 - каждая строка разбирается с вероятностью 1 / step, остальные пропускаются.
+    stop_position - чтение прекращается, когда позиция в файле лога на диске (для gz в сжатых байтах) до него дошла."""
+    position = aggregate.offset
+    # Последняя строка дописываемого лога может быть неполной. Тогда checkpoint сохраняется до нее, чтобы при
+    # продолжении прочитать ее заново.
+    partial_line = False
+    skip = 0
+    if step > 1:
+        # Независимый выбор каждой строки, а не каждая step-я: у логов бывает периодичность, например health check
+        # раз в N запросов, и с ней регулярная выборка смещена. Между выбранными строками пропускается геометрически
+        # распределенное число строк, так что случайное число берется на выбранную строку, а не на каждую.
+        rnd = random.Random(SAMPLING_SEED)
+        log_skip_share = math.log(1 - 1 / step)
+        skip = int(math.log(1 - rnd.random()) / log_skip_share)
+    try:
+        with open_log(log, binary=True) as log_file:
+            log_file.seek(position)
+            raw_file = getattr(log_file, 'fileobj', log_file)
+            try:
+                for count, line in enumerate(log_file, 1):
+                    if stop_position is not None and raw_file.tell() >= stop_position:
+                        break
+                    if skip:
+                        skip -= 1
+                        position += len(line)
+                        continue
+                    if step > 1:
+                        skip = int(math.log(1 - rnd.random()) / log_skip_share)
+                    analyzed_line = line_analyzer(line if binary else line.decode('utf-8'))
+                    if checkpoint and not line.endswith(b'\n'):
+                        partial_line = True
+                        checkpoint.save(aggregate, position)
+                    elif checkpoint and not count % checkpoint.every_lines:
+                        checkpoint.save(aggregate, position)
+                    position += len(line)
+                    yield analyzed_line
+            finally:
+                # Сюда попадаем и когда analyze_lines прекратил разбор, к этому моменту он учел последнюю строку
+                if not partial_line:
+                    aggregate.offset = position
+                if checkpoint and not partial_line:
+                    checkpoint.save(aggregate, position)
+
+    except ValueError:
+        logging.error(ErrorMessages.log_encoding_error.format(log.log_file_path))
+        return TRIPLE_NONE
+    except OSError:
+        logging.error(ErrorMessages.log_file_open_problem.format(log.log_file_path))
+        return TRIPLE_NONE
+
+
+def get_chunk_line(log_file_path, start, end, line_analyzer, binary):
+    """Как get_line, но читает только строки из диапазона байт [start, end) plain лога"""
+    if isinstance(line_analyzer, MappedLineAnalyzer):
+        yield from line_analyzer.scan(log_file_path, start, end)
+        return
+    with open(log_file_path, mode='rb') as log_file:
+        log_file.seek(start)
+        position = start
+        for line in log_file:
+            if position >= end:
+                break
+            position += len(line)
+            yield line_analyzer(line if binary else line.decode('utf-8'))
+
+
+def analyze_lines(analyzed_lines, aggregate, max_time):
+    """Складывает разобранные строки в aggregate. Возвращает False, если анализ лога надо прекратить."""
+    add_request = aggregate.add_request
+    for url, time, line in analyzed_lines:
         if url:
-            req_data = parsed_data.setdefault(url, EmptyReqData())
-            req_data.count += 1
-            req_data.time_list.append(time)
-            sum_all_time += time
-            parsed_count += 1
+            add_request(url, time)
+            aggregate.sum_all_time += time
+            aggregate.parsed_count += 1
         elif not line:
             # Как правило что-то вроде 400 ответа, где нет никакого запроса, скипаю без учета в количестве
             continue
         elif line:
-            unparsed_count += 1
+            aggregate.unparsed_count += 1
         elif url is None and time is None and line is None:
             # Значит есть ошибка в парсинге, требуется прекратить дальнейший анализ лога
-            return TRIPLE_NONE
+            return False
+
+        if sys_time.time() > max_time:
+            return False
+    return True
+
+
+def analyze_chunk(task):
+    """Выполняется в дочернем процессе. В task либо путь до лога и диапазон байт, либо прочитанные строки gz лога."""
+    if task.lines is None:
+        analyzed_lines = get_chunk_line(task.log_file_path, task.start, task.end, task.line_analyzer, task.binary)
+    elif task.binary:
+        analyzed_lines = map(task.line_analyzer, task.lines)
+    else:
+        analyzed_lines = (task.line_analyzer(line.decode('utf-8')) for line in task.lines)
+    aggregate = task.aggregate_factory()
+    aggregate.offset = task.end
+    try:
+        if analyze_lines(analyzed_lines, aggregate, task.max_time):
+            return aggregate
+    except ValueError:
+        logging.error(ErrorMessages.log_encoding_error.format(task.log_file_path))
+    except OSError:
+        logging.error(ErrorMessages.log_file_open_problem.format(task.log_file_path))
+    return None
+
+
+def get_chunk_tasks(log, workers, line_analyzer, binary, max_time, aggregate_factory, aggregate):
+    offset = aggregate.offset
+    if log.ext == '.gz':
+        # Строки gz читаются в байтах, чтобы посчитать позицию конца пачки для checkpoint
+        with GzipLineReader(log.log_file_path, offset) as log_file:
+            try:
+                for batch in iter_line_batches(log_file):
+                    start, offset = offset, offset + sum(map(len, batch))
+                    yield chunk_task(line_analyzer, binary, max_time, aggregate_factory, log.log_file_path, batch,
+                                     start, offset)
+            finally:
+                # gz распаковывается в основном процессе, поэтому время распаковки добавляется сразу в общий агрегат
+                aggregate.decompress_seconds += log_file.decompress_seconds
+    else:
+        # Недописанный хвост plain лога разберет analyze_log после всех кусков
+        end = get_complete_lines_end(log.log_file_path)
+        for start, end in split_to_ranges(log.log_file_path, workers, offset, end):
+            yield chunk_task(line_analyzer, binary, max_time, aggregate_factory, log.log_file_path, None, start, end)
+
+
+def analyze_log_parallel(log, workers, line_analyzer, binary, max_time, aggregate, aggregate_factory,
+                         checkpoint=None):
+    """Дополняет aggregate данными из кусков лога, разобранных в workers процессах. Возвращает False, если разбор
+    прерван."""
+    tasks = get_chunk_tasks(log, workers, line_analyzer, binary, max_time, aggregate_factory, aggregate)
+    try:
+        for chunk_aggregate in imap_ordered(analyze_chunk, tasks, workers):
+            if chunk_aggregate is None:
+                return False
+            aggregate.merge(chunk_aggregate)
+            if checkpoint:
+                checkpoint.save(aggregate, aggregate.offset)
+    except ValueError:
+        logging.error(ErrorMessages.log_encoding_error.format(log.log_file_path))
+        return False
+    except OSError:
+        logging.error(ErrorMessages.log_file_open_problem.format(log.log_file_path))
+        return False
+    return True
 
+
+def get_checkpoint(log, checkpoint_dir=None, checkpoint_every_lines=1000000, nginx_line_log_re=None,
+                   aggregation_engine='exact', sketch_relative_error=None, url_normalization_rules=None,
+                   collapse_numeric_segments=False, max_distinct_urls=None, **settings):
+    if not checkpoint_dir:
+        return None
+    settings_key = (nginx_line_log_re, aggregation_engine, sketch_relative_error,
+                    repr(url_normalization_rules), collapse_numeric_segments, max_distinct_urls)
+    return Checkpoint(checkpoint_dir, log, settings_key, checkpoint_every_lines)
+
+
+def analyze_log_lines(log, workers, line_analyzer, binary, max_time, aggregate, aggregate_factory, checkpoint):
+    """Дополняет aggregate строками лога. Возвращает False, если разбор прерван."""
+    if workers > 1:
+        if not analyze_log_parallel(log, workers, line_analyzer, binary, max_time, aggregate, aggregate_factory,
+                                    checkpoint):
+            return False
+        if log.ext == '.gz':
+            # gz распакован до конца, а seek по нему распаковал бы все заново
+            return True
+    elif not checkpoint and not aggregate.offset:
+        return analyze_lines(get_line(log, line_analyzer, binary, aggregate), aggregate, max_time)
+    # Хвост лога после кусков, разобранных в процессах, либо весь лог, если надо знать позицию в нем
+    return analyze_lines_from_offset(log, line_analyzer, binary, max_time, aggregate, checkpoint)
+
+
+def analyze_lines_from_offset(log, line_analyzer, binary, max_time, aggregate, checkpoint=None, **kwargs):
+    analyzed_lines = get_line_from_offset(log, line_analyzer, binary, aggregate, checkpoint, **kwargs)
+    try:
+        return analyze_lines(analyzed_lines, aggregate, max_time)
+    finally:
+        # Закрываем явно, чтобы checkpoint сохранился сразу, а не когда сборщик мусора доберется до генератора
+        analyzed_lines.close()
+
+
+def analyze_log_sampled(log, line_analyzer, binary, max_time, aggregate_factory, sampling_probe_mb):
+    """Разбирает первые sampling_probe_mb мегабайт лога и по скорости разбора оценивает, уложится ли весь лог в
+    отведенное время. Если нет, то лог разбирается заново, но каждая строка попадает в разбор только с вероятностью
+    1 / step, и результат потом домножается на step. Заново, а не с места остановки, чтобы выборка была равномерной по
+    всему логу.
+    Возвращает LogAggregate или None, если разбор прерван."""
+    started = sys_time.time()
+    aggregate = aggregate_factory()
+    probe_bytes = sampling_probe_mb * 1024 * 1024
+    log_size = os.path.getsize(log.log_file_path)
+    if log_size <= probe_bytes:
+        return aggregate if analyze_lines_from_offset(log, line_analyzer, binary, max_time, aggregate) else None
+    if not analyze_lines_from_offset(log, line_analyzer, binary, max_time, aggregate, stop_position=probe_bytes):
+        return None
+    now = sys_time.time()
+    projected_time = (now - started) * log_size / probe_bytes
+    if projected_time - (now - started) <= max_time - now:
+        return aggregate if analyze_lines_from_offset(log, line_analyzer, binary, max_time, aggregate) else None
+    step = math.ceil(projected_time / ((max_time - now) * SAMPLING_TIME_SHARE))
+    logging.warning(ErrorMessages.sampling_enabled.format(projected_time, log.log_file_path, step))
+    aggregate = aggregate_factory()
+    aggregate.sample_step = step
+    return aggregate if analyze_lines_from_offset(log, line_analyzer, binary, max_time, aggregate, step=step) else None
+
+
+def analyze_log(log, parse_success_threshold_percent, max_time_parsing_for_log, nginx_line_log_re, workers=1,
+                time_budget_sampling=False, sampling_probe_mb=64, **settings):
+    """Возвращает LogAggregate по логу или None, если разобрать лог не удалось"""
+    aggregate_factory = get_aggregate_factory(**settings)
+    line_analyzer, binary = get_line_analyzer(nginx_line_log_re, compressed=log.ext == '.gz', **settings)
+    checkpoint = get_checkpoint(log, nginx_line_log_re=nginx_line_log_re, **settings)
+    aggregate = checkpoint and checkpoint.load() or aggregate_factory()
+    max_time = sys_time.time() + max_time_parsing_for_log
+    if time_budget_sampling and workers == 1 and not checkpoint:
+        aggregate = analyze_log_sampled(log, line_analyzer, binary, max_time, aggregate_factory, sampling_probe_mb)
+    elif not analyze_log_lines(log, workers, line_analyzer, binary, max_time, aggregate, aggregate_factory,
+                               checkpoint):
+        aggregate = None
+    if aggregate is None:
         if sys_time.time() > max_time:
             logging.error(ErrorMessages.parsing_time_exceeded.format(max_time_parsing_for_log, log.log_file_path))
-            return TRIPLE_NONE
-    if not parsed_data:
-        return TRIPLE_NONE
+        return None
+    if not aggregate.parsed_count:
+        return None
+    parsed_count = aggregate.parsed_count
+    unparsed_count = aggregate.unparsed_count
     parse_threshold_result = int(round(parsed_count * 100 / (parsed_count + unparsed_count), 0))
     if parse_threshold_result >= parse_success_threshold_percent:
-        return parsed_data, parsed_count + unparsed_count, round(sum_all_time, 3)
+        return aggregate
     else:
         logging.error(ErrorMessages.threshold_not_reached.format(parse_threshold_result,
                                                                  parse_success_threshold_percent))
-        return TRIPLE_NONE
+        return None
+
+
+def get_aggregate_stat_data(aggregate, report_size):
+    """Превращает LogAggregate в строки отчета"""
+    sample_step = aggregate.sample_step
+    stat_data = aggregate.get_stat_data(report_size / sample_step)
+    if sample_step > 1:
+        scale_sampled_stat_data(stat_data, sample_step, dict(aggregate.iter_req_data()))
+    return stat_data
+
+
+def scale_sampled_stat_data(stat_data, sample_step, req_data_by_url):
+    """Переводит строки отчета, посчитанные по выборке, куда каждая строка лога попала независимо с вероятностью
+    1 / sample_step, в оценки для всего лога. Проценты, среднее, медиана и перцентили по такой выборке оцениваются
+    как есть, а количество и сумма времени домножаются на sample_step. К ним добавляются 95% доверительные интервалы:
+    count_err, time_sum_err - полуширина интервала для count и time_sum. Оценка суммы по выборке, где каждая строка
+        попадает в нее с вероятностью p, имеет дисперсию (1 - p) / p**2 * сумма квадратов времен выборки, для count
+        все времена равны 1.
+    time_med_low, time_med_high, time_p90_low и т.д. - границы интервала для медианы и перцентилей, значения выборки с
+        рангами из get_quantile_interval_ranks."""
+    sampled_share = 1 / sample_step
+    for data in stat_data:
+        req_data = req_data_by_url[data['url']]
+        sampled_count = data['count']
+        data['count'] = sampled_count * sample_step
+        data['time_sum'] = round(data['time_sum'] * sample_step, 3)
+        data['count_err'] = int(round(Z_95 * math.sqrt(sampled_count * (1 - sampled_share)) / sampled_share))
+        data['time_sum_err'] = round(Z_95 * math.sqrt(req_data.get_time_sq_sum() * (1 - sampled_share)) /
+                                     sampled_share, 3)
+        for key, q in STAT_QUANTILES.items():
+            if key in data:
+                low, high = req_data.get_quantile_interval(q)
+                data[key + '_low'] = round(low, 3)
+                data[key + '_high'] = round(high, 3)
 
 
 def get_stat_data(log, report_size, **settings):
-    parsed_data, count_all_reqs, sum_time_all_reqs = analyze_log(log, **settings)
-    if not parsed_data:
+    aggregate = analyze_log(log, **settings)
+    if not aggregate:
         return None
-    stat_data = []
-    for url, data_obj in parsed_data.items():
-        # Приходится проходить цикл, чтобы пересчитать общие суммы и отфильтровать запросы на которых суммарно по
-        # времени не набирается порог
-        time_sum = sum(data_obj.time_list)
-        if time_sum < report_size:
-            count_all_reqs -= data_obj.count
-            sum_time_all_reqs -= time_sum
-            continue
-        data_obj.time_sum = time_sum
-        count = data_obj.count
-        time_list = data_obj.time_list
-        stat_data.append({
-            'url': url,
-            'count': count,
-            'time_sum': round(time_sum, 3),
-            'time_med': round(median(time_list), 3),
-            'time_avg': round(time_sum / count, 3),
-            'time_max': round(max(time_list), 3),
-        })
-    for data in stat_data:
-        count = data['count']
-        time_sum = data['time_sum']
-        data.update({
-            'count_perc': round(count * 100 / count_all_reqs, 2),
-            'time_perc': round(time_sum * 100 / sum_time_all_reqs, 2),
-        })
-    return stat_data
+    return get_aggregate_stat_data(aggregate, report_size)
@@ -0,0 +1,52 @@
+import logging
+import os
+import pickle
+
+from lib_errors import ErrorMessages
+
+
+class Checkpoint:
+    """Сохраняет накопленные по логу данные вместе с позицией в логе, до которой они посчитаны. Для gz позиция
+    считается в распакованных байтах. Если разбор прервался, следующий запуск продолжит с сохраненной позиции, а
+    если лог с тех пор дописали, то разберет только новые строки.
+    Вместе с данными сохраняется размер файла лога на диске: если файл стал меньше, его обрезали при ротации. Для gz
+    только так и можно заметить обрезку, позицию в распакованных байтах со сжатым размером сравнивать нельзя."""
+
+    def __init__(self, checkpoint_dir, log, settings_key, every_lines):
+        self.path = os.path.join(checkpoint_dir, os.path.basename(log.log_file_path) + '.checkpoint')
+        self.log_file_path = log.log_file_path
+        self.compressed = log.ext == '.gz'
+        # Данные, посчитанные с другими настройками, смешивать нельзя
+        self.settings_key = settings_key
+        self.every_lines = every_lines
+
+    def get_file_id(self):
+        stat = os.stat(self.log_file_path)
+        return stat.st_dev, stat.st_ino
+
+    def load(self):
+        """Возвращает сохраненный LogAggregate или None, если продолжать нечего"""
+        try:
+            with open(self.path, mode='rb') as checkpoint_file:
+                file_id, file_size, settings_key, aggregate = pickle.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            logging.error(ErrorMessages.checkpoint_broken.format(self.path))
+            return None
+        size = os.path.getsize(self.log_file_path)
+        if file_id != self.get_file_id() or settings_key != self.settings_key or size < file_size \
+                or not self.compressed and aggregate.offset > size:
+            # Лог подменили, обрезали при ротации или поменялись настройки, начинаем сначала
+            return None
+        logging.info('Resume parsing from the position {} of the log {}'.format(aggregate.offset, self.log_file_path))
+        return aggregate
+
+    def save(self, aggregate, offset):
+        aggregate.offset = offset
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='wb') as checkpoint_file:
+            pickle.dump((self.get_file_id(), os.path.getsize(self.log_file_path), self.settings_key, aggregate),
+                        checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        # Чтобы при падении посреди записи не остаться с битым checkpoint
+        os.replace(tmp_path, self.path)
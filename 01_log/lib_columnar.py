@@ -0,0 +1,77 @@
+import json
+import struct
+import sys
+from array import array
+
+# Формат файла с данными отчета по колонкам:
+#   4 байта - длина заголовка, little-endian uint32
+#   заголовок - json: число строк, имена колонок и смещения их данных от начала файла
+#   колонки чисел - float64 little-endian, каждая с границы 8 байт
+#   url - смещения uint32 (строк + 1 штука) и склеенные url в utf-8
+# Строки отсортированы по убыванию time_sum, поэтому первые N строк файла и есть топ отчета. Отчет в браузере
+# читает только нужные ему куски колонок без разбора большого json.
+HEADER_SIZE = struct.Struct('<I')
+ALIGN = 8
+
+
+def to_little_endian(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_columns(path, stat_data):
+    rows = sorted(stat_data, key=lambda row: row['time_sum'], reverse=True)
+    names = sorted(key for key in rows[0] if key != 'url') if rows else []
+    blocks = [to_little_endian(array('d', (row[name] for row in rows))) for name in names]
+    urls = [row['url'].encode('utf-8') for row in rows]
+    url_offsets = array('I', [0])
+    for url in urls:
+        url_offsets.append(url_offsets[-1] + len(url))
+    blocks.append(to_little_endian(url_offsets))
+    blocks.append(b''.join(urls))
+
+    # Заголовок нужен, чтобы посчитать смещения, а смещения входят в заголовок. Поэтому место под заголовок
+    # резервируется с запасом и дополняется пробелами.
+    header = {'rows': len(rows), 'columns': [], 'url_offsets': None, 'urls': None}
+    reserve = len(json.dumps(header)) + (len(names) + 2) * 64
+    offset = HEADER_SIZE.size + reserve
+    offsets = []
+    for block in blocks:
+        offset += -offset % ALIGN
+        offsets.append(offset)
+        offset += len(block)
+    header['columns'] = [{'name': name, 'offset': offsets[i]} for i, name in enumerate(names)]
+    header['url_offsets'] = offsets[-2]
+    header['urls'] = {'offset': offsets[-1], 'length': len(blocks[-1])}
+    header_bytes = json.dumps(header).encode('utf-8').ljust(reserve)
+
+    with open(path, mode='wb') as columns_file:
+        columns_file.write(HEADER_SIZE.pack(reserve))
+        columns_file.write(header_bytes)
+        position = HEADER_SIZE.size + reserve
+        for block_offset, block in zip(offsets, blocks):
+            columns_file.write(b'\0' * (block_offset - position))
+            columns_file.write(block)
+            position = block_offset + len(block)
+
+
+def read_columns(path):
+    """Читает файл, записанный write_columns, в словарь {колонка: список значений}"""
+    with open(path, mode='rb') as columns_file:
+        data = columns_file.read()
+    header_size, = HEADER_SIZE.unpack_from(data)
+    header = json.loads(data[HEADER_SIZE.size:HEADER_SIZE.size + header_size].decode('utf-8'))
+    rows = header['rows']
+    columns = {}
+    for column in header['columns']:
+        values = array('d', data[column['offset']:column['offset'] + rows * 8])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        columns[column['name']] = values.tolist()
+    url_offsets = array('I', data[header['url_offsets']:header['url_offsets'] + (rows + 1) * 4])
+    if sys.byteorder != 'little':
+        url_offsets.byteswap()
+    urls = data[header['urls']['offset']:header['urls']['offset'] + header['urls']['length']]
+    columns['url'] = [urls[url_offsets[i]:url_offsets[i + 1]].decode('utf-8') for i in range(rows)]
+    return columns
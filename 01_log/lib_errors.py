@@ -13,3 +13,15 @@ class ErrorMessages:
     probably_duplicate = 'There is already another file for the date "{}" has planned to parse. ' \
                          'Probably duplicate gz archive or plain log?'
     parsing_time_exceeded = 'Parsing time {} for the log "{}" exceeded. Going to the next one.'
+    unknown_aggregation_engine = 'Unknown aggregation engine "{}". Available engines: {}.'
+    unknown_line_parser = 'Unknown line parser "{}". Available parsers: {}.'
+    unknown_report_format = 'Unknown report format "{}". Available formats: {}.'
+    wrong_url_normalization_rule = 'Wrong url normalization rule {}. Rule has to be a pair of regex and replacement.'
+    numpy_not_installed = 'Aggregation engine "numpy" requires numpy to be installed.'
+    sampling_enabled = 'Parsing of the whole log is projected to take {:.0f}s, more than the time left for the log ' \
+                       '"{}". Only every {} line will be parsed.'
+    tail_log_path_not_set = 'Setting "tail_log_path" is required for the tail mode.'
+    logs_index_broken = 'Logs index "{}" is broken and will be rebuilt.'
+    checkpoint_broken = 'Checkpoint "{}" is broken and will be ignored.'
+    sketch_error_mismatch = 'Can\'t merge sketches with different relative errors {} and {}. ' \
+                            'Probably "sketch_relative_error" was changed.'
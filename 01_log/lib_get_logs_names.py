@@ -5,55 +5,91 @@ from collections import namedtuple
 from datetime import datetime
 
 from lib_errors import ErrorMessages, MyException
+from lib_logs_index import LogsIndex, get_report_name
 
-log_params = namedtuple('log_name', ('date_str', 'date', 'report_file_path', 'log_file_path', 'ext'))
+log_params = namedtuple('log_params', ('date_str', 'date', 'report_file_path', 'log_file_path', 'ext'))
 
 
-def check_result_log_name(result, nginx_logs_path, reports_path, existed_reports, report_name_template, **settings):
-    if not result:
-        return False
-    re_dict = result.groupdict()
-    date_str = re_dict['date']
-    try:
-        log_date = datetime.strptime(date_str, '%Y%m%d')
-    except ValueError:
-        logging.error(ErrorMessages.wrong_date_conversion.format(date_str, result.string))
-        return False
-    date_str_report = log_date.strftime('%Y.%m.%d')
-    report_name = report_name_template.format(date_str_report)
+def check_log_name(file_name, date_str, log_date, ext, nginx_logs_path, reports_path, existed_reports,
+                   report_name_template, **settings):
+    report_name = get_report_name(report_name_template, log_date)
     # Можно конечно проверять наличие файла через os.path.isfile, но так не будет системного вызова
     if report_name in existed_reports:
         # Значит уже существует отчет на лог с полученным именем
         return False
     report_file_path = os.path.join(reports_path, report_name)
-    nginx_file_path = os.path.join(nginx_logs_path, result.string)
-    return log_params(date_str, log_date, report_file_path, nginx_file_path, re_dict['ext'])
+    nginx_file_path = os.path.join(nginx_logs_path, file_name)
+    return log_params(date_str, log_date, report_file_path, nginx_file_path, ext)
 
 
-def get_fresh_log_to_parse(nginx_logs_dir, reports_dir, nginx_log_name_re, **settings):
-    max_date = None
-    logs_registry = {}
-    existed_reports = set(os.listdir(reports_dir))
+def iter_log_names(nginx_logs_dir, nginx_log_name_re):
+    """Отдает (имя файла, дата строкой, datetime, расширение) для всех логов в директории"""
     regex_name = re.compile(nginx_log_name_re, re.VERBOSE)
     for entry in os.scandir(nginx_logs_dir):
         if entry.is_dir():
             continue
         result = regex_name.match(entry.name)
-        result = check_result_log_name(result, nginx_logs_dir, reports_dir, existed_reports, **settings)
+        if not result:
+            continue
+        date_str = result.group('date')
+        try:
+            log_date = datetime.strptime(date_str, '%Y%m%d')
+        except ValueError:
+            logging.error(ErrorMessages.wrong_date_conversion.format(date_str, entry.name))
+            continue
+        yield entry.name, date_str, log_date, result.group('ext')
+
+
+def iter_indexed_log_names(logs_index):
+    """Как iter_log_names, но по индексу, где даты уже проверены, и только для логов без отчета"""
+    for file_name, info in logs_index.get_pending_logs().items():
+        date_str = info['date']
+        yield file_name, date_str, datetime(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:])), info['ext']
+
+
+def get_logs_registry(nginx_logs_dir, reports_dir, nginx_log_name_re, report_name_template, logs_index_path=None,
+                      **settings):
+    """Возвращает {дата: log_params} для логов, на которые еще нет отчета"""
+    logs_registry = {}
+    if logs_index_path:
+        logs_index = LogsIndex(logs_index_path, nginx_logs_dir, reports_dir, nginx_log_name_re, report_name_template)
+        log_names = iter_indexed_log_names(logs_index)
+        # Логи с отчетами индекс уже отбросил
+        existed_reports = ()
+    else:
+        logs_index = None
+        existed_reports = set(os.listdir(reports_dir))
+        log_names = iter_log_names(nginx_logs_dir, nginx_log_name_re)
+    for log_name in log_names:
+        result = check_log_name(*log_name, nginx_logs_dir, reports_dir, existed_reports, report_name_template,
+                                **settings)
         if not result:
             continue
         elif result.date in logs_registry:
             logging.error(ErrorMessages.probably_duplicate.format(result.date_str))
             continue
         logs_registry[result.date] = result
-        if not max_date or result.date > max_date:
-            max_date = result.date
-    return logs_registry.pop(max_date, None)
+    if logs_index:
+        logs_index.save()
+    return logs_registry
+
+
+def get_fresh_log_to_parse(**settings):
+    logs_registry = get_logs_registry(**settings)
+    if not logs_registry:
+        return None
+    return logs_registry[max(logs_registry)]
+
+
+def get_logs_to_parse(**settings):
+    """Все логи, на которые еще нет отчета, от старых к новым"""
+    logs_registry = get_logs_registry(**settings)
+    return [logs_registry[date] for date in sorted(logs_registry)]
 
 
 def validate_dirs(**settings):
     for key, directory in settings.items():
-        if not key.endswith('dir'):
+        if not key.endswith('dir') or directory is None:
             continue
         # Прогоняем через abspath, чтобы решить проблему с trailing slash
         abs_directory = os.path.abspath(directory)
@@ -0,0 +1,161 @@
+import io
+import os
+import queue
+import threading
+import time as sys_time
+import zlib
+
+# Сколько сжатых байт читается и распаковывается за раз
+GZIP_READ_BLOCK = 1024 * 1024
+# Сколько распакованных блоков может ждать разбора. Ограничивает память, если распаковка обгоняет разбор.
+GZIP_QUEUE_BLOCKS = 8
+# wbits для распаковки формата gzip с заголовком и контрольной суммой
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+
+class GzipReadError(EOFError):
+    """Битый или обрезанный gz архив. Наследует EOFError, как и ошибка gzip.open на обрезанном архиве, а не OSError,
+    чтобы не приниматься за проблему открытия файла: по части лога отчет строить нельзя."""
+
+
+def iter_gzip_blocks(file, block_size=GZIP_READ_BLOCK):
+    """Распаковывает открытый в байтах gz файл и отдает распакованные блоки. Файл может состоять из нескольких
+    склеенных gz архивов, как получается после cat или дописывания через gzip -c >>. Нулевые байты после архива
+    пропускаются, как в gzip.open."""
+    # None - предыдущий архив закончился, и следующий еще не начат
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    # Подавались ли данные в decompressor, пустой файл не ошибка
+    started = False
+    try:
+        while True:
+            data = file.read(block_size)
+            if not data:
+                break
+            while data:
+                if decompressor is None:
+                    data = data.lstrip(b'\x00')
+                    if not data:
+                        break
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                started = True
+                block = decompressor.decompress(data)
+                if block:
+                    yield block
+                if not decompressor.eof:
+                    break
+                data = decompressor.unused_data
+                decompressor = None
+    except zlib.error as exception:
+        raise GzipReadError('Broken gzip file: {}'.format(exception))
+    if started and decompressor is not None:
+        # Архив обрезан, например лог еще дописывается
+        raise GzipReadError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def iter_blocks_in_thread(blocks, max_blocks=GZIP_QUEUE_BLOCKS):
+    """Выполняет итератор blocks в отдельном потоке. zlib отпускает GIL на время распаковки, поэтому распаковка
+    идет параллельно с разбором строк в основном потоке."""
+    blocks_queue = queue.Queue(max_blocks)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # С таймаутом, чтобы поток завершился, если читатель бросил чтение и очередь никто не разбирает
+        while not stop.is_set():
+            try:
+                blocks_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put(block):
+                    return
+        except Exception as exception:
+            put(exception)
+            return
+        put(done)
+
+    thread = threading.Thread(target=produce, name='gzip-reader', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = blocks_queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def skip_bytes(blocks, count):
+    """Пропускает первые count байт потока блоков"""
+    for block in blocks:
+        if count >= len(block):
+            count -= len(block)
+            continue
+        yield block[count:] if count else block
+        count = 0
+
+
+def iter_block_lines(blocks):
+    """Режет блоки байт на строки. Строки с переводом строки в конце, кроме, может быть, последней."""
+    tail = b''
+    for block in blocks:
+        cut = block.rfind(b'\n') + 1
+        if not cut:
+            tail += block
+            continue
+        # BytesIO режет строки на C и быстрее split по b'\n' с последующей склейкой
+        yield from io.BytesIO(tail + block[:cut] if tail else block[:cut])
+        tail = block[cut:]
+    if tail:
+        yield tail
+
+
+class GzipLineReader:
+    """Читает строки gz лога в байтах. В отличие от gzip.open распаковывает большими блоками и, если threaded,
+    в отдельном потоке, а строки режет сразу по байтам без декодирования. По умолчанию поток используется, только если
+    у процесса есть больше одного ядра, иначе он только добавляет переключения.
+    offset - с какой позиции в распакованных байтах начать, должна приходиться на начало строки.
+    В decompress_seconds копится время чтения и распаковки. Замеряется каждый блок, а не строка, поэтому разбор строк
+    замеры не замедляют. С потоком распаковка идет параллельно с разбором и в общее время входит не целиком."""
+
+    def __init__(self, path, offset=0, threaded=None, block_size=GZIP_READ_BLOCK):
+        if threaded is None:
+            threaded = len(os.sched_getaffinity(0)) > 1 if hasattr(os, 'sched_getaffinity') else os.cpu_count() > 1
+        self.decompress_seconds = 0
+        self.file = open(path, mode='rb')
+        blocks = self.iter_timed(iter_gzip_blocks(self.file, block_size))
+        self.blocks = iter_blocks_in_thread(blocks) if threaded else blocks
+        self.lines = iter_block_lines(skip_bytes(self.blocks, offset) if offset else self.blocks)
+
+    def iter_timed(self, blocks):
+        while True:
+            started = sys_time.perf_counter()
+            block = next(blocks, None)
+            self.decompress_seconds += sys_time.perf_counter() - started
+            if block is None:
+                return
+            yield block
+
+    def __iter__(self):
+        return self.lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Сначала останавливаем поток распаковки, потом закрываем файл, который он читает
+        self.lines.close()
+        self.blocks.close()
+        self.file.close()
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import time as sys_time
+from datetime import datetime
+
+from lib_errors import ErrorMessages
+
+INDEX_VERSION = 2
+# mtime директории на NFS может быть грубым, и файл, созданный в ту же секунду, что и просмотр директории, может не
+# поменять его. Поэтому слишком свежий mtime не запоминается, и директория будет просмотрена еще раз.
+MTIME_SAFETY_SECONDS = 2
+
+
+def get_report_name(report_name_template, log_date):
+    return report_name_template.format(log_date.strftime('%Y.%m.%d'))
+
+
+class LogsIndex:
+    """Постоянный индекс директорий логов и отчетов. Для каждого файла логов хранит дату из имени, расширение, размер,
+    mtime, имя отчета и есть ли уже отчет, для отчетов - список имен, а еще отдельно список логов без отчетов.
+    Добавление и удаление файлов меняет mtime директории, поэтому если он не изменился, директория не читается совсем,
+    а если изменился, то regex, strptime и stat выполняются только для новых файлов. Появление и удаление отчетов
+    сравнивается со старым списком, и статус меняется только у затронутых логов. Поэтому выбор лога для разбора
+    стоит O(логов без отчета + новых файлов), а не O(всех файлов)."""
+
+    def __init__(self, path, nginx_logs_dir, reports_dir, nginx_log_name_re, report_name_template):
+        self.path = path
+        self.nginx_logs_dir = nginx_logs_dir
+        self.reports_dir = reports_dir
+        self.regex_name = re.compile(nginx_log_name_re, re.VERBOSE)
+        self.report_name_template = report_name_template
+        # Индекс, построенный для других директорий, regex или имен отчетов, не подходит
+        self.key = [os.path.abspath(nginx_logs_dir), os.path.abspath(reports_dir), nginx_log_name_re,
+                    report_name_template]
+        self.data = self.load()
+        self.changed = False
+
+    def get_empty(self):
+        return {
+            'version': INDEX_VERSION,
+            'key': self.key,
+            'logs_mtime': None,
+            # имя файла -> {'date': 'YYYYMMDD', 'ext', 'size', 'mtime', 'report_name', 'report'}, date None - не лог
+            'logs': {},
+            # имена логов, на которые нет отчета
+            'pending': [],
+            'reports_mtime': None,
+            'reports': [],
+        }
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as index_file:
+                data = json.load(index_file)
+        except FileNotFoundError:
+            return self.get_empty()
+        except (OSError, ValueError):
+            logging.error(ErrorMessages.logs_index_broken.format(self.path))
+            return self.get_empty()
+        if not isinstance(data, dict) or data.get('version') != INDEX_VERSION or data.get('key') != self.key:
+            return self.get_empty()
+        return data
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as index_file:
+            json.dump(self.data, index_file, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.changed = False
+
+    @staticmethod
+    def get_dir_mtime(directory):
+        """mtime директории или None, если он слишком свежий, чтобы ему доверять"""
+        mtime = os.stat(directory).st_mtime_ns
+        if sys_time.time() - mtime / 1e9 < MTIME_SAFETY_SECONDS:
+            return None
+        return mtime
+
+    def is_fresh(self, directory, mtime_key):
+        mtime = self.data[mtime_key]
+        return mtime is not None and mtime == os.stat(directory).st_mtime_ns
+
+    def get_log_info(self, entry, reports):
+        if entry.is_dir():
+            return {'date': None}
+        result = self.regex_name.match(entry.name)
+        if not result:
+            return {'date': None}
+        date_str = result.group('date')
+        try:
+            log_date = datetime.strptime(date_str, '%Y%m%d')
+        except ValueError:
+            logging.error(ErrorMessages.wrong_date_conversion.format(date_str, entry.name))
+            return {'date': None}
+        stat = entry.stat()
+        report_name = get_report_name(self.report_name_template, log_date)
+        return {'date': date_str, 'ext': result.group('ext'), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'report_name': report_name, 'report': report_name in reports}
+
+    def update_reports(self):
+        """Перечитывает директорию отчетов, если она менялась, и меняет статус логов, чьи отчеты появились или
+        пропали"""
+        if self.is_fresh(self.reports_dir, 'reports_mtime'):
+            return
+        mtime = self.get_dir_mtime(self.reports_dir)
+        old_reports = set(self.data['reports'])
+        reports = set(os.listdir(self.reports_dir))
+        logs = self.data['logs']
+        added = reports - old_reports
+        pending = []
+        for name in self.data['pending']:
+            if logs[name]['report_name'] in added:
+                logs[name]['report'] = True
+            else:
+                pending.append(name)
+        removed = old_reports - reports
+        if removed:
+            # Отчеты удаляют редко, поэтому тут можно пройти по всем логам
+            for name, info in logs.items():
+                if info['date'] and info['report'] and info['report_name'] in removed:
+                    info['report'] = False
+                    pending.append(name)
+        self.data['pending'] = sorted(pending)
+        self.data['reports'] = sorted(reports)
+        self.data['reports_mtime'] = mtime
+        self.changed = True
+
+    def update_logs(self):
+        """Перечитывает директорию логов, если она менялась. Разбираются только новые имена."""
+        if self.is_fresh(self.nginx_logs_dir, 'logs_mtime'):
+            return
+        # mtime берется до чтения директории: если файл добавят во время чтения, в следующий раз mtime не совпадет
+        mtime = self.get_dir_mtime(self.nginx_logs_dir)
+        reports = set(self.data['reports'])
+        old_logs = self.data['logs']
+        logs = {}
+        pending = set(self.data['pending'])
+        for entry in os.scandir(self.nginx_logs_dir):
+            info = old_logs.get(entry.name)
+            if info is None:
+                info = self.get_log_info(entry, reports)
+                if info['date'] and not info['report']:
+                    pending.add(entry.name)
+            logs[entry.name] = info
+        self.data['logs'] = logs
+        self.data['pending'] = sorted(name for name in pending if name in logs)
+        self.data['logs_mtime'] = mtime
+        self.changed = True
+
+    def refresh_log(self, name):
+        """Перепроверяет размер и mtime лога: его могли дописать или подменить при ротации. Возвращает False, если
+        файла уже нет."""
+        info = self.data['logs'][name]
+        try:
+            stat = os.stat(os.path.join(self.nginx_logs_dir, name))
+        except FileNotFoundError:
+            return False
+        if (info['size'], info['mtime']) != (stat.st_size, stat.st_mtime):
+            info.update(size=stat.st_size, mtime=stat.st_mtime)
+            self.changed = True
+        return True
+
+    def get_pending_logs(self):
+        """Возвращает {имя файла: данные} для логов, на которые еще нет отчета"""
+        # Сначала отчеты, чтобы новые логи получили статус по текущему списку отчетов
+        self.update_reports()
+        self.update_logs()
+        return {name: self.data['logs'][name] for name in self.data['pending'] if self.refresh_log(name)}
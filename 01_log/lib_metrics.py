@@ -0,0 +1,112 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import time as sys_time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Нет на windows, тогда пиковую память не показываем
+    resource = None
+
+# Сколько функций из профиля писать в лог
+PROFILE_TOP_FUNCTIONS = 30
+
+
+def get_peak_rss_mb():
+    """Пиковая память текущего процесса и самого прожорливого из завершенных дочерних, в мегабайтах"""
+    if resource is None:
+        return None
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # На macOS ru_maxrss в байтах, на linux в килобайтах
+    return round(peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class RunMetrics:
+    """Время по этапам и счетчики одного запуска. Этапы крупные (разбор лога, подсчет статистики, запись отчета),
+    чтобы замеры не замедляли разбор строк. Внутри разбора отдельно известно только время распаковки gz (decompress),
+    оно замеряется по блокам в GzipLineReader. Как остальное время разбора делится между regex и подсчетом,
+    показывает --profile."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = sys_time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, sys_time.perf_counter() - started)
+
+    def add_stage_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """Добавляет метрики, посчитанные в другом процессе"""
+        for name, value in other.stages.items():
+            self.add_stage_time(name, value)
+        for name, value in other.counters.items():
+            self.add(name, value)
+
+    def add_aggregate(self, aggregate, log_size):
+        self.add('logs')
+        self.add('bytes', log_size)
+        self.add('parsed_lines', aggregate.parsed_count)
+        self.add('unmatched_lines', aggregate.unparsed_count)
+        if aggregate.decompress_seconds:
+            # Часть этапа analyze
+            self.add_stage_time('decompress', aggregate.decompress_seconds)
+
+    def as_dict(self):
+        analyze_time = self.stages.get('analyze')
+        lines = self.counters.get('parsed_lines', 0) + self.counters.get('unmatched_lines', 0)
+        metrics = {
+            'stages': {name: round(value, 3) for name, value in self.stages.items()},
+            'counters': dict(self.counters),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }
+        if analyze_time:
+            metrics['lines_per_sec'] = round(lines / analyze_time, 1)
+            metrics['bytes_per_sec'] = round(self.counters.get('bytes', 0) / analyze_time, 1)
+        return metrics
+
+    def log(self):
+        metrics = self.as_dict()
+        for name, value in metrics['stages'].items():
+            logging.info('Stage {}: {}s'.format(name, value))
+        for name, value in metrics['counters'].items():
+            logging.info('Counter {}: {}'.format(name, value))
+        if 'lines_per_sec' in metrics:
+            logging.info('Throughput: {} lines/sec, {} bytes/sec'.format(metrics['lines_per_sec'],
+                                                                         metrics['bytes_per_sec']))
+        if metrics['peak_rss_mb'] is not None:
+            logging.info('Peak RSS: {} MB'.format(metrics['peak_rss_mb']))
+
+    def write_json(self, path):
+        with open(path, mode='w', encoding='utf-8') as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2, sort_keys=True)
+
+
+def run_profiled(profile_path, func, *args, **kwargs):
+    """Выполняет func под cProfile, сохраняет статистику в profile_path для pstats/snakeviz и пишет в лог самые
+    дорогие функции. Профилируется только текущий процесс, дочерние процессы workers в статистику не попадают."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        logging.info('Profile saved to {}:\n{}'.format(profile_path, stream.getvalue()))
@@ -0,0 +1,71 @@
+import os
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+# Сколько строк gz лога отдается одному процессу за раз
+GZIP_BATCH_LINES = 50000
+# Максимальный размер куска plain лога. Мелкие куски равномернее распределяются по процессам и чаще дают сохранить
+# checkpoint.
+PLAIN_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_complete_lines_end(file_path, block_size=65536):
+    """Возвращает позицию сразу за последним переводом строки. Хвост после нее может быть недописанной строкой."""
+    size = os.path.getsize(file_path)
+    with open(file_path, mode='rb') as file:
+        position = size
+        while position > 0:
+            start = max(position - block_size, 0)
+            file.seek(start)
+            index = file.read(position - start).rfind(b'\n')
+            if index != -1:
+                return start + index + 1
+            position = start
+    return 0
+
+
+def split_to_ranges(file_path, parts, start=0, end=None, max_chunk_size=PLAIN_CHUNK_BYTES):
+    """Делит файл на куски (start, end) по байтам, не меньше parts штук и не больше max_chunk_size каждый. Границы
+    кусков выровнены по концу строки, чтобы ни одна строка не оказалась разрезанной между двумя процессами."""
+    end = os.path.getsize(file_path) if end is None else end
+    if start >= end:
+        return []
+    step = min(max((end - start) // parts, 1), max_chunk_size)
+    ranges = []
+    with open(file_path, mode='rb') as file:
+        begin = start
+        while begin < end:
+            file.seek(min(begin + step, end))
+            # Дочитываем строку, на которую попала граница, до конца
+            file.readline()
+            chunk_end = min(file.tell(), end)
+            ranges.append((begin, chunk_end))
+            begin = chunk_end
+    return ranges
+
+
+def iter_line_batches(file, batch_size=GZIP_BATCH_LINES):
+    """Нарезает открытый файл на списки строк. Используется для gz, где нельзя прыгнуть на середину файла без
+    распаковки всего, что перед ней, поэтому распаковка остается в основном процессе."""
+    while True:
+        batch = list(islice(file, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def imap_ordered(func, tasks, workers):
+    """Выполняет func над tasks в пуле процессов и отдает результаты в порядке tasks. Порядок важен, чтобы после
+    слияния url в отчете шли так же, как при однопоточном разборе."""
+    # pool.imap вычитывает tasks целиком в очередь, а для многогигабайтного gz это весь лог в памяти, поэтому держим
+    # в работе не больше двух задач на процесс.
+    pending = deque()
+    with Pool(processes=workers) as pool:
+        # Пул закроется через terminate при выходе из with, даже если результаты дочитаны не до конца
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
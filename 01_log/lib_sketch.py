@@ -0,0 +1,60 @@
+import math
+
+from lib_errors import ErrorMessages, MyException
+
+# Значения меньше этого считаются нулем, в логе время приезжает с точностью до миллисекунды
+MIN_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """Скетч квантилей с гарантированной относительной ошибкой (по мотивам DDSketch). Значения раскладываются по
+    корзинам с логарифмическими границами gamma**(i-1) < x <= gamma**i, поэтому память зависит от разброса значений,
+    а не от их количества. Скетчи можно сливать друг с другом без потери точности."""
+
+    def __init__(self, relative_error=0.01, max_bins=2048):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value < MIN_VALUE:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise MyException(ErrorMessages.sketch_error_mismatch.format(self.relative_error, other.relative_error))
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        # Жертвуем точностью самых маленьких значений, для отчета важны медленные запросы
+        first, second = sorted(self.bins)[:2]
+        self.bins[second] += self.bins.pop(first)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for key in sorted(self.bins):
+            cumulative += self.bins[key]
+            if cumulative > rank:
+                # Середина корзины в смысле относительной ошибки
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
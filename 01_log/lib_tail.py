@@ -0,0 +1,175 @@
+import io
+import json
+import logging
+import os
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Как часто проверять, не дописан ли лог
+TAIL_POLL_SECONDS = 1
+# Сколько байт лога читается за раз. Если прочитано столько, то в логе, скорее всего, есть еще, и читаем сразу снова.
+TAIL_READ_BYTES = 16 * 1024 * 1024
+
+
+class LogFollower:
+    """Читает дописываемый nginx лог, как tail -F. Ротацию замечает по смене файла на том же пути (logrotate с create)
+    или по уменьшению размера (copytruncate). Перед переходом на новый файл дочитывает старый."""
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self.file = None
+        self.file_id = None
+        # Недописанная последняя строка, ждет продолжения
+        self.partial_line = b''
+        self.open(from_start)
+
+    def open(self, from_start=True):
+        try:
+            self.file = open(self.path, mode='rb')
+        except FileNotFoundError:
+            # Старый лог уже переименован, а новый еще не создан
+            self.file = None
+            return
+        stat = os.fstat(self.file.fileno())
+        self.file_id = stat.st_dev, stat.st_ino
+        self.partial_line = b''
+        if not from_start:
+            self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def read_available(self):
+        """Возвращает (полные строки, прочитан ли предел TAIL_READ_BYTES)"""
+        chunk = self.file.read(TAIL_READ_BYTES)
+        if not chunk:
+            return [], False
+        data = self.partial_line + chunk
+        cut = data.rfind(b'\n') + 1
+        self.partial_line = data[cut:]
+        return io.BytesIO(data[:cut]).readlines(), len(chunk) == TAIL_READ_BYTES
+
+    def read_lines(self):
+        """Возвращает (новые полные строки лога, есть ли еще непрочитанное)"""
+        if self.file is None:
+            self.open()
+            if self.file is None:
+                return [], False
+        lines, more = self.read_available()
+        if more:
+            return lines, True
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return lines, False
+        if (stat.st_dev, stat.st_ino) != self.file_id:
+            logging.info('Log {} is rotated, switch to the new file.'.format(self.path))
+            # Дочитываем старый файл: nginx мог писать в него до переоткрытия логов
+            while True:
+                rest, more = self.read_available()
+                lines.extend(rest)
+                if not more:
+                    break
+            self.close()
+            self.open()
+            return lines, True
+        if stat.st_size < self.file.tell():
+            logging.info('Log {} is truncated, read it from the start.'.format(self.path))
+            self.file.seek(0)
+            self.partial_line = b''
+            return lines, True
+        return lines, False
+
+
+class SlidingWindow:
+    """Агрегаты по url за последние max_window секунд. Время делится на корзины по bucket_seconds, у каждой свой
+    LogAggregate, а устаревшие корзины выбрасываются целиком, поэтому память ограничена числом корзин."""
+
+    def __init__(self, aggregate_factory, bucket_seconds, max_window):
+        self.aggregate_factory = aggregate_factory
+        self.bucket_seconds = bucket_seconds
+        self.max_window = max_window
+        # (начало корзины, LogAggregate), по возрастанию времени
+        self.buckets = deque()
+
+    def get_bucket(self, now):
+        """Возвращает LogAggregate корзины, в которую попадает момент now"""
+        start = now - now % self.bucket_seconds
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append((start, self.aggregate_factory()))
+        self.expire(now)
+        return self.buckets[-1][1]
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] + self.bucket_seconds <= now - self.max_window:
+            self.buckets.popleft()
+
+    def get_aggregate(self, now, window):
+        """Сливает корзины, пересекающиеся с последними window секундами"""
+        self.expire(now)
+        aggregate = self.aggregate_factory()
+        for start, bucket in self.buckets:
+            if start + self.bucket_seconds > now - window:
+                aggregate.merge(bucket)
+        return aggregate
+
+
+def get_window_name(seconds):
+    """300 -> 5m, 3600 -> 1h"""
+    if seconds % 3600 == 0:
+        return '{}h'.format(seconds // 3600)
+    if seconds % 60 == 0:
+        return '{}m'.format(seconds // 60)
+    return '{}s'.format(seconds)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer есть только с python 3.7"""
+    daemon_threads = True
+
+
+class LiveReports:
+    """Последние данные отчетов по окнам в json для http сервера. Сервер работает в отдельном потоке."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = {}
+
+    def update(self, name, stat_data):
+        data = json.dumps(stat_data, sort_keys=True).encode('utf-8')
+        with self.lock:
+            self.reports[name] = data
+
+    def get(self, name):
+        with self.lock:
+            return self.reports.get(name)
+
+    def serve(self, port, host='127.0.0.1'):
+        """По умолчанию сервер доступен только с этой машины, host '' или '0.0.0.0' открывает его на всех
+        интерфейсах"""
+        live_reports = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # /live-5m.json -> live-5m
+                data = live_reports.get(self.path.strip('/').rsplit('.json', 1)[0])
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='live-reports', daemon=True).start()
+        logging.info('Serve live reports on {}:{}.'.format(*server.server_address[:2]))
+        return server
@@ -0,0 +1,46 @@
+import re
+
+from lib_errors import ErrorMessages, MyException
+
+# Ключ, в который сливаются url, не попавшие под ограничение max_distinct_urls
+OTHER_URL = 'other'
+# Число в сегменте пути или в значении параметра: /api/v2/banner/25769978, ?id=6761497&page=2
+NUMERIC_SEGMENT_RE = re.compile(r'(?<=[/=])\d+(?=[/?&;#]|$)')
+NUMERIC_SEGMENT_PLACEHOLDER = '{id}'
+
+
+class UrlNormalizer:
+    """Приводит url к шаблону до подсчета, чтобы запросы к одному обработчику с разными id считались вместе.
+    Правила - пары (regex, замена) в синтаксисе re.sub, применяются по порядку, после них числовые сегменты
+    заменяются на {id}, если включен collapse_numeric_segments."""
+
+    def __init__(self, rules=(), collapse_numeric_segments=False):
+        self.rules = []
+        for rule in rules:
+            try:
+                pattern, replacement = rule
+                self.rules.append((re.compile(pattern), replacement))
+            except (TypeError, ValueError, re.error):
+                raise MyException(ErrorMessages.wrong_url_normalization_rule.format(rule))
+        self.collapse_numeric_segments = collapse_numeric_segments
+
+    def __call__(self, url):
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+        if self.collapse_numeric_segments:
+            url = NUMERIC_SEGMENT_RE.sub(NUMERIC_SEGMENT_PLACEHOLDER, url)
+        return url
+
+
+def get_url_normalizer(url_normalization_rules=None, collapse_numeric_segments=False, **settings):
+    """Возвращает UrlNormalizer или None, если нормализация не настроена"""
+    if not url_normalization_rules and not collapse_numeric_segments:
+        return None
+    return UrlNormalizer(url_normalization_rules or (), collapse_numeric_segments)
+
+
+def normalize_analyzed_line(line, line_analyzer, url_normalizer):
+    url, time, unparsed_line = line_analyzer(line)
+    if url:
+        url = url_normalizer(url)
+    return url, time, unparsed_line
@@ -4,14 +4,21 @@
 import argparse
 import json
 import logging
+import math
 import os
+import time as sys_time
 from string import Template
 
 import yaml
 
-from lib_analyze import get_stat_data
-from lib_errors import MyException
-from lib_get_logs_names import get_fresh_log_to_parse, validate_dirs
+from lib_aggregates import (get_day_aggregate_path, get_day_aggregates, get_rollups, merge_day_aggregates,
+                            save_day_aggregate, to_day_aggregate, ROLLUP_PERIODS)
+from lib_analyze import analyze_lines, analyze_log, get_aggregate_factory, get_aggregate_stat_data, get_line_analyzer
+from lib_columnar import write_columns
+from lib_errors import ErrorMessages, MyException
+from lib_get_logs_names import get_fresh_log_to_parse, get_logs_to_parse, validate_dirs
+from lib_metrics import RunMetrics, run_profiled
+from lib_parallel import imap_ordered
 
 logging_settings = dict(
     format='[%(asctime)s] %(levelname).1s %(message)s',
@@ -27,6 +34,52 @@ DEFAULT_SETTINGS = {
     "parse_success_threshold_percent": 100,
     "max_time_parsing_for_log": 600,
     "report_name_template": "report-{}.html",
+    # Число процессов для разбора лога, при 1 лог разбирается в текущем процессе
+    "workers": 1,
+    # exact - хранит все времена запросов, sketch - считает медиану и перцентили приблизительно в ограниченной памяти,
+    # numpy - хранит времена в плоском массиве и считает статистику векторно через numpy
+    "aggregation_engine": "exact",
+    # Относительная ошибка квантилей для aggregation_engine: sketch
+    "sketch_relative_error": 0.01,
+    # regex - разбор строки через nginx_line_log_re, fast - быстрый разбор формата по умолчанию с откатом на regex,
+    # mmap - nginx_line_log_re применяется прямо к отображенному в память plain логу без копирования строк
+    "line_parser": "regex",
+    # Файл индекса директорий логов и отчетов, чтобы не просматривать их целиком на каждом запуске. None - без индекса.
+    "logs_index_path": None,
+    # Куда сохранять промежуточные результаты разбора, чтобы продолжить прерванный разбор. None - не сохранять.
+    "checkpoint_dir": None,
+    "checkpoint_every_lines": 1000000,
+    # Сохранять ли рядом с отчетом сжатый агрегат за день, из которого потом строятся отчеты за неделю и месяц. В режиме
+    # --backfill сохраняется всегда.
+    "save_day_aggregates": False,
+    "aggregate_name_template": "aggregate-{}.pickle.gz",
+    # inline - данные отчета вшиты в html как json. columnar - данные лежат рядом с отчетом в бинарном файле по
+    # колонкам, а отчет подгружает его и показывает постранично.
+    "report_format": "inline",
+    # Если по скорости разбора первых sampling_probe_mb мегабайт лог не успевает разобраться за
+    # max_time_parsing_for_log, то разбирается только случайная выборка строк. Работает при workers: 1 и без
+    # checkpoint_dir.
+    "time_budget_sampling": False,
+    "sampling_probe_mb": 64,
+    # Пары [regex, замена] в синтаксисе re.sub, которыми url приводится к шаблону до подсчета
+    "url_normalization_rules": [],
+    # Заменять числовые сегменты url и значения параметров на {id}: /api/v2/banner/25769978 -> /api/v2/banner/{id}
+    "collapse_numeric_segments": False,
+    # Сколько разных url хранить. Когда их становится больше, самые редкие сливаются в url "other". None - без
+    # ограничения. Память ограничивается только с aggregation_engine sketch, exact и numpy хранят время каждого запроса.
+    "max_distinct_urls": None,
+    # Куда сохранить время по этапам и счетчики запуска в json. None - только в лог.
+    "metrics_file": None,
+    # Режим --tail: дописываемый лог, за которым следить, окна отчетов в секундах, размер корзины окна, как часто
+    # обновлять отчеты и порог time_sum для них. tail_http_port - порт, на котором отдавать данные отчетов в json,
+    # tail_http_host - адрес, на котором его слушать. По умолчанию только локальный, "" - все интерфейсы.
+    "tail_log_path": None,
+    "tail_windows": [300, 3600],
+    "tail_bucket_seconds": 10,
+    "tail_report_interval": 30,
+    "tail_report_size": 0,
+    "tail_http_port": None,
+    "tail_http_host": "127.0.0.1",
     "nginx_log_name_re": r"""
         ^nginx-access-ui.log-       # обязательный префикс
         (?P<date>\d{8})             # дата, ровно 8 цифр подряд
@@ -55,7 +108,12 @@ DEFAULT_SETTINGS = {
 }
 
 DEFAULT_CONFIG_PATH = "./config.yml"
+DEFAULT_PROFILE_PATH = "./log_analyzer.prof"
 REPORT_TEMPLATE_PATH = './report.html'
+REPORT_TEMPLATE_PATHS = {
+    'inline': REPORT_TEMPLATE_PATH,
+    'columnar': './report_columnar.html',
+}
 
 
 def get_settings_from_config(config_path):
@@ -82,35 +140,195 @@ def get_template(path):
         return Template(report_template_file.read())
 
 
-def parse_log(log, report_template, **kwargs):
-    logging.info('Begin parsing the log file:\n' + log.log_file_path)
-    stat_data = get_stat_data(log, **kwargs)
-    if not stat_data:
-        return False
-    report = report_template.safe_substitute(table_json=json.dumps(stat_data, sort_keys=True))
+def get_report_template(report_format):
+    if report_format not in REPORT_TEMPLATE_PATHS:
+        raise MyException(ErrorMessages.unknown_report_format.format(report_format, ', '.join(REPORT_TEMPLATE_PATHS)))
+    return get_template(REPORT_TEMPLATE_PATHS[report_format])
+
+
+def write_report(report_file_path, stat_data, report_template, report_format='inline'):
+    if report_format == 'columnar':
+        # Данные отчета кладем рядом с ним: report-2017.06.30.html -> report-2017.06.30.cols
+        data_file_path = os.path.splitext(report_file_path)[0] + '.cols'
+        write_columns(data_file_path, stat_data)
+        report = report_template.safe_substitute(data_url=os.path.basename(data_file_path))
+    else:
+        report = report_template.safe_substitute(table_json=json.dumps(stat_data, sort_keys=True))
     try:
-        with open(log.report_file_path, mode='w', encoding='utf-8') as report_file:
+        with open(report_file_path, mode='w', encoding='utf-8') as report_file:
             report_file.write(report)
     except Exception as exception:
         logging.error('Something going wrong with report creation. Trying to remove report '
-                      'file:\n' + log.report_file_path)
-        os.remove(log.report_file_path)
+                      'file:\n' + report_file_path)
+        os.remove(report_file_path)
         raise exception
+
+
+def parse_log(log, report_template, report_size, save_day_aggregates=False, report_format='inline', metrics=None,
+              **kwargs):
+    metrics = metrics or RunMetrics()
+    logging.info('Begin parsing the log file:\n' + log.log_file_path)
+    with metrics.stage('analyze'):
+        aggregate = analyze_log(log, **kwargs)
+    if not aggregate:
+        return False
+    metrics.add_aggregate(aggregate, os.path.getsize(log.log_file_path))
+    with metrics.stage('stat'):
+        stat_data = get_aggregate_stat_data(aggregate, report_size)
+    if not stat_data:
+        return False
+    metrics.add('report_rows', len(stat_data))
+    if save_day_aggregates and aggregate.sample_step > 1:
+        logging.warning('The log {} was parsed by sample, day aggregate is not saved.'.format(log.log_file_path))
+    elif save_day_aggregates:
+        aggregate_path = get_day_aggregate_path(kwargs['reports_dir'], kwargs['aggregate_name_template'], log.date)
+        with metrics.stage('day_aggregate'):
+            save_day_aggregate(to_day_aggregate(aggregate, kwargs['sketch_relative_error']), aggregate_path)
+    with metrics.stage('report'):
+        write_report(log.report_file_path, stat_data, report_template, report_format)
     return True
 
 
+def parse_log_task(task):
+    """Выполняется в дочернем процессе, поэтому метрики возвращаются вместе с результатом"""
+    log, report_template, settings = task
+    metrics = RunMetrics()
+    return parse_log(log, report_template, metrics=metrics, **settings), metrics
+
+
+def backfill(logs, report_template, workers, metrics=None, **settings):
+    """Разбирает все логи без отчетов, по логу на процесс, и сохраняет дневные агрегаты для отчетов за период"""
+    # Каждый лог разбирается в одном процессе, вложенные пулы процессов не поддерживаются
+    settings.update(workers=1, save_day_aggregates=True)
+    tasks = ((log, report_template, settings) for log in logs)
+    for log, (parsed, log_metrics) in zip(logs, imap_ordered(parse_log_task, tasks, workers)):
+        if metrics:
+            metrics.merge(log_metrics)
+        if not parsed:
+            logging.error('Report for the log {} is not created.'.format(log.log_file_path))
+
+
+def make_rollup_reports(period, report_template, reports_dir, report_name_template, aggregate_name_template,
+                        report_size, report_format='inline', metrics=None, **settings):
+    """Строит отчеты за неделю или месяц, сливая сохраненные дневные агрегаты, без повторного разбора логов"""
+    metrics = metrics or RunMetrics()
+    day_aggregates = get_day_aggregates(reports_dir, aggregate_name_template)
+    for period_name, paths in get_rollups(day_aggregates, period).items():
+        logging.info('Create {} report from {} day aggregates.'.format(period_name, len(paths)))
+        with metrics.stage('rollup'):
+            stat_data = get_aggregate_stat_data(merge_day_aggregates(paths), report_size)
+        report_file_path = os.path.join(reports_dir, report_name_template.format(period_name))
+        with metrics.stage('report'):
+            write_report(report_file_path, stat_data, report_template, report_format)
+
+
+def write_live_reports(window, now, tail_windows, report_template, reports_dir, report_name_template,
+                       tail_report_size, report_format='inline', live_reports=None, **settings):
+    from lib_tail import get_window_name
+    for seconds in tail_windows:
+        name = 'live-' + get_window_name(seconds)
+        stat_data = get_aggregate_stat_data(window.get_aggregate(now, seconds), tail_report_size)
+        write_report(os.path.join(reports_dir, report_name_template.format(name)), stat_data, report_template,
+                     report_format)
+        if live_reports:
+            live_reports.update(name, stat_data)
+
+
+def tail(report_template, tail_log_path=None, tail_windows=(300, 3600), tail_bucket_seconds=10,
+         tail_report_interval=30, tail_http_port=None, tail_http_host='127.0.0.1', sketch_relative_error=0.01,
+         max_distinct_urls=None, **settings):
+    """Следит за дописываемым логом и раз в tail_report_interval секунд перестраивает отчеты за последние
+    tail_windows секунд (report-live-5m.html и т.д.). Времена по url копятся в скетчах, а url ограничены
+    max_distinct_urls, чтобы память демона не росла."""
+    if not tail_log_path:
+        raise MyException(ErrorMessages.tail_log_path_not_set)
+    # lib_tail нужен только демону, пакетный режим не должен зависеть от http сервера
+    from lib_tail import TAIL_POLL_SECONDS, LiveReports, LogFollower, SlidingWindow
+    line_analyzer, binary = get_line_analyzer(**settings)
+    aggregate_factory = get_aggregate_factory('sketch', sketch_relative_error, max_distinct_urls)
+    window = SlidingWindow(aggregate_factory, tail_bucket_seconds, max(tail_windows))
+    follower = LogFollower(tail_log_path)
+    live_reports = None
+    if tail_http_port is not None:
+        live_reports = LiveReports()
+        live_reports.serve(tail_http_port, tail_http_host)
+    logging.info('Tail the log {}.'.format(tail_log_path))
+    next_report = sys_time.time() + tail_report_interval
+    try:
+        while True:
+            lines, more = follower.read_lines()
+            now = sys_time.time()
+            if lines:
+                # Битая кодировка в одной строке не должна останавливать демон
+                analyzed_lines = (line_analyzer(line if binary else line.decode('utf-8', errors='replace'))
+                                  for line in lines)
+                analyze_lines(analyzed_lines, window.get_bucket(now), math.inf)
+            if now >= next_report:
+                write_live_reports(window, now, tail_windows, report_template, live_reports=live_reports, **settings)
+                next_report = now + tail_report_interval
+            if not more:
+                sys_time.sleep(TAIL_POLL_SECONDS)
+    except KeyboardInterrupt:
+        logging.info('Tail stopped.')
+    finally:
+        follower.close()
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Create reports from nginx logs.')
     parser.add_argument('-c', '--config', nargs='?', const=DEFAULT_CONFIG_PATH, default='',
                         help='path to config or empty, then default path "./config" relative to script '
                              'location will be used')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of processes to parse the log, overrides "workers" from config')
+    parser.add_argument('--backfill', action='store_true',
+                        help='parse all logs without reports, "workers" logs at a time, and save day aggregates')
+    parser.add_argument('--rollup', choices=sorted(ROLLUP_PERIODS),
+                        help='create reports for every week or month from saved day aggregates')
+    parser.add_argument('--tail', action='store_true',
+                        help='follow "tail_log_path" and periodically rebuild reports for the last "tail_windows"')
+    parser.add_argument('--profile', nargs='?', const=DEFAULT_PROFILE_PATH, default=None,
+                        help='run under cProfile and save stats to the path, by default "{}". Worker processes are '
+                             'not profiled.'.format(DEFAULT_PROFILE_PATH))
     return parser.parse_args()
 
 
+def run(settings, report_template, backfill_mode=False, rollup=None, metrics=None, tail_mode=False):
+    if tail_mode:
+        tail(report_template, **settings)
+        return
+    if backfill_mode:
+        logs = get_logs_to_parse(**settings)
+        if logs:
+            backfill(logs, report_template, metrics=metrics, **settings)
+        else:
+            logging.info('No new log find to parse.')
+    else:
+        fresh_log = get_fresh_log_to_parse(**settings)
+        if fresh_log:
+            parse_log(fresh_log, report_template, metrics=metrics, **settings)
+        else:
+            logging.info('No new log find to parse.')
+
+    if rollup:
+        make_rollup_reports(rollup, report_template, metrics=metrics, **settings)
+
+
 def main(do_parse_args=True):
     config_path = False
+    workers = None
+    backfill_mode = False
+    rollup = None
+    profile_path = None
+    tail_mode = False
     if do_parse_args:
-        config_path = parse_args().config
+        args = parse_args()
+        config_path = args.config
+        workers = args.workers
+        backfill_mode = args.backfill
+        rollup = args.rollup
+        profile_path = args.profile
+        tail_mode = args.tail
     settings = DEFAULT_SETTINGS.copy()
     if config_path == DEFAULT_CONFIG_PATH:
         logging.info('Used default config path "{}"'.format(DEFAULT_CONFIG_PATH))
@@ -118,19 +336,25 @@ def main(do_parse_args=True):
         settings_from_config = get_settings_from_config(config_path)
         settings.update(settings_from_config)
         logging.info('Successfully update settings from config {}'.format(config_path))
+    if workers:
+        settings["workers"] = workers
 
     # С этого момента начинаем выводить лог в файл, если задано в настройках
     reset_logger(settings["analyzer_log_file"])
 
-    report_template = get_template(REPORT_TEMPLATE_PATH)
+    report_template = get_report_template(settings["report_format"])
 
     validate_dirs(**settings)
 
-    fresh_log = get_fresh_log_to_parse(**settings)
-    if fresh_log:
-        parse_log(fresh_log, report_template, **settings)
+    metrics = RunMetrics()
+    if profile_path:
+        run_profiled(profile_path, run, settings, report_template, backfill_mode, rollup, metrics, tail_mode)
     else:
-        logging.info('No new log find to parse.')
+        run(settings, report_template, backfill_mode, rollup, metrics, tail_mode)
+
+    metrics.log()
+    if settings["metrics_file"]:
+        metrics.write_json(settings["metrics_file"])
 
 
 if __name__ == "__main__":
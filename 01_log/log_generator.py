@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Генератор синтетического лога nginx в формате log_format ui_short для бенчмарков. Популярность url
+распределена по закону Ципфа, как в настоящих логах: немного горячих url и длинный хвост редких."""
+import argparse
+import gzip
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+# Обработчики, в которые подставляется id url. Разные обработчики нужны, чтобы строки были разной длины.
+URL_PATTERNS = (
+    '/api/v2/banner/{}',
+    '/api/v2/banner/{}/statistic/?date_from=2017-06-28&date_to=2017-06-29',
+    '/api/1/campaigns/?id={}',
+    '/api/v2/group/{}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/v2/slot/{}/groups',
+    '/export/appinstall_raw/2017-06-{}/',
+    '/agency/outstanding_payments_summary/?id={}',
+)
+USER_AGENTS = (
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+    'Go 1.1 package http',
+    '-',
+)
+STATUSES = ('200', '200', '200', '200', '200', '200', '302', '304', '404', '499', '500')
+
+LINE_TEMPLATE = '{ip} -  - [{time_local}] "{method} {url} HTTP/1.1" {status} {bytes} "-" "{agent}" "-" ' \
+                '"{request_id}" "{user}" {time:.3f}\n'
+
+# Распределения времени ответа. Параметры подобраны так, чтобы медиана была порядка десятых долей секунды.
+TIME_DISTRIBUTIONS = {
+    'exp': lambda rnd: rnd.expovariate(5),
+    'lognormal': lambda rnd: rnd.lognormvariate(-2, 1),
+    # Тяжелый хвост: редкие запросы идут секунды
+    'pareto': lambda rnd: 0.05 * rnd.paretovariate(1.5),
+}
+
+# Сколько строк собирается в памяти перед записью в файл
+WRITE_BATCH_LINES = 10000
+START_TIME = datetime(2017, 6, 29, 3, 50, 22)
+
+
+def get_url_cum_weights(urls, zipf):
+    """Накопленные веса url с номерами 0..urls-1 для random.choices"""
+    return list(accumulate(1 / (rank + 1) ** zipf for rank in range(urls)))
+
+
+def get_url(url_id):
+    return URL_PATTERNS[url_id % len(URL_PATTERNS)].format(url_id)
+
+
+def generate_lines(lines, urls, zipf=1.1, time_distribution='exp', broken_ratio=0.0, seed=0):
+    """Отдает строки лога пачками по WRITE_BATCH_LINES. Битые строки - обрезанные на середине, как при аварийной
+    записи лога."""
+    rnd = random.Random(seed)
+    url_ids = range(urls)
+    cum_weights = get_url_cum_weights(urls, zipf)
+    request_time = TIME_DISTRIBUTIONS[time_distribution]
+    generated = 0
+    while generated < lines:
+        size = min(WRITE_BATCH_LINES, lines - generated)
+        time_local = (START_TIME + timedelta(seconds=generated // 100)).strftime('%d/%b/%Y:%H:%M:%S +0300')
+        batch = []
+        for url_id in rnd.choices(url_ids, cum_weights=cum_weights, k=size):
+            line = LINE_TEMPLATE.format(
+                ip='1.{}.{}.{}'.format(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)),
+                time_local=time_local,
+                method='GET' if rnd.random() < 0.9 else 'POST',
+                url=get_url(url_id),
+                status=rnd.choice(STATUSES),
+                bytes=rnd.randrange(100, 100000),
+                agent=rnd.choice(USER_AGENTS),
+                request_id='{}-{}-4708-{}'.format(1498697422 + generated // 100, rnd.randrange(10 ** 10),
+                                                  rnd.randrange(10 ** 7)),
+                user='dc7161be3' if rnd.random() < 0.5 else '-',
+                time=request_time(rnd),
+            )
+            if broken_ratio and rnd.random() < broken_ratio:
+                line = line[:len(line) // 2] + '\n'
+            batch.append(line)
+        generated += size
+        yield ''.join(batch)
+
+
+def generate_log(path, lines, urls, zipf=1.1, time_distribution='exp', broken_ratio=0.0, compress=None, seed=0):
+    """Пишет лог в path. compress=None - сжимать, если путь кончается на .gz"""
+    if compress is None:
+        compress = path.endswith('.gz')
+    open_func = gzip.open if compress else open
+    with open_func(path, mode='wt', encoding='utf-8') as log_file:
+        for batch in generate_lines(lines, urls, zipf, time_distribution, broken_ratio, seed):
+            log_file.write(batch)
+
+
+def get_lines_for_size(size_mb, urls, zipf=1.1, time_distribution='exp'):
+    """Оценивает, сколько строк нужно для лога в size_mb мегабайт без сжатия, по средней длине первой пачки"""
+    batch = next(generate_lines(WRITE_BATCH_LINES, urls, zipf, time_distribution))
+    return int(size_mb * 1024 * 1024 * WRITE_BATCH_LINES / len(batch.encode('utf-8')))
+
+
+def add_generator_args(parser):
+    parser.add_argument('--lines', type=int, default=1000000, help='number of lines in the log')
+    parser.add_argument('--size-mb', type=float, default=None,
+                        help='approximate uncompressed log size, overrides --lines')
+    parser.add_argument('--urls', type=int, default=10000, help='number of distinct urls')
+    parser.add_argument('--zipf', type=float, default=1.1, help='skew of url popularity, 0 - uniform')
+    parser.add_argument('--time-distribution', choices=sorted(TIME_DISTRIBUTIONS), default='exp')
+    parser.add_argument('--broken-ratio', type=float, default=0.0, help='share of truncated lines')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def get_generator_kwargs(args):
+    lines = args.lines
+    if args.size_mb:
+        lines = get_lines_for_size(args.size_mb, args.urls, args.zipf, args.time_distribution)
+    return dict(lines=lines, urls=args.urls, zipf=args.zipf, time_distribution=args.time_distribution,
+                broken_ratio=args.broken_ratio, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic nginx log for benchmarks.')
+    parser.add_argument('path', help='path to the log, gzip is used if it ends with .gz')
+    add_generator_args(parser)
+    args = parser.parse_args()
+    generate_log(args.path, **get_generator_kwargs(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,27 @@
 import gzip
+import json
+import math
 import os
 import shutil
 import sys
 import tempfile
 import unittest
+from itertools import count
+from operator import itemgetter
 from os.path import join
+from unittest import mock
+from urllib.request import urlopen
 
 import yaml
 
-from log_analyzer import main, get_template, REPORT_TEMPLATE_PATH
+from lib_analyze import (EmptyReqData, LogAggregate, SketchReqData, analyze_lines_from_offset, get_aggregate_stat_data,
+                         get_line_analyzer, get_stat_data)
+from lib_columnar import read_columns, write_columns
+from lib_get_logs_names import get_logs_registry, log_params
+from lib_gzip import GzipLineReader, GzipReadError
+from lib_tail import LiveReports, LogFollower, SlidingWindow
+from lib_urls import OTHER_URL, UrlNormalizer
+from log_analyzer import main, get_template, REPORT_TEMPLATE_PATH, DEFAULT_SETTINGS
 from test_data import log_data, test_report_data
 
 
@@ -46,12 +59,15 @@ class TestCompleteParsing(unittest.TestCase):
         self.log_file_path = join(self.test_log_dir, self.LOG_NAME)
         config["analyzer_log_file"] = self.log_file_path
         config["parse_success_threshold_percent"] = 90
+        self.metrics_file_path = join(self.test_log_dir, 'metrics.json')
+        config["metrics_file"] = self.metrics_file_path
 
         config_file_path = join(self.test_log_dir, self.CONFIG_NAME)
         with open(config_file_path, mode='w') as file:
             yaml.dump(config, file)
 
         # Имитируем как-будто бы передачу пути до конфига для парсинга
+        self.argv = sys.argv[:]
         sys.argv.extend(('-c', config_file_path))
 
         # Готовим шаблон для проверки отчетов
@@ -62,6 +78,7 @@ class TestCompleteParsing(unittest.TestCase):
         # Remove the directory after the test
         shutil.rmtree(self.test_log_dir)
         shutil.rmtree(self.test_report_dir)
+        sys.argv[:] = self.argv
 
     def test_something(self):
         main()
@@ -73,6 +90,391 @@ class TestCompleteParsing(unittest.TestCase):
                 self.assertEqual(self.report_example, file.read())
         self.assertTrue(os.path.isfile(self.log_file_path))
 
+    def test_backfill_and_rollup(self):
+        sys.argv.extend(('--backfill', '--rollup', 'week'))
+        main()
+        self.assertEqual(['aggregate-2017.07.01.pickle.gz', 'aggregate-2017.07.02.pickle.gz', 'report-2017.07.01.html',
+                          'report-2017.07.02.html', 'report-week-2017-W26.html'],
+                         sorted(os.listdir(self.test_report_dir)))
+        for report in ('report-2017.07.01.html', 'report-2017.07.02.html'):
+            with open(os.path.join(self.test_report_dir, report), newline='') as file:
+                self.assertEqual(self.report_example, file.read())
+
+    def test_metrics_and_profile(self):
+        profile_path = join(self.test_log_dir, 'log_analyzer.prof')
+        sys.argv.extend(('--backfill', '--profile', profile_path))
+        main()
+        with open(self.metrics_file_path) as file:
+            metrics = json.load(file)
+        self.assertEqual(2, metrics['counters']['logs'])
+        self.assertEqual(4, metrics['counters']['unmatched_lines'])
+        self.assertGreater(metrics['counters']['parsed_lines'], 0)
+        self.assertEqual({'analyze', 'decompress', 'stat', 'day_aggregate', 'report'}, set(metrics['stages']))
+        self.assertLess(metrics['stages']['decompress'], metrics['stages']['analyze'])
+        self.assertGreater(metrics['lines_per_sec'], 0)
+        self.assertGreater(os.path.getsize(profile_path), 0)
+
+
+class TestAnalyzeModes(unittest.TestCase):
+    """Альтернативные режимы разбора должны давать такие же данные для отчета, как и обычный"""
+    # Повторяем тестовый лог, чтобы хватило на несколько кусков при разборе в несколько процессов
+    LOG_REPEAT = 200
+
+    def setUp(self):
+        self.test_log_dir = tempfile.mkdtemp()
+        test_log_data = ((log_data + '\n') * self.LOG_REPEAT).encode('utf-8')
+        self.plain_log = self.make_log('nginx-access-ui.log-20170702.log', test_log_data, '.log')
+        self.gz_log = self.make_log('nginx-access-ui.log-20170701.gz', gzip.compress(test_log_data), '.gz')
+        self.settings = DEFAULT_SETTINGS.copy()
+        self.settings.update(report_size=0, parse_success_threshold_percent=90)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_log_dir)
+
+    def make_log(self, name, data, ext):
+        path = join(self.test_log_dir, name)
+        with open(path, mode='wb') as file:
+            file.write(data)
+        return log_params(name[-8:], None, None, path, ext)
+
+    def get_stat_data(self, log, **settings):
+        return get_stat_data(log, **dict(self.settings, **settings))
+
+    def test_workers(self):
+        for log in (self.plain_log, self.gz_log):
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, workers=4))
+
+    def test_fast_line_parser(self):
+        for log in (self.plain_log, self.gz_log):
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, line_parser='fast'))
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, line_parser='fast', workers=4))
+
+    def test_mmap_line_parser(self):
+        for log in (self.plain_log, self.gz_log):
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, line_parser='mmap'))
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, line_parser='mmap', workers=4))
+        self.assertEqual(self.get_stat_data(self.plain_log, collapse_numeric_segments=True),
+                         self.get_stat_data(self.plain_log, collapse_numeric_segments=True, line_parser='mmap'))
+        # Пустые строки и строка без перевода строки в конце считаются так же, как при обычном разборе
+        log = self.make_log('nginx-access-ui.log-20170703.log', b'\n\n' + log_data.encode('utf-8').rstrip(), '.log')
+        self.assertEqual(self.get_stat_data(log, parse_success_threshold_percent=0),
+                         self.get_stat_data(log, parse_success_threshold_percent=0, line_parser='mmap'))
+
+    def test_numpy_engine(self):
+        for log in (self.plain_log, self.gz_log):
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, aggregation_engine='numpy'))
+            self.assertEqual(self.get_stat_data(log), self.get_stat_data(log, aggregation_engine='numpy', workers=4))
+        # Фильтр по report_size тоже считается векторно
+        self.assertEqual(self.get_stat_data(self.plain_log, report_size=100),
+                         self.get_stat_data(self.plain_log, report_size=100, aggregation_engine='numpy'))
+
+    def test_url_normalization(self):
+        normalizer = UrlNormalizer([[r'^/export/[^?]+', '/export/*']], collapse_numeric_segments=True)
+        self.assertEqual(normalizer('/api/v2/banner/25769978'), '/api/v2/banner/{id}')
+        self.assertEqual(normalizer('/api/1/campaigns/?id=6761497&page=2'), '/api/{id}/campaigns/?id={id}&page={id}')
+        self.assertEqual(normalizer('/export/appinstall_raw/2017-06-29/'), '/export/*')
+
+        expected = self.get_stat_data(self.plain_log)
+        stat_data = self.get_stat_data(self.plain_log, collapse_numeric_segments=True)
+        self.assertLess(len(stat_data), len(expected))
+        self.assertEqual(sum(row['count'] for row in expected), sum(row['count'] for row in stat_data))
+        self.assertIn('/api/v2/banner/{id}', [row['url'] for row in stat_data])
+
+    def test_max_distinct_urls(self):
+        expected = self.get_stat_data(self.plain_log)
+        for settings in ({}, {'workers': 4}, {'aggregation_engine': 'numpy'}, {'aggregation_engine': 'sketch'}):
+            stat_data = self.get_stat_data(self.plain_log, max_distinct_urls=5, **settings)
+            self.assertLessEqual(len(stat_data), 5)
+            self.assertIn(OTHER_URL, [row['url'] for row in stat_data])
+            self.assertEqual(sum(row['count'] for row in expected), sum(row['count'] for row in stat_data))
+            self.assertAlmostEqual(sum(row['time_sum'] for row in expected), sum(row['time_sum'] for row in stat_data))
+        # Пока url меньше предела, отчет не меняется
+        self.assertEqual(expected, self.get_stat_data(self.plain_log, max_distinct_urls=len(expected)))
+        # numpy сливает те же url, что и exact, только other стоит на месте первого слитого url
+        for max_distinct_urls in (2, 5, 10):
+            exact, numpy_stat_data = (self.get_stat_data(self.plain_log, max_distinct_urls=max_distinct_urls,
+                                                         aggregation_engine=engine) for engine in ('exact', 'numpy'))
+            self.assertEqual(sorted(exact, key=itemgetter('url')), sorted(numpy_stat_data, key=itemgetter('url')))
+
+    def test_time_budget_sampling(self):
+        expected = self.get_stat_data(self.plain_log)
+        # Каждый вызов часов сдвигает время на миллисекунду, так что весь лог не укладывается в 2 секунды
+        clock = count(0, 0.001)
+        with mock.patch('lib_analyze.sys_time.time', side_effect=lambda: next(clock)):
+            stat_data = self.get_stat_data(self.plain_log, time_budget_sampling=True, sampling_probe_mb=0.01,
+                                           max_time_parsing_for_log=2)
+        # Порядок url с одинаковым временем зависит от того, какая строка попала в выборку первой
+        stat_data = {row['url']: row for row in stat_data}
+        self.assertEqual({row['url'] for row in expected}, set(stat_data))
+        for expected_row in expected:
+            row = stat_data[expected_row['url']]
+            self.assertIn('count_err', row)
+            self.assertGreater(row['count_err'], 0)
+            self.assertLessEqual(abs(expected_row['count'] - row['count']), row['count_err'])
+            self.assertEqual(expected_row['time_med'], row['time_med'])
+            self.assertLessEqual(abs(expected_row['time_sum'] - row['time_sum']), row['time_sum_err'] + 0.001)
+            self.assertLessEqual(row['time_med_low'], expected_row['time_med'])
+            self.assertLessEqual(expected_row['time_med'], row['time_med_high'])
+
+    def test_sampling_periodic_log(self):
+        """Тестовый лог повторяется с периодом 21 строка. Каждая 7-я строка попадала бы только на 3 места из 21,
+        а независимая выборка видит все url, и count по ней попадает в доверительный интервал."""
+        expected = self.get_stat_data(self.plain_log)
+        line_analyzer, binary = get_line_analyzer(**self.settings)
+        aggregate = LogAggregate()
+        aggregate.sample_step = 7
+        analyze_lines_from_offset(self.plain_log, line_analyzer, binary, math.inf, aggregate, step=7)
+        stat_data = {row['url']: row for row in get_aggregate_stat_data(aggregate, 0)}
+        self.assertEqual({row['url'] for row in expected}, set(stat_data))
+        for expected_row in expected:
+            row = stat_data[expected_row['url']]
+            self.assertLessEqual(abs(expected_row['count'] - row['count']), row['count_err'])
+
+    def test_quantile_interval(self):
+        exact, sketch = EmptyReqData(), SketchReqData(0.001)
+        for time in range(1, 101):
+            exact.add(time)
+            sketch.add(time)
+        # Ранги 50 +- 1.96 * 5 с округлением наружу
+        self.assertEqual((41, 61), exact.get_quantile_interval(0.5))
+        for expected, value in zip(exact.get_quantile_interval(0.5), sketch.get_quantile_interval(0.5)):
+            self.assertAlmostEqual(expected, value, delta=expected * 0.001)
+
+    def test_gzip_line_reader(self):
+        with gzip.open(self.gz_log.log_file_path, mode='rb') as file:
+            expected = list(file)
+        offset = sum(map(len, expected[:30]))
+        for threaded in (False, True):
+            # Маленькие блоки, чтобы строки разрезались между блоками
+            with GzipLineReader(self.gz_log.log_file_path, threaded=threaded, block_size=100) as reader:
+                self.assertEqual(expected, list(reader))
+            with GzipLineReader(self.gz_log.log_file_path, offset, threaded=threaded, block_size=100) as reader:
+                self.assertEqual(expected[30:], list(reader))
+        # Склеенные архивы с нулями между ними и после, как их читает gzip.open
+        path = join(self.test_log_dir, 'parts.gz')
+        with open(path, mode='wb') as file:
+            file.write(gzip.compress(b'first\nsec') + b'\x00' * 10 + gzip.compress(b'ond\n') + b'\x00' * 200)
+        for block_size in (5, 100):
+            with GzipLineReader(path, block_size=block_size) as reader:
+                self.assertEqual([b'first\n', b'second\n'], list(reader))
+        # Обрезанный архив
+        with open(path, mode='wb') as file:
+            file.write(gzip.compress(b'line\n' * 1000)[:-10])
+        with self.assertRaises(GzipReadError), GzipLineReader(path) as reader:
+            list(reader)
+
+    def test_truncated_gz_log(self):
+        """По обрезанному gz логу отчет не строится"""
+        with open(self.gz_log.log_file_path, mode='rb') as file:
+            data = file.read()
+        log = self.make_log('nginx-access-ui.log-20170704.gz', data[:len(data) // 2], '.gz')
+        for settings in ({}, {'workers': 4}, {'line_parser': 'fast'}):
+            with self.assertRaises(EOFError):
+                self.get_stat_data(log, **settings)
+
+    def test_checkpoint_resume(self):
+        log = self.make_log('nginx-access-ui.log-20170703.log', (log_data + '\n').encode('utf-8'), '.log')
+        checkpoint_dir = join(self.test_log_dir, 'checkpoints')
+        os.mkdir(checkpoint_dir)
+        expected = self.get_stat_data(log)
+        # Время на разбор кончается после каждой строки, поэтому каждый запуск продвигается на одну строку
+        for _ in range(len(log_data.splitlines()) + 1):
+            stat_data = self.get_stat_data(log, checkpoint_dir=checkpoint_dir, max_time_parsing_for_log=-1)
+            if stat_data:
+                break
+        self.assertEqual(expected, stat_data)
+
+    def test_checkpoint_resume_gz(self):
+        checkpoint_dir = join(self.test_log_dir, 'checkpoints')
+        os.mkdir(checkpoint_dir)
+        expected = self.get_stat_data(self.gz_log)
+        # Распакованный лог в сотню раз больше сжатого, поэтому позиция в нем быстро обгоняет размер файла.
+        # Каждый вызов часов сдвигает время на миллисекунду, так что за запуск разбирается около 500 строк.
+        clock = count(0, 0.001)
+        lines = len(log_data.splitlines()) * self.LOG_REPEAT
+        with mock.patch('lib_analyze.sys_time.time', side_effect=lambda: next(clock)):
+            for _ in range(lines // 100):
+                stat_data = self.get_stat_data(self.gz_log, checkpoint_dir=checkpoint_dir,
+                                               max_time_parsing_for_log=0.5)
+                if stat_data:
+                    break
+        self.assertEqual(expected, stat_data)
+
+    def test_checkpoint_appended_log(self):
+        checkpoint_dir = join(self.test_log_dir, 'checkpoints')
+        os.mkdir(checkpoint_dir)
+        lines = (log_data + '\n').encode('utf-8').splitlines(keepends=True)
+        for workers in (1, 4):
+            name = 'nginx-access-ui.log-2017070{}.log'.format(workers)
+            log = self.make_log(name, b''.join(lines[:10]) + lines[10][:20], '.log')
+            self.get_stat_data(log, checkpoint_dir=checkpoint_dir, parse_success_threshold_percent=0,
+                               workers=workers)
+            with open(log.log_file_path, mode='ab') as file:
+                file.write(lines[10][20:] + b''.join(lines[11:]))
+            stat_data = self.get_stat_data(log, checkpoint_dir=checkpoint_dir, workers=workers)
+            self.assertEqual(self.get_stat_data(log), stat_data)
+
+    def test_columnar_report_data(self):
+        stat_data = self.get_stat_data(self.plain_log, aggregation_engine='sketch')
+        path = join(self.test_log_dir, 'report.cols')
+        write_columns(path, stat_data)
+        columns = read_columns(path)
+        rows = sorted(stat_data, key=lambda row: row['time_sum'], reverse=True)
+        self.assertEqual(sorted(rows[0]), sorted(columns))
+        for name, values in columns.items():
+            self.assertEqual([row[name] for row in rows], values)
+
+    def test_sketch_engine(self):
+        relative_error = 0.01
+        exact = self.get_stat_data(self.plain_log)
+        sketch = self.get_stat_data(self.plain_log, aggregation_engine='sketch', sketch_relative_error=relative_error)
+        self.assertEqual(len(exact), len(sketch))
+        for exact_row, sketch_row in zip(exact, sketch):
+            for key in ('url', 'count', 'count_perc', 'time_max'):
+                self.assertEqual(exact_row[key], sketch_row[key])
+            self.assertAlmostEqual(exact_row['time_sum'], sketch_row['time_sum'], places=2)
+            # Округление до миллисекунд в отчете добавляет еще немного к ошибке скетча
+            self.assertAlmostEqual(exact_row['time_med'], sketch_row['time_med'],
+                                   delta=exact_row['time_med'] * relative_error + 0.001)
+            self.assertLessEqual(sketch_row['time_p90'], sketch_row['time_p99'])
+        self.assertEqual(sketch, self.get_stat_data(self.plain_log, workers=4, aggregation_engine='sketch',
+                                                    sketch_relative_error=relative_error))
+
+
+class TestLogsIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_log_dir = tempfile.mkdtemp()
+        self.test_report_dir = tempfile.mkdtemp()
+        self.settings = DEFAULT_SETTINGS.copy()
+        self.settings.update(nginx_logs_dir=self.test_log_dir, reports_dir=self.test_report_dir)
+        for name in ('nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20170701.log',
+                     'nginx-access-ui.log-20170799.log', 'other.log'):
+            self.touch(self.test_log_dir, name)
+        os.utime(self.test_report_dir, (self.mtime, self.mtime))
+        self.index_path = join(tempfile.mkdtemp(), 'index.json')
+
+    def tearDown(self):
+        for directory in (self.test_log_dir, self.test_report_dir, os.path.dirname(self.index_path)):
+            shutil.rmtree(directory)
+
+    def touch(self, directory, name):
+        with open(join(directory, name), mode='w'):
+            pass
+        # mtime в прошлом, иначе индекс не доверяет ему, см. MTIME_SAFETY_SECONDS
+        self.mtime = getattr(self, 'mtime', 1500000000) + 1
+        os.utime(directory, (self.mtime, self.mtime))
+
+    def test_index(self):
+        expected = get_logs_registry(**self.settings)
+        self.assertEqual(expected, get_logs_registry(**dict(self.settings, logs_index_path=self.index_path)))
+        # Директории не менялись, поэтому не читаются
+        with mock.patch('lib_logs_index.os.scandir', side_effect=AssertionError), \
+                mock.patch('lib_logs_index.os.listdir', side_effect=AssertionError):
+            self.assertEqual(expected, get_logs_registry(**dict(self.settings, logs_index_path=self.index_path)))
+        self.touch(self.test_log_dir, 'nginx-access-ui.log-20170702.log')
+        self.touch(self.test_report_dir, 'report-2017.07.01.html')
+        expected = get_logs_registry(**self.settings)
+        self.assertEqual(2, len(expected))
+        self.assertEqual(expected, get_logs_registry(**dict(self.settings, logs_index_path=self.index_path)))
+
+    def load_index(self):
+        with open(self.index_path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def test_rotated_log(self):
+        settings = dict(self.settings, logs_index_path=self.index_path)
+        name = 'nginx-access-ui.log-20170701.log'
+        path = join(self.test_log_dir, name)
+        get_logs_registry(**settings)
+        self.assertEqual(0, self.load_index()['logs'][name]['size'])
+        # Ротация после индексации: лог переименован, а на его месте создан новый, который уже дописали
+        os.rename(path, path + '.1')
+        with open(path, mode='w') as file:
+            file.write('line\n')
+        os.utime(self.test_log_dir, (self.mtime, self.mtime))
+        self.assertEqual(get_logs_registry(**self.settings), get_logs_registry(**settings))
+        self.assertEqual(5, self.load_index()['logs'][name]['size'])
+        # Дописали без изменения директории
+        with open(path, mode='a') as file:
+            file.write('line\n')
+        get_logs_registry(**settings)
+        self.assertEqual(10, self.load_index()['logs'][name]['size'])
+
+    def test_report_status(self):
+        settings = dict(self.settings, logs_index_path=self.index_path)
+        self.assertEqual(2, len(get_logs_registry(**settings)))
+        self.assertEqual(['nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20170701.log'],
+                         self.load_index()['pending'])
+        self.touch(self.test_report_dir, 'report-2017.07.01.html')
+        self.assertEqual(get_logs_registry(**self.settings), get_logs_registry(**settings))
+        index = self.load_index()
+        self.assertEqual(['nginx-access-ui.log-20170630.gz'], index['pending'])
+        self.assertTrue(index['logs']['nginx-access-ui.log-20170701.log']['report'])
+        # Отчет удалили, лог снова ждет разбора
+        os.remove(join(self.test_report_dir, 'report-2017.07.01.html'))
+        os.utime(self.test_report_dir, (self.mtime + 1, self.mtime + 1))
+        self.assertEqual(2, len(get_logs_registry(**settings)))
+        self.assertFalse(self.load_index()['logs']['nginx-access-ui.log-20170701.log']['report'])
+
+
+class TestTail(unittest.TestCase):
+    def setUp(self):
+        self.test_log_dir = tempfile.mkdtemp()
+        self.path = join(self.test_log_dir, 'nginx-access-ui.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_log_dir)
+
+    def append(self, data, path=None):
+        with open(path or self.path, mode='ab') as file:
+            file.write(data)
+
+    def test_follower(self):
+        self.append(b'old\n')
+        follower = LogFollower(self.path)
+        self.assertEqual([], follower.read_lines()[0])
+        # Недописанная строка отдается, только когда допишут перевод строки
+        self.append(b'first\nsec')
+        self.assertEqual([b'first\n'], follower.read_lines()[0])
+        self.append(b'ond\n')
+        self.assertEqual([b'second\n'], follower.read_lines()[0])
+        # Ротация: старый файл переименован и в него еще дописали, новый создан
+        os.rename(self.path, self.path + '.1')
+        self.append(b'late\n', self.path + '.1')
+        self.append(b'new\n')
+        self.assertEqual([b'late\n'], follower.read_lines()[0])
+        self.assertEqual([b'new\n'], follower.read_lines()[0])
+        # copytruncate
+        with open(self.path, mode='wb') as file:
+            file.write(b'x\n')
+        self.assertEqual([], follower.read_lines()[0])
+        self.assertEqual([b'x\n'], follower.read_lines()[0])
+        follower.close()
+
+    def test_sliding_window(self):
+        window = SlidingWindow(LogAggregate, bucket_seconds=10, max_window=60)
+        for now in range(0, 100, 5):
+            window.get_bucket(now).add_request('/api/{}'.format(now // 50), 1.0)
+        self.assertLessEqual(len(window.buckets), 7)
+        aggregate = window.get_aggregate(100, 30)
+        self.assertEqual({'/api/1': 6}, {url: data.count for url, data in aggregate.parsed_data.items()})
+        aggregate = window.get_aggregate(100, 60)
+        self.assertEqual({'/api/0': 2, '/api/1': 10}, {url: data.count for url, data in aggregate.parsed_data.items()})
+
+    def test_live_reports_server(self):
+        live_reports = LiveReports()
+        live_reports.update('live-5m', [{'url': '/api', 'count': 1}])
+        # Порт 0 - любой свободный. По умолчанию сервер слушает только локальный адрес.
+        server = live_reports.serve(0)
+        try:
+            host, port = server.server_address[:2]
+            self.assertEqual('127.0.0.1', host)
+            with urlopen('http://127.0.0.1:{}/live-5m.json'.format(port)) as response:
+                self.assertEqual([{'url': '/api', 'count': 1}], json.load(response))
+        finally:
+            server.shutdown()
+            server.server_close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Бенчмарки способов оценки рук.
+
+speed  - скорость на случайных руках из 5 и 7 карт, с джокерами и без. Заодно проверяет, что результаты совпадают, и
+         печатает доли категорий рук из 7 карт.
+corpus - все 2598960 рук из 5 карт каждым способом: очки должны совпасть у всех, а число рук каждой категории - с
+         известным распределением."""
+import argparse
+import json
+import os
+import random
+import subprocess
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+from itertools import combinations
+
+from poker import RANK_BASE, best_cards, best_hand, best_hand_direct, best_wild_hand, best_wild_hand_product, \
+    cached_rank_score, encode_card, get_score_tables, hand_score, rank_score, try_int
+from poker_batch import ENGINES, encode_hands, evaluate_hands, get_batch_tables, np
+
+DECK = [str(try_int(rank, reverse=True)) + suit for rank in range(2, 15) for suit in 'SHDC']
+# Категория руки по сотням очков calc_score
+CATEGORIES = {
+    0: 'high card',
+    2: 'pair',
+    6: 'two pair',
+    7: 'three of a kind',
+    8: 'straight',
+    9: 'flush',
+    11: 'full house',
+    12: 'four of a kind',
+    13: 'straight flush',
+}
+# Число рук каждой категории среди всех рук из 5 карт. Стандартные числа поправлены на то, что здесь стрит с тузом внизу
+# (A2345) не считается: 4 таких стрит-флеша становятся флешами, а 1020 стритов - старшей картой.
+CORPUS_CATEGORY_COUNTS = {
+    'straight flush': 40 - 4,
+    'four of a kind': 624,
+    'full house': 3744,
+    'flush': 5108 + 4,
+    'straight': 10200 - 1020,
+    'three of a kind': 54912,
+    'two pair': 123552,
+    'pair': 1098240,
+    'high card': 1302540 + 1020,
+}
+# Доли категорий лучшей руки из 7 карт по стандартным правилам, для сравнения. Без стрита A2345 стритов чуть меньше.
+SEVEN_CARD_SHARES = {
+    'straight flush': 41584 / 133784560,
+    'four of a kind': 224848 / 133784560,
+    'full house': 3473184 / 133784560,
+    'flush': 4047644 / 133784560,
+    'straight': 6180020 / 133784560,
+    'three of a kind': 6461620 / 133784560,
+    'two pair': 31433400 / 133784560,
+    'pair': 58627800 / 133784560,
+    'high card': 23294460 / 133784560,
+}
+# Скорости текущего запуска по названиям, для --results
+RATES = {}
+
+
+def random_hands(count, size, seed=0, jokers=()):
+    rnd = random.Random(seed)
+    return [rnd.sample(DECK, size - len(jokers)) + list(jokers) for _ in range(count)]
+
+
+def sort_hand(hand):
+    return sorted(hand, key=lambda k: try_int(k[0]), reverse=True)
+
+
+def timed(func, items):
+    started = time.perf_counter()
+    results = [func(item) for item in items]
+    return results, time.perf_counter() - started
+
+
+def report(name, count, seconds, base_rate=None):
+    rate = count / seconds
+    line = '{}: {:,.0f} hands/sec'.format(name, rate)
+    if base_rate:
+        line += ', x{:.1f}'.format(rate / base_rate)
+    print(line)
+    RATES[name] = round(rate)
+    return rate
+
+
+def get_category(score):
+    return CATEGORIES[score // RANK_BASE]
+
+
+def print_categories(name, scores, reference=None):
+    counts = Counter(get_category(score) for score in scores)
+    print('{} categories:'.format(name))
+    for category in CATEGORIES.values():
+        line = '  {}: {:.4%}'.format(category, counts[category] / len(scores))
+        if reference:
+            line += ' (standard {:.4%})'.format(reference[category])
+        print(line)
+
+
+def bench_5_cards(hands, base_hands):
+    hands = [sort_hand(hand) for hand in hands]
+    get_score_tables()
+    base, seconds = timed(rank_score, hands[:base_hands])
+    base_rate = report('rank_score, 5 cards', base_hands, seconds)
+    scores, seconds = timed(hand_score, hands)
+    assert scores[:base_hands] == base, 'hand_score differs from rank_score'
+    report('hand_score, 5 cards', len(hands), seconds, base_rate)
+
+
+def bench_7_cards(hands, base_hands):
+    base, seconds = timed(lambda hand: best_hand(hand, split_input=False, return_max_score=True), hands[:base_hands])
+    base_rate = report('best_hand, 7 cards', base_hands, seconds)
+    results, seconds = timed(lambda hand: best_hand(hand, split_input=False, return_max_score=True,
+                                                    score_func=hand_score), hands)
+    assert results[:base_hands] == base, 'best_hand with hand_score differs'
+    report('best_hand + hand_score, 7 cards', len(hands), seconds, base_rate)
+    cached, seconds = timed(lambda hand: best_hand(hand, split_input=False, return_max_score=True,
+                                                   score_func=cached_rank_score), hands)
+    assert cached == results, 'best_hand with cached_rank_score differs'
+    report('best_hand + cached_rank_score, 7 cards', len(hands), seconds, base_rate)
+    direct, seconds = timed(lambda hand: best_hand_direct(hand, split_input=False, return_max_score=True), hands)
+    assert direct == results, 'best_hand_direct differs from best_hand'
+    report('best_hand_direct, 7 cards', len(hands), seconds, base_rate)
+    # Карты разобраны заранее, как если бы вся программа работала с кодами карт
+    encoded = [[encode_card(card) for card in hand] for hand in hands]
+    cards, seconds = timed(best_cards, encoded)
+    assert [score for _, score in cards] == [score for _, score in results], 'best_cards differs from best_hand'
+    report('best_cards, 7 encoded cards', len(hands), seconds, base_rate)
+    print_categories('7 cards', [score for _, score in results], SEVEN_CARD_SHARES)
+
+
+def bench_wild(hands, base_hands, jokers):
+    name = 'best_wild_hand{}, 7 cards with {}'.format('{}', ' '.join(jokers))
+    # best_wild_hand_product удаляет джокеров из переданного списка
+    base, seconds = timed(lambda hand: best_wild_hand_product(list(hand), split_input=False), hands[:base_hands])
+    base_rate = report(name.format('_product'), base_hands, seconds)
+    results, seconds = timed(lambda hand: best_wild_hand(hand, split_input=False), hands)
+    assert results[:base_hands] == base, 'best_wild_hand differs from best_wild_hand_product'
+    report(name.format(''), len(hands), seconds, base_rate)
+    scores = [cached_rank_score(sort_hand(hand)) for hand in results]
+    print_categories('7 cards with {}'.format(' '.join(jokers)), scores)
+
+
+def bench_batch(hands, base_hands, workers):
+    cards = encode_hands(hands)
+    base, seconds = timed(best_cards, [list(hand) for hand in cards[:base_hands]])
+    base_rate = report('best_cards, 7 encoded cards from array', base_hands, seconds)
+    if np is not None:
+        get_batch_tables()
+    for engine in ENGINES if np is not None else ENGINES[1:]:
+        started = time.perf_counter()
+        scores, _ = evaluate_hands(cards, engine=engine, workers=workers)
+        seconds = time.perf_counter() - started
+        assert list(scores[:base_hands]) == [score for _, score in base], 'evaluate_hands differs from best_cards'
+        report('evaluate_hands({}), 7 encoded cards'.format(engine), len(hands), seconds, base_rate)
+
+
+CORPUS_EVALUATORS = {
+    'rank_score': rank_score,
+    'hand_score': hand_score,
+    'cached_rank_score': cached_rank_score,
+    'best_cards': None,
+    'evaluate_hands': None,
+}
+
+
+def iter_corpus_scores(evaluator):
+    """Очки всех рук из 5 карт в порядке combinations колоды DECK"""
+    if evaluator == 'evaluate_hands':
+        codes = encode_hands([DECK])[0]
+        for start in range(0, len(DECK)):
+            # Руки по первой карте, чтобы не держать в памяти все сразу
+            rest = np.array(list(combinations(range(start + 1, len(DECK)), 4)), dtype=np.int64).reshape(-1, 4)
+            indexes = np.concatenate([np.full((len(rest), 1), start), rest], axis=1)
+            yield from evaluate_hands(codes[indexes], engine='numpy')[0].tolist()
+    elif evaluator == 'best_cards':
+        for cards in combinations([encode_card(card) for card in DECK], 5):
+            yield best_cards(cards)[1]
+    else:
+        score_func = CORPUS_EVALUATORS[evaluator]
+        # DECK по возрастанию рангов, а rank_score ждет руку по убыванию
+        for hand in combinations(DECK, 5):
+            yield score_func(hand[::-1])
+
+
+def bench_corpus(evaluators):
+    get_score_tables()
+    base = None
+    base_rate = None
+    for evaluator in evaluators:
+        if evaluator == 'evaluate_hands':
+            if np is None:
+                print('evaluate_hands: skipped, numpy is not installed')
+                continue
+            get_batch_tables()
+        started = time.perf_counter()
+        scores = array('i', iter_corpus_scores(evaluator))
+        seconds = time.perf_counter() - started
+        rate = report('{}, all 5 card hands'.format(evaluator), len(scores), seconds, base_rate)
+        counts = Counter(get_category(score) for score in scores)
+        assert counts == CORPUS_CATEGORY_COUNTS, '{} category counts differ: {}'.format(evaluator, dict(counts))
+        if base is None:
+            base, base_rate = scores, rate
+        assert scores == base, '{} scores differ from {}'.format(evaluator, evaluators[0])
+    print_categories('5 cards', base)
+
+
+def bench_speed(args):
+    bench_5_cards(random_hands(args.hands, 5), min(args.base_hands, args.hands))
+    bench_7_cards(random_hands(args.hands_7, 7, seed=1), min(args.base_hands, args.hands_7))
+    for seed, jokers in enumerate((('?B',), ('?B', '?R')), 2):
+        bench_wild(random_hands(args.hands_wild, 7, seed, jokers), min(args.base_wild_hands, args.hands_wild), jokers)
+    bench_batch(random_hands(args.hands_batch, 7, seed=4), min(args.base_hands, args.hands_batch), args.workers)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(('git', 'rev-parse', '--short', 'HEAD'), stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results_path, args):
+    result = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'params': vars(args),
+        'rates': RATES,
+    }
+    with open(results_path, mode='a', encoding='utf-8') as results_file:
+        results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark poker hand evaluators.')
+    parser.add_argument('bench', choices=('speed', 'corpus'), nargs='?', default='speed')
+    parser.add_argument('--evaluators', nargs='+', choices=tuple(CORPUS_EVALUATORS), default=tuple(CORPUS_EVALUATORS),
+                        help='evaluators for the corpus, the first one is the reference')
+    parser.add_argument('--hands', type=int, default=1000000, help='number of random 5 card hands')
+    parser.add_argument('--hands-7', type=int, default=100000, help='number of random 7 card hands')
+    parser.add_argument('--hands-wild', type=int, default=10000, help='number of random 7 card hands with jokers')
+    parser.add_argument('--hands-batch', type=int, default=1000000, help='number of random 7 card hands for batch API')
+    parser.add_argument('--workers', type=int, default=None, help='processes for evaluate_hands, default - all cores')
+    parser.add_argument('--base-hands', type=int, default=20000,
+                        help='how many hands to evaluate with the slow original evaluators')
+    parser.add_argument('--base-wild-hands', type=int, default=200,
+                        help='how many hands with jokers to evaluate with the original best_wild_hand')
+    parser.add_argument('--results', default=None, help='file to append hands/sec of the run to as a json line')
+    args = parser.parse_args()
+    if args.bench == 'corpus':
+        bench_corpus(args.evaluators)
+    else:
+        bench_speed(args)
+    if args.results:
+        save_results(args.results, args)
+
+
+if __name__ == '__main__':
+    main()
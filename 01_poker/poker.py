@@ -26,8 +26,10 @@
 # Вам наверняка пригодится itertoolsю
 # Можно свободно определять свои функции и т.п.
 # -----------------
+from collections import Counter
 from enum import Enum
-from itertools import combinations, groupby, tee, product
+from functools import lru_cache
+from itertools import combinations, combinations_with_replacement, groupby, tee, product
 
 
 # В задании вроде это не указано или указано неявно. (Кстати, задание написано не очень понятно, доработать бы) Решил
@@ -119,7 +121,7 @@ def straight(ranks):
     return True
 
 
-# Можно, кстати, что-то вроде кэша сделать, чтобы для одинаковых комбинаций не считать одно и то же.
+# Кэш для одинаковых комбинаций - cached_rank_score.
 def kind(n, ranks):
     """Возвращает первый ранг, который n раз встречается в данной руке.
     Возвращает None, если ничего не найдено"""
@@ -168,15 +170,103 @@ def calc_score(result):
     return sum_
 
 
-def best_hand(hand, sorted_result=True, split_input=True, return_max_score=False):
-    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
+def rank_score(hand):
+    """Очки "руки" из 5 карт, отсортированной от большего ранга к меньшему"""
+    return calc_score(hand_rank(hand))
+
+
+# Очки зависят только от набора рангов и от того, флеш ли это. Набор рангов кодируется произведением простых чисел
+# (у каждого ранга свое), которое не зависит от порядка карт и однозначно определяет набор, так что ранжирование руки
+# сводится к поиску в словаре.
+RANK_PRIMES = {2: 2, 3: 3, 4: 5, 5: 7, 6: 11, 7: 13, 8: 17, 9: 19, 10: 23, 11: 29, 12: 31, 13: 37, 14: 41}
+# Ранг по символу карты без Enum и исключений try_int
+CARD_RANKS = {str(try_int(rank, reverse=True)): rank for rank in RANK_PRIMES}
+CARD_PRIMES = {char: RANK_PRIMES[rank] for char, rank in CARD_RANKS.items()}
+
+
+def get_rank_key(ranks):
+    key = 1
+    for rank in ranks:
+        key *= RANK_PRIMES[rank]
+    return key
+
+
+@lru_cache(maxsize=None)
+def get_score_tables():
+    """Возвращает словари {произведение простых рангов: очки} для рук не флешей и для флешей. Очки считаются через
+    hand_rank и calc_score для каждого набора рангов, поэтому порядок рук в точности тот же."""
+    scores = {}
+    flush_scores = {}
+    for ranks in combinations_with_replacement(range(14, 1, -1), 5):
+        if max(Counter(ranks).values()) > 4:
+            continue
+        # Масти по кругу, чтобы рука точно не оказалась флешем
+        hand = ['{}{}'.format(try_int(rank, reverse=True), 'SHDC'[i % 4]) for i, rank in enumerate(ranks)]
+        scores[get_rank_key(ranks)] = rank_score(hand)
+        if len(set(ranks)) == 5:
+            flush_scores[get_rank_key(ranks)] = rank_score([card[0] + 'S' for card in hand])
+    return scores, flush_scores
+
+
+def hand_score(hand):
+    """То же, что rank_score, но двумя поисками по таблицам из get_score_tables. Порядок карт не важен."""
+    scores, flush_scores = get_score_tables()
+    key = 1
+    for card in hand:
+        key *= CARD_PRIMES[card[0]]
+    suit = hand[0][1]
+    if all(card[1] == suit for card in hand):
+        return flush_scores[key]
+    return scores[key]
+
+
+# Сколько разных рук помнит cached_rank_score
+HAND_CACHE_SIZE = 65536
+
+
+def get_canonical_hand(hand):
+    """Ключ руки для кэша: ранги в порядке карт и признак того, что все карты одной масти. Больше hand_rank ничего из
+    руки не берет, поэтому руки, отличающиеся только мастями, например перестановкой мастей, дают один ключ."""
+    suit = hand[0][1]
+    return tuple(CARD_RANKS[card[0]] for card in hand), all(card[1] == suit for card in hand)
+
+
+@lru_cache(maxsize=HAND_CACHE_SIZE)
+def get_canonical_score(ranks, is_flush):
+    """rank_score руки с такими рангами, одной масти или с чередующимися мастями"""
+    suits = 'S' if is_flush else 'SH'
+    return rank_score([str(try_int(rank, reverse=True)) + suits[i % len(suits)] for i, rank in enumerate(ranks)])
+
+
+def cached_rank_score(hand):
+    """То же, что rank_score, но повторные и отличающиеся только мастями руки берутся из ограниченного LRU кэша"""
+    return get_canonical_score(*get_canonical_hand(hand))
+
+
+def get_hand_cache_stats():
+    """Статистика кэша cached_rank_score. Вытеснения считаются как промахи, не оставшиеся в кэше, поэтому верны с
+    последнего cache_clear, который сбрасывает и промахи."""
+    info = get_canonical_score.cache_info()
+    calls = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'evictions': info.misses - info.currsize,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hit_rate': info.hits / calls if calls else 0.0,
+    }
+
+
+def best_hand(hand, sorted_result=True, split_input=True, return_max_score=False, score_func=rank_score):
+    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт. score_func - функция очков руки из 5 карт, например
+    hand_score."""
     hand = hand.split() if split_input else hand
     hand = sorted(hand, key=lambda k: try_int(k[0]), reverse=True)
     max_score = 0
     _best_hand = ''
     for hand_5 in combinations(hand, 5):
-        result = hand_rank(hand_5)
-        score = calc_score(result)
+        score = score_func(hand_5)
         if score > max_score:
             max_score = score
             _best_hand = hand_5
@@ -188,13 +278,217 @@ def best_hand(hand, sorted_result=True, split_input=True, return_max_score=False
     return _best_hand
 
 
+# Карта кодируется числом rank << 2 | масть, строки разбираются только на входе и собираются на выходе.
+SUITS = 'SHDC'
+SUIT_CODES = {suit: code for code, suit in enumerate(SUITS)}
+# Биты пяти рангов подряд в маске рангов (бит rank выставлен, если ранг есть)
+STRAIGHT_BITS = 0b11111
+
+
+def encode_card(card):
+    """'TH' -> 10 << 2 | 1"""
+    return CARD_RANKS[card[0]] << 2 | SUIT_CODES[card[1]]
+
+
+def decode_card(code):
+    return str(try_int(code >> 2, reverse=True)) + SUITS[code & 3]
+
+
+def get_straight_top(rank_mask):
+    """Старший ранг самого старшего стрита в маске рангов или 0. Как и straight, стрит с тузом внизу не считается."""
+    for top in range(14, 5, -1):
+        if rank_mask >> (top - 4) & STRAIGHT_BITS == STRAIGHT_BITS:
+            return top
+    return 0
+
+
+def evaluate_cards(cards):
+    """Лучшая рука из 5 карт без перебора сочетаний. cards - коды карт, отсортированные от большего ранга к меньшему
+    с сохранением порядка равных. Возвращает (очки, индексы карт лучшей руки по возрастанию).
+
+    Категории по очкам не пересекаются, поэтому ищется самая старшая доступная категория, а в ней максимум очков
+    прямо по рангам. Если максимум дают несколько рук, выбирается та, что best_hand нашел бы первой в combinations,
+    то есть с наименьшим в лексикографическом порядке набором индексов."""
+    count = len(cards)
+    ranks = [card >> 2 for card in cards]
+    # ранг -> индексы его карт по возрастанию
+    rank_indexes = {}
+    suit_indexes = ([], [], [], [])
+    suit_masks = [0, 0, 0, 0]
+    rank_mask = 0
+    for index, card in enumerate(cards):
+        rank_indexes.setdefault(card >> 2, []).append(index)
+        suit_indexes[card & 3].append(index)
+        suit_masks[card & 3] |= 1 << (card >> 2)
+        rank_mask |= 1 << (card >> 2)
+
+    # Для стрит-флешей и флешей: (очки, индексы), при равных очках берется меньший набор индексов
+    straight_flushes = []
+    flushes = []
+    for suit, indexes in enumerate(suit_indexes):
+        if len(indexes) >= 5:
+            top = get_straight_top(suit_masks[suit])
+            if top:
+                # С джокерами карта может повториться, берется первая
+                straight = {}
+                for index in indexes:
+                    if top - 4 <= ranks[index] <= top:
+                        straight.setdefault(ranks[index], index)
+                straight_flushes.append((-top, sorted(straight.values())))
+            flushes.append((-sum(ranks[index] for index in indexes[:5]), indexes[:5]))
+    if straight_flushes:
+        top, indexes = min(straight_flushes)
+        return calc_score((13, -top)), tuple(indexes)
+
+    quads = [rank for rank, indexes in rank_indexes.items() if len(indexes) >= 4]
+    if quads:
+        quad = max(quads)
+        kicker = next(index for index in range(count) if ranks[index] != quad)
+        return calc_score((12, quad)), tuple(sorted(rank_indexes[quad][:4] + [kicker]))
+
+    trips = [rank for rank, indexes in rank_indexes.items() if len(indexes) == 3]
+    pairs = [rank for rank, indexes in rank_indexes.items() if len(indexes) >= 2]
+    if trips and len(pairs) >= 2:
+        # Очки фулл хауса - сумма рангов тройки и пары, при двух тройках любую можно взять за пару
+        full_houses = [(three, two) for three in trips for two in pairs if two != three]
+        three, two = max(full_houses, key=sum)
+        candidates = [tuple(sorted(cards_3 + cards_2))
+                      for three_, two_ in full_houses if three_ + two_ == three + two
+                      for cards_3 in combinations(rank_indexes[three_], 3)
+                      for cards_2 in combinations(rank_indexes[two_], 2)]
+        return calc_score((10, three, two)), min(candidates)
+
+    if flushes:
+        flush_sum, indexes = min(flushes)
+        return calc_score((9, -flush_sum)), tuple(indexes)
+
+    top = get_straight_top(rank_mask)
+    if top:
+        # Из карт одного ранга первая по порядку
+        return calc_score((8, top)), tuple(sorted(rank_indexes[rank][0] for rank in range(top, top - 5, -1)))
+
+    if trips:
+        three = trips[0]
+        others = [index for index in range(count) if ranks[index] != three][:2]
+        return calc_score((6, three, ranks[others[0]])), tuple(sorted(rank_indexes[three] + others))
+
+    if len(pairs) >= 2:
+        # Кикер - старшая карта вне выбранных пар, ею может быть и карта третьей пары
+        two_pairs = []
+        for max_pair, low_pair in combinations(sorted(pairs, reverse=True), 2):
+            kick = next(ranks[index] for index in range(count) if ranks[index] not in (max_pair, low_pair))
+            for kicker in rank_indexes[kick]:
+                indexes = tuple(sorted(rank_indexes[max_pair] + rank_indexes[low_pair] + [kicker]))
+                two_pairs.append((-(max_pair + low_pair + kick), indexes, (max_pair, low_pair, kick)))
+        _, indexes, two_pair_ranks = min(two_pairs)
+        return calc_score((3,) + two_pair_ranks), indexes
+
+    if pairs:
+        pair = pairs[0]
+        others = [index for index in range(count) if ranks[index] != pair][:3]
+        return calc_score((1, pair, ranks[others[0]])), tuple(sorted(rank_indexes[pair] + others))
+
+    return calc_score((0, ranks[0])), tuple(range(5))
+
+
+def best_cards(cards):
+    """best_hand для закодированных карт: возвращает (коды карт лучшей руки, очки)"""
+    cards = sorted(cards, key=lambda card: card >> 2, reverse=True)
+    score, indexes = evaluate_cards(cards)
+    return [cards[index] for index in indexes], score
+
+
+def best_hand_direct(hand, sorted_result=True, split_input=True, return_max_score=False):
+    """То же, что best_hand, с теми же результатами, но через evaluate_cards вместо перебора 21 сочетания"""
+    hand = hand.split() if split_input else hand
+    hand = sorted(hand, key=lambda card: CARD_RANKS[card[0]], reverse=True)
+    max_score, indexes = evaluate_cards([encode_card(card) for card in hand])
+    _best_hand = tuple(hand[index] for index in indexes)
+    if sorted_result:
+        _best_hand = sorted(_best_hand)
+    if return_max_score:
+        return _best_hand, max_score
+    return _best_hand
+
+
 def cards_generator(suits):
     for rank, suit in product(range(2, 15), suits):
         yield str(try_int(rank, reverse=True)) + suit
 
 
-def best_wild_hand(hand, split_input=True):
-    """best_hand но с джокерами"""
+def split_jokers(hand):
+    """Возвращает (карты без джокеров, масти замен для каждого джокера в порядке SUITS_JOKER)"""
+    hand = list(hand)
+    joker_suits = []
+    for joker, suits in SUITS_JOKER.items():
+        if joker in hand:
+            hand.remove(joker)
+            joker_suits.append(suits)
+    return hand, joker_suits
+
+
+def get_wild_score_limit(cards, joker_suits):
+    """Наибольшие очки, которые можно набрать с этими джокерами, если это стрит-флеш или каре, иначе None. Если замена
+    дает столько очков, лучше уже не будет."""
+    suit_masks = [0, 0, 0, 0]
+    rank_counts = Counter(card >> 2 for card in cards)
+    for card in cards:
+        suit_masks[card & 3] |= 1 << (card >> 2)
+    for top in range(14, 5, -1):
+        for suit_code, suit in enumerate(SUITS):
+            missing = bin(STRAIGHT_BITS << (top - 4) & ~suit_masks[suit_code]).count('1')
+            if missing <= sum(suit in suits for suits in joker_suits):
+                return calc_score((13, top))
+    quads = [rank for rank in range(2, 15) if rank_counts[rank] + len(joker_suits) >= 4]
+    if quads:
+        return calc_score((12, max(quads)))
+    return None
+
+
+def best_wild_hand(hand, split_input=True, return_max_score=False):
+    """best_hand но с джокерами. Результат тот же, что у перебора всех замен в best_wild_hand_product: из замен с
+    наибольшими очками берется первая в порядке product. Но очки считаются через evaluate_cards, а замены, которые
+    не могут дать разные очки, считаются один раз: масть замены важна, только если в этой масти может набраться флеш,
+    а порядок джокеров не важен. Если набран стрит-флеш или каре из get_wild_score_limit, больше очков не будет, и
+    остальные замены не считаются. Замены перебираются в порядке product, поэтому первая, набравшая наибольшие очки,
+    и есть ответ, и второй проход по заменам не нужен."""
+    hand = hand.split() if split_input else hand
+    stable_hand, joker_suits = split_jokers(hand)
+    if not joker_suits:
+        return best_hand_direct(stable_hand, split_input=False, return_max_score=return_max_score)
+    cards = [encode_card(card) for card in stable_hand]
+    suit_counts = Counter(card & 3 for card in cards)
+    for suits in joker_suits:
+        suit_counts.update(SUIT_CODES[suit] for suit in suits)
+    flush_suits = {suit_code for suit_code, count in suit_counts.items() if count >= 5}
+    substitutions = [[encode_card(card) for card in cards_generator(suits)] for suits in joker_suits]
+    scores = {}
+
+    def get_score(cards_set):
+        # Масть, в которой не может быть флеша, на очки не влияет
+        key = tuple(sorted((card >> 2, card & 3 if card & 3 in flush_suits else -1) for card in cards_set))
+        score = scores.get(key)
+        if score is None:
+            hand_cards = sorted(cards + list(cards_set), key=lambda card: card >> 2, reverse=True)
+            score = scores[key] = evaluate_cards(hand_cards)[0]
+        return score
+
+    score_limit = get_wild_score_limit(cards, joker_suits)
+    max_score = 0
+    best_cards_set = None
+    for cards_set in product(*substitutions):
+        score = get_score(cards_set)
+        if score > max_score:
+            max_score = score
+            best_cards_set = cards_set
+            if max_score == score_limit:
+                break
+    return best_hand_direct(stable_hand + [decode_card(card) for card in best_cards_set], split_input=False,
+                            return_max_score=return_max_score)
+
+
+def best_wild_hand_product(hand, split_input=True):
+    """best_hand но с джокерами перебором всех замен. Медленно, оставлено для проверки best_wild_hand."""
     hand = hand.split() if split_input else hand
     joker_suits = []
     max_score = 0
@@ -209,7 +503,7 @@ def best_wild_hand(hand, split_input=True):
     stable_hand = tuple(hand)
     for cards_set in product(*joker_suits):
         hand = stable_hand + cards_set
-        hand, score = best_hand(hand, split_input=False, return_max_score=True)
+        hand, score = best_hand(hand, split_input=False, return_max_score=True, score_func=cached_rank_score)
         if score > max_score:
             max_score = score
             _best_hand = hand
@@ -229,9 +523,55 @@ def test_best_wild_hand():
     assert best_wild_hand("6C 7C 8C 9C TC 5C ?B") == ['7C', '8C', '9C', 'JC', 'TC']
     assert best_wild_hand("TD TC 5H 5C 7C ?R ?B") == ['7C', 'TC', 'TD', 'TH', 'TS']
     assert best_wild_hand("JD TC TH 7C 7D 7S 7H") == ['7C', '7D', '7H', '7S', 'JD']
+    # Руки, где лучших замен несколько, и руки с повтором карты джокером
+    for hand in ("AS KD 2C 2H 9S 9D ?R", "2S 5D 8C JH KS ?B ?R", "TD TC TH 4S 3H ?B ?R", "AC KC QC 2D 3H ?B ?R",
+                 "9S 9H 4D 4C 2S 2H ?B"):
+        assert best_wild_hand(hand) == best_wild_hand_product(hand)
+    print('OK')
+
+
+def test_hand_score():
+    print("test_hand_score...")
+    scores, flush_scores = get_score_tables()
+    # Все наборы рангов без пяти одинаковых и все флеши
+    assert (len(scores), len(flush_scores)) == (6175, 1287)
+    for hand in ("6C 7C 8C 9C TC 5C JS", "TD TC TH 7C 7D 8C 8S", "JD TC TH 7C 7D 7S 7H", "AS KD 2C 2H 9S 9D 4C"):
+        assert best_hand(hand, return_max_score=True) == best_hand(hand, return_max_score=True, score_func=hand_score)
+    print('OK')
+
+
+def test_best_hand_direct():
+    print("test_best_hand_direct...")
+    assert best_hand_direct("6C 7C 8C 9C TC 5C JS") == ['6C', '7C', '8C', '9C', 'TC']
+    assert best_hand_direct("TD TC TH 7C 7D 8C 8S") == ['8C', '8S', 'TC', 'TD', 'TH']
+    assert best_hand_direct("JD TC TH 7C 7D 7S 7H") == ['7C', '7D', '7H', '7S', 'JD']
+    assert best_cards([encode_card(card) for card in "2S 3S 4S 5S 6S KD KH".split()]) == \
+        ([encode_card(card) for card in "6S 5S 4S 3S 2S".split()], 1306)
+    # Руки, где несколько наборов дают одинаковые очки: выбирается тот же, что у best_hand
+    for hand in ("AS KD 2C 2H 9S 9D 4C", "KS KH 9C 9D 5S 5H 2C", "QS QH QD 8C 8D 8S 3H", "TS TH TD 7C 7D 3S 3H",
+                 "AS QD 9C 7H 5S 4D 2C", "8S 7H 6D 5C 4S 8H 8D"):
+        assert best_hand_direct(hand, return_max_score=True) == best_hand(hand, return_max_score=True)
+    print('OK')
+
+
+def test_cached_rank_score():
+    print("test_cached_rank_score...")
+    get_canonical_score.cache_clear()
+    for hand in ("6C 7C 8C 9C TC 5C JS", "TD TC TH 7C 7D 8C 8S", "AS KD 2C 2H 9S 9D 4C"):
+        assert best_hand(hand, return_max_score=True, score_func=cached_rank_score) == \
+            best_hand(hand, return_max_score=True)
+    stats = get_hand_cache_stats()
+    assert stats['hits'] + stats['misses'] == 63 and stats['evictions'] == 0
+    # Та же рука с переставленными мастями - попадание в кэш
+    assert cached_rank_score("KH QH 9H 5H 3H".split()) == rank_score("KH QH 9H 5H 3H".split())
+    assert cached_rank_score("KD QD 9D 5D 3D".split()) == rank_score("KD QD 9D 5D 3D".split())
+    assert get_hand_cache_stats()['hits'] == stats['hits'] + 1
     print('OK')
 
 
 if __name__ == '__main__':
     test_best_hand()
     test_best_wild_hand()
+    test_hand_score()
+    test_best_hand_direct()
+    test_cached_rank_score()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Оценка лучших рук для большого числа рук сразу. Руки передаются массивом кодов карт encode_card, одна рука - одна
+строка из 5-7 карт одной колоды (джокеры не поддерживаются, для них best_wild_hand).
+
+numpy      - все сочетания по 5 карт всех рук оцениваются векторно: сумма весов рангов - индекс в таблице очков.
+processes  - если numpy нет: руки делятся на куски, которые считаются через evaluate_cards в пуле процессов."""
+import os
+from collections import Counter
+from functools import lru_cache
+from itertools import combinations, combinations_with_replacement
+from multiprocessing import Pool
+
+from poker import encode_card, evaluate_cards, get_rank_key, get_score_tables
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ENGINES = ('numpy', 'processes')
+# Сколько рук считается за один векторный проход, очки всех сочетаний занимают 21 * 4 байта на руку
+NUMPY_BATCH_HANDS = 20000
+# Сколько рук отдается одному процессу за раз
+PROCESS_BATCH_HANDS = 10000
+# Веса рангов 2..A, подобранные жадно так, что суммы весов любых 5 рангов (одного ранга не больше 4) различны. Сумма
+# весов - индекс в плотной таблице очков размером около 360 тысяч, поиск в ней дешевле поиска по произведению простых.
+RANK_WEIGHTS = (0, 1, 5, 22, 94, 312, 992, 2422, 5624, 12522, 19998, 43258, 79415)
+
+
+def encode_hands(hands):
+    """Руки строками ('6C 7C 8C 9C TC 5C JS') или списками карт -> массив кодов (N, число карт), без numpy - список
+    списков"""
+    cards = [[encode_card(card) for card in (hand.split() if isinstance(hand, str) else hand)] for hand in hands]
+    return np.array(cards, dtype=np.int16).reshape(len(cards), -1) if np is not None else cards
+
+
+@lru_cache(maxsize=None)
+def get_batch_tables():
+    """Массивы очков не флешей и флешей, индексированные суммой весов RANK_WEIGHTS рангов руки, и веса по рангам.
+    Очки берутся из get_score_tables, поэтому совпадают с rank_score."""
+    scores, flush_scores = get_score_tables()
+    weights = np.zeros(15, dtype=np.int32)
+    weights[2:] = RANK_WEIGHTS
+    size = sum(sorted(RANK_WEIGHTS)[-2:]) + 4 * max(RANK_WEIGHTS) + 1
+    score_table = np.zeros(size, dtype=np.int32)
+    flush_table = np.zeros(size, dtype=np.int32)
+    for ranks in combinations_with_replacement(range(2, 15), 5):
+        if max(Counter(ranks).values()) > 4:
+            continue
+        key = weights[list(ranks)].sum()
+        assert not score_table[key], 'RANK_WEIGHTS give equal sums for different ranks'
+        score_table[key] = scores[get_rank_key(ranks)]
+        if len(set(ranks)) == 5:
+            flush_table[key] = flush_scores[get_rank_key(ranks)]
+    return weights, score_table, flush_table
+
+
+def evaluate_batch_numpy(cards):
+    """Векторная оценка пачки рук. Карты каждой руки сортируются по рангу с сохранением порядка равных, а argmax
+    берет первое сочетание с наибольшими очками, поэтому выбор руки тот же, что у best_hand."""
+    weights, score_table, flush_table = get_batch_tables()
+    cards = cards.astype(np.int64)
+    order = np.argsort(-(cards >> 2), axis=1, kind='stable')
+    cards = np.take_along_axis(cards, order, axis=1)
+    card_weights = weights[cards >> 2]
+    suits = cards & 3
+    # (число сочетаний, 5) индексов карт в порядке combinations
+    combos = list(combinations(range(cards.shape[1]), 5))
+    scores = np.empty((len(cards), len(combos)), dtype=np.int32)
+    # По столбцам, а не через индексацию массивом сочетаний: так не создаются массивы (рук, сочетаний, 5)
+    for column, combo in enumerate(combos):
+        key = card_weights[:, combo[0]].copy()
+        is_flush = np.ones(len(cards), dtype=bool)
+        for index in combo[1:]:
+            key += card_weights[:, index]
+            is_flush &= suits[:, index] == suits[:, combo[0]]
+        scores[:, column] = np.where(is_flush, flush_table[key], score_table[key])
+    best = scores.argmax(axis=1)
+    rows = np.arange(len(cards))
+    indexes = np.sort(order[rows[:, None], np.array(combos)[best]], axis=1)
+    return scores[rows, best], indexes
+
+
+def evaluate_batch_python(cards):
+    """То же, что evaluate_batch_numpy, для списка рук через evaluate_cards"""
+    scores = []
+    indexes = []
+    for hand in cards:
+        order = sorted(range(len(hand)), key=lambda index: hand[index] >> 2, reverse=True)
+        score, best = evaluate_cards([hand[index] for index in order])
+        scores.append(score)
+        indexes.append(sorted(order[index] for index in best))
+    return scores, indexes
+
+
+def evaluate_hands(cards, engine=None, workers=None):
+    """Возвращает (очки лучших рук, индексы 5 карт лучших рук в строках cards по возрастанию) - те же очки и карты,
+    что у best_hand. cards - результат encode_hands. engine - один из ENGINES, по умолчанию numpy, если установлен.
+    Для numpy результат - массивы numpy, для processes - списки."""
+    engine = engine or ('numpy' if np is not None else 'processes')
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine "{}", should be one of {}'.format(engine, ', '.join(ENGINES)))
+    if engine == 'numpy':
+        if np is None:
+            raise ImportError('Engine "numpy" requires numpy to be installed')
+        cards = np.asarray(cards)
+        if not len(cards):
+            return np.zeros(0, dtype=np.int32), np.zeros((0, 5), dtype=np.int64)
+        results = [evaluate_batch_numpy(cards[start:start + NUMPY_BATCH_HANDS])
+                   for start in range(0, len(cards), NUMPY_BATCH_HANDS)]
+        return np.concatenate([scores for scores, _ in results]), np.concatenate([indexes for _, indexes in results])
+    cards = cards.tolist() if np is not None and isinstance(cards, np.ndarray) else cards
+    batches = [cards[start:start + PROCESS_BATCH_HANDS] for start in range(0, len(cards), PROCESS_BATCH_HANDS)]
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(batches) > 1:
+        with Pool(processes=workers) as pool:
+            results = pool.map(evaluate_batch_python, batches)
+    else:
+        results = [evaluate_batch_python(batch) for batch in batches]
+    return [score for scores, _ in results for score in scores], [index for _, indexes in results for index in indexes]
+
+
+def test_evaluate_hands():
+    from poker import best_hand
+
+    print("test_evaluate_hands...")
+    hands = ["6C 7C 8C 9C TC 5C JS", "TD TC TH 7C 7D 8C 8S", "JD TC TH 7C 7D 7S 7H", "AS KD 2C 2H 9S 9D 4C",
+             "KS KH 9C 9D 5S 5H 2C", "AS QD 9C 7H 5S 4D 2C", "8S 7H 6D 5C 4S 8H 8D"]
+    expected = [best_hand(hand, return_max_score=True) for hand in hands]
+    cards = encode_hands(hands)
+    engines = ENGINES if np is not None else ('processes',)
+    for engine in engines:
+        scores, indexes = evaluate_hands(cards, engine=engine, workers=1)
+        for hand, score, best, (expected_hand, expected_score) in zip(hands, scores, indexes, expected):
+            assert score == expected_score
+            assert sorted(hand.split()[index] for index in best) == expected_hand
+    print('OK')
+
+
+if __name__ == '__main__':
+    test_evaluate_hands()
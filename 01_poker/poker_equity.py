@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Эквити руки: доля банка, которую рука в среднем забирает против opponents соперников со случайными картами при
+известных картах игрока и части борда. Рука - лучшие 5 из 2 карт игрока и 5 карт борда, сила - очки best_hand, при
+равенстве банк делится поровну.
+
+Если раздач оставшихся карт не больше samples, перебираются все, иначе выбираются случайные. Раздачи считаются кусками
+в пуле процессов, после каждого куска оценка дополняется точкой сходимости. Без джокеров руки оцениваются пачками
+через poker_batch.evaluate_hands, с джокерами - по одной через best_wild_hand."""
+import argparse
+import math
+import os
+import random
+from collections import deque
+from itertools import combinations, islice
+from multiprocessing import Pool
+
+from poker import SUITS_JOKER, best_cards, best_wild_hand, encode_card, try_int
+from poker_batch import encode_hands, evaluate_hands, np
+
+DECK = [str(try_int(rank, reverse=True)) + suit for rank in range(2, 15) for suit in 'SHDC']
+# Сколько раздач считается одним куском. После каждого куска добавляется точка сходимости.
+CHUNK_DEALS = 20000
+
+
+class EquityResult:
+    """Итог подсчета. Для каждой раздачи доля игрока - 1 за победу, 1/k за дележ на k игроков, 0 за проигрыш."""
+
+    def __init__(self, exhaustive):
+        self.exhaustive = exhaustive
+        self.deals = 0
+        self.wins = 0
+        self.ties = 0
+        self.share_sum = 0.0
+        self.share_sq_sum = 0.0
+        # (раздач, эквити, стандартная ошибка) после каждого куска
+        self.convergence = []
+
+    def add(self, chunk):
+        deals, wins, ties, share_sum, share_sq_sum = chunk
+        self.deals += deals
+        self.wins += wins
+        self.ties += ties
+        self.share_sum += share_sum
+        self.share_sq_sum += share_sq_sum
+        self.convergence.append((self.deals, self.equity, self.stderr))
+
+    @property
+    def equity(self):
+        return self.share_sum / self.deals if self.deals else 0.0
+
+    @property
+    def stderr(self):
+        """Стандартная ошибка оценки эквити, для полного перебора 0"""
+        if self.exhaustive or self.deals < 2:
+            return 0.0
+        variance = max(self.share_sq_sum / self.deals - self.equity ** 2, 0.0)
+        return math.sqrt(variance / (self.deals - 1))
+
+    def as_dict(self):
+        return {
+            'deals': self.deals,
+            'exhaustive': self.exhaustive,
+            'equity': self.equity,
+            'stderr': self.stderr,
+            'win': self.wins / self.deals if self.deals else 0.0,
+            'tie': self.ties / self.deals if self.deals else 0.0,
+        }
+
+
+def comb(n, k):
+    """Число сочетаний из n по k. math.comb есть только с python 3.8."""
+    if not 0 <= k <= n:
+        return 0
+    result = 1
+    for i in range(min(k, n - k)):
+        # Произведение i + 1 подряд идущих чисел делится на (i + 1)!, поэтому деление всегда нацело
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def count_deals(deck_size, missing, opponents):
+    """Число разных раздач missing карт борда и по 2 карты каждому сопернику"""
+    count = comb(deck_size, missing)
+    deck_size -= missing
+    for _ in range(opponents):
+        count *= comb(deck_size, 2)
+        deck_size -= 2
+    return count
+
+
+def iter_holes(deck, opponents):
+    if not opponents:
+        yield ()
+        return
+    for hole in combinations(deck, 2):
+        rest = [card for card in deck if card not in hole]
+        for others in iter_holes(rest, opponents - 1):
+            yield hole + others
+
+
+def iter_deals(deck, missing, opponents):
+    """Все раздачи: missing карт борда, затем по 2 карты соперникам"""
+    for board_cards in combinations(deck, missing):
+        rest = [card for card in deck if card not in board_cards]
+        for holes in iter_holes(rest, opponents):
+            yield board_cards + holes
+
+
+def get_share_stats(player_scores, opponents_scores):
+    """Складывает доли игрока по раздачам. opponents_scores - очки соперников по раздачам."""
+    wins = ties = 0
+    share_sum = share_sq_sum = 0.0
+    for score, scores in zip(player_scores, opponents_scores):
+        best = max(scores)
+        if score > best:
+            wins += 1
+        elif score == best:
+            ties += 1
+            share = 1 / (1 + scores.count(score))
+            share_sum += share
+            share_sq_sum += share * share
+    return len(player_scores), wins, ties, wins + share_sum, wins + share_sq_sum
+
+
+def score_deals_numpy(hole, board, deals, opponents):
+    """Раздачи массивом кодов карт (раздач, карт в раздаче), все руки оцениваются пачками"""
+    missing = 5 - len(board)
+    count = len(deals)
+    full_board = np.concatenate([np.tile(np.array(board, dtype=np.int16), (count, 1)), deals[:, :missing]], axis=1)
+    player_scores, _ = evaluate_hands(np.concatenate([np.tile(np.array(hole, dtype=np.int16), (count, 1)),
+                                                      full_board], axis=1), engine='numpy')
+    opponents_scores = np.stack([
+        evaluate_hands(np.concatenate([deals[:, missing + 2 * i:missing + 2 * i + 2], full_board], axis=1),
+                       engine='numpy')[0]
+        for i in range(opponents)], axis=1)
+    best = opponents_scores.max(axis=1)
+    wins = player_scores > best
+    ties = player_scores == best
+    shares = np.where(ties, 1 / (1 + (opponents_scores == player_scores[:, None]).sum(axis=1)), wins.astype(float))
+    return count, int(wins.sum()), int(ties.sum()), float(shares.sum()), float((shares * shares).sum())
+
+
+def get_hand_score(hand):
+    if any(card in SUITS_JOKER for card in hand):
+        return best_wild_hand(hand, split_input=False, return_max_score=True)[1]
+    return best_cards([encode_card(card) for card in hand])[1]
+
+
+def score_deals_python(hole, board, deals, opponents):
+    """Раздачи списками карт строками, руки оцениваются по одной"""
+    missing = 5 - len(board)
+    player_scores = []
+    opponents_scores = []
+    for deal in deals:
+        full_board = board + list(deal[:missing])
+        player_scores.append(get_hand_score(hole + full_board))
+        opponents_scores.append([get_hand_score(list(deal[missing + 2 * i:missing + 2 * i + 2]) + full_board)
+                                 for i in range(opponents)])
+    return get_share_stats(player_scores, opponents_scores)
+
+
+def use_numpy(hole, board, deck):
+    return np is not None and not any(card in SUITS_JOKER for card in hole + board + deck)
+
+
+def score_deals(task):
+    """Считает кусок раздач. task - (карты игрока, борд, колода, соперников, раздачи или (число, seed) для случайных)"""
+    hole, board, deck, opponents, deals = task
+    need = 5 - len(board) + 2 * opponents
+    if use_numpy(hole, board, deck):
+        codes = encode_hands([deck])[0]
+        if isinstance(deals, tuple):
+            count, seed = deals
+            # Случайная перестановка колоды для каждой раздачи, первые need карт - раздача
+            order = np.random.default_rng(seed).random((count, len(deck))).argsort(axis=1)[:, :need]
+            deals = codes[order]
+        else:
+            deals = encode_hands(deals).reshape(len(deals), need)
+        return score_deals_numpy(encode_hands([hole])[0], encode_hands([board])[0].tolist(), deals, opponents)
+    if isinstance(deals, tuple):
+        count, seed = deals
+        rnd = random.Random(seed)
+        deals = [rnd.sample(deck, need) for _ in range(count)]
+    return score_deals_python(hole, board, deals, opponents)
+
+
+def get_tasks(hole, board, deck, opponents, exhaustive, samples, seed, chunk_deals):
+    if exhaustive:
+        deals = iter_deals(deck, 5 - len(board), opponents)
+        while True:
+            chunk = list(islice(deals, chunk_deals))
+            if not chunk:
+                return
+            yield hole, board, deck, opponents, chunk
+    rnd = random.Random(seed)
+    for start in range(0, samples, chunk_deals):
+        yield hole, board, deck, opponents, (min(chunk_deals, samples - start), rnd.getrandbits(63))
+
+
+def calc_equity(hole, board='', opponents=1, samples=100000, exhaustive=None, jokers=False, workers=None, seed=None,
+                chunk_deals=CHUNK_DEALS, progress=None):
+    """Возвращает EquityResult для карт игрока hole при борде board (строки карт через пробел).
+    exhaustive - перебрать все раздачи, по умолчанию - если их не больше samples. jokers - в колоде есть два джокера.
+    progress - функция, которая вызывается с EquityResult после каждого куска."""
+    hole = hole.split() if isinstance(hole, str) else list(hole)
+    board = board.split() if isinstance(board, str) else list(board)
+    known = hole + board
+    if len(hole) != 2 or len(board) > 5:
+        raise ValueError('Need 2 hole cards and at most 5 board cards')
+    if len(set(known)) != len(known):
+        raise ValueError('Cards are repeated: {}'.format(' '.join(known)))
+    deck = [card for card in DECK + (list(SUITS_JOKER) if jokers else []) if card not in known]
+    missing = 5 - len(board)
+    if missing + 2 * opponents > len(deck):
+        raise ValueError('Not enough cards for {} opponents'.format(opponents))
+    if exhaustive is None:
+        exhaustive = count_deals(len(deck), missing, opponents) <= samples
+    result = EquityResult(exhaustive)
+    tasks = get_tasks(hole, board, deck, opponents, exhaustive, samples, seed, chunk_deals)
+    workers = workers or os.cpu_count()
+    for chunk in imap_bounded(score_deals, tasks, workers) if workers > 1 else map(score_deals, tasks):
+        result.add(chunk)
+        if progress:
+            progress(result)
+    return result
+
+
+def imap_bounded(func, tasks, workers):
+    """Как pool.imap, но держит в работе не больше двух задач на процесс. pool.imap вычитывает генератор tasks
+    целиком, и при полном переборе в памяти оказались бы все раздачи сразу."""
+    pending = deque()
+    with Pool(processes=workers) as pool:
+        # Пул закроется через terminate при выходе из with, даже если результаты дочитаны не до конца
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def test_calc_equity():
+    print("test_calc_equity...")
+    # На полном борде раздаются только карты соперника, 990 раздач
+    result = calc_equity("AS AH", "AD AC 2S 3H 4D", workers=1)
+    assert result.exhaustive and result.deals == 990 and result.equity == 1
+    assert count_deals(45, 0, 1) == 990 and count_deals(47, 2, 0) == 1081 and comb(3, 5) == 0
+    # Оценка пачками и по одной дают одно и то же на одних и тех же раздачах
+    hole, board = ["AS", "KS"], ["QS", "JS", "2D", "7H"]
+    deck = [card for card in DECK if card not in hole + board]
+    deals = list(islice(iter_deals(deck, 1, 2), 3000))
+    expected = score_deals_python(hole, board, deals, 2)
+    stats = score_deals((hole, board, deck, 2, deals))
+    assert stats[:3] == expected[:3] and all(math.isclose(a, b) for a, b in zip(stats[3:], expected[3:]))
+    result = calc_equity("AS KS", "QS JS 2D", samples=20000, exhaustive=False, seed=1, workers=1, chunk_deals=5000)
+    assert len(result.convergence) == 4 and 0.6 < result.equity < 0.8 and result.stderr < 0.01
+    # Тот же seed - тот же результат
+    again = calc_equity("AS KS", "QS JS 2D", samples=20000, exhaustive=False, seed=1, workers=1, chunk_deals=5000)
+    assert again.as_dict() == result.as_dict()
+    # В пуле процессов куски те же и в том же порядке
+    parallel = calc_equity("AS KS", "QS JS 2D", samples=20000, exhaustive=False, seed=1, workers=2, chunk_deals=5000)
+    assert parallel.as_dict() == result.as_dict() and parallel.convergence == result.convergence
+    print('OK')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Poker hand equity against random opponents.')
+    parser.add_argument('hole', nargs='?', help='two hole cards, e.g. "AS KS"')
+    parser.add_argument('--board', default='', help='known board cards, e.g. "QS JS 2D"')
+    parser.add_argument('--opponents', type=int, default=1)
+    parser.add_argument('--samples', type=int, default=100000,
+                        help='random deals, if there are more possible deals than that')
+    parser.add_argument('--exhaustive', action='store_true', default=None, help='enumerate all deals')
+    parser.add_argument('--jokers', action='store_true', help='the deck has two jokers')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default - all cores')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--test', action='store_true', help='run tests instead')
+    args = parser.parse_args()
+    if args.test:
+        test_calc_equity()
+        return
+    if not args.hole:
+        parser.error('hole cards are required')
+
+    def progress(result):
+        print('{:>10} deals: equity {:.4f} +- {:.4f}'.format(result.deals, result.equity, result.stderr))
+
+    result = calc_equity(args.hole, args.board, args.opponents, args.samples, args.exhaustive, args.jokers,
+                         args.workers, args.seed, progress=progress)
+    print(' '.join('{}: {}'.format(key, value) for key, value in result.as_dict().items()))
+
+
+if __name__ == '__main__':
+    main()